@@ -0,0 +1,117 @@
+"""
+Benchmark of pooled against per-request HTTP sessions for KBase token lookups.
+
+Lookups go through KBaseAuth and its pooled session, and through a new session per request, as
+the client made before, to a local fake Auth2 server.
+
+Run from the repository root:
+    python -m bench.auth_session [--requests N] [--concurrency C] [--latency SECONDS]
+
+The fake server is plain HTTP on localhost, so only TCP setup is saved per request. Against the
+real server each new session also pays a TLS handshake and a DNS lookup, so the gap is larger.
+"""
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+from aiohttp import web
+
+from berdl.auth.kb_auth import KBaseAuth, _get
+
+
+class FakeAuth2:
+    """
+    Answers /api/V2/me for any token, and counts the connections it accepted.
+    """
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.connections = set()
+
+    async def me(self, request: web.Request) -> web.Response:
+        self.connections.add(id(request.transport))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"user": "alice", "customroles": []})
+
+    async def start(self) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_get("/services/auth/api/V2/me", self.me)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        self.port = runner.addresses[0][1]
+        return runner
+
+
+async def _per_request_session(url: str, token: str) -> None:
+    # what every lookup did before the session was shared
+    async with aiohttp.ClientSession() as session:
+        await _get(session, url + "api/V2/me", {"Authorization": token})
+
+
+async def _measure(name: str, server: FakeAuth2, lookup, requests: int, concurrency: int):
+    server.connections.clear()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int) -> float:
+        async with semaphore:
+            start = time.perf_counter()
+            await lookup(f"token-{i}")
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = sorted(await asyncio.gather(*(one(i) for i in range(requests))))
+    total = time.perf_counter() - start
+    print(
+        f"{name:<12} {requests:>8} {total:>9.3f} {requests / total:>10.0f} "
+        f"{latencies[len(latencies) // 2] * 1000:>9.2f} "
+        f"{latencies[int(len(latencies) * 0.99)] * 1000:>9.2f} "
+        f"{len(server.connections):>12}"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    server = FakeAuth2(args.latency)
+    runner = await server.start()
+    url = f"http://127.0.0.1:{server.port}/services/auth/"
+    auth = KBaseAuth(url, [])
+    try:
+        print(
+            f"{'session':<12} {'requests':>8} {'total s':>9} {'req/s':>10} "
+            f"{'p50 ms':>9} {'p99 ms':>9} {'connections':>12}"
+        )
+        # warm up both paths, e.g. the import of the JSON decoder
+        await auth.get_user("warm-up")
+        await _per_request_session(url, "warm-up")
+        await _measure(
+            "per-request",
+            server,
+            lambda token: _per_request_session(url, token),
+            args.requests,
+            args.concurrency,
+        )
+        await _measure(
+            "pooled", server, auth.get_user, args.requests, args.concurrency
+        )
+    finally:
+        await auth.close()
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000, help="Lookups per mode.")
+    parser.add_argument(
+        "--concurrency", type=int, default=10, help="Lookups in flight at once."
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0,
+        help="Seconds the fake server takes to answer.",
+    )
+    asyncio.run(main(parser.parse_args()))
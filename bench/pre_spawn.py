@@ -0,0 +1,96 @@
+"""
+Benchmark of the pre-spawn steps run concurrently against one after the other.
+
+The governance and Spark steps are fakes that wait as long as the real services typically
+take, with jitter. The concurrent pipeline is the one the hub uses, where the steps do not
+depend on each other; the sequential pipeline makes Spark depend on governance, as the hook ran
+them before.
+
+Run from the repository root:
+    python -m bench.pre_spawn [--spawns N] [--governance SECONDS] [--spark SECONDS]
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import time
+from types import SimpleNamespace
+
+from berdl.config.hooks.pipeline import HookPipeline, SpawnStep
+
+
+def _fake_step(mean: float, jitter: float):
+    async def run(spawner):
+        await asyncio.sleep(max(0.0, random.gauss(mean, mean * jitter)))
+
+    return run
+
+
+def _pipeline(args: argparse.Namespace, sequential: bool) -> HookPipeline:
+    pipeline = HookPipeline("sequential" if sequential else "concurrent")
+    pipeline.add_step(
+        SpawnStep(
+            "governance", _fake_step(args.governance, args.jitter), critical=False
+        )
+    )
+    pipeline.add_step(
+        SpawnStep(
+            "spark",
+            _fake_step(args.spark, args.jitter),
+            depends_on=["governance"] if sequential else [],
+        )
+    )
+    return pipeline
+
+
+async def _measure(pipeline: HookPipeline, spawns: int) -> None:
+    log = logging.getLogger("bench")
+
+    async def spawn(i: int) -> float:
+        spawner = SimpleNamespace(user=SimpleNamespace(name=f"user-{i}"), log=log)
+        start = time.perf_counter()
+        await pipeline.run(spawner)
+        return time.perf_counter() - start
+
+    # the spawns run at once, like a class starting together
+    durations = sorted(await asyncio.gather(*(spawn(i) for i in range(spawns))))
+    print(
+        f"{pipeline.name:<12} {spawns:>7} {statistics.mean(durations):>9.3f} "
+        f"{durations[len(durations) // 2]:>9.3f} "
+        f"{durations[int(len(durations) * 0.99)]:>9.3f}"
+    )
+
+
+async def main(args: argparse.Namespace) -> None:
+    random.seed(args.seed)
+    print(
+        f"governance {args.governance:g}s, spark {args.spark:g}s, "
+        f"jitter {args.jitter:.0%}"
+    )
+    print(f"{'pipeline':<12} {'spawns':>7} {'mean s':>9} {'p50 s':>9} {'p99 s':>9}")
+    for sequential in (True, False):
+        await _measure(_pipeline(args, sequential), args.spawns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--spawns", type=int, default=200, help="Spawns per pipeline.")
+    parser.add_argument(
+        "--governance",
+        type=float,
+        default=0.4,
+        help="Mean seconds the governance step takes.",
+    )
+    parser.add_argument(
+        "--spark", type=float, default=1.5, help="Mean seconds the Spark step takes."
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=0.25,
+        help="Standard deviation of the step durations, as a fraction of their mean.",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    asyncio.run(main(parser.parse_args()))
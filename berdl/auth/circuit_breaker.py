@@ -0,0 +1,111 @@
+"""
+A circuit breaker for calls to an external service.
+"""
+
+import time
+from enum import IntEnum
+from typing import Callable
+
+
+class BreakerState(IntEnum):
+    """
+    The states of a circuit breaker. The values are exported as a metric.
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitOpenError(IOError):
+    """An error thrown when a call is rejected because the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Stops calls to a failing service until it has had time to recover.
+
+    The breaker opens after `failure_threshold` consecutive failures and rejects calls for
+    `reset_timeout` seconds. It then lets a single trial call through; if the trial succeeds the
+    breaker closes, otherwise it opens again.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30,
+        on_state_change: Callable[[BreakerState], None] | None = None,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Create the breaker.
+        :param failure_threshold: the number of consecutive failures that opens the breaker.
+        :param reset_timeout: the number of seconds to reject calls once the breaker opens.
+        :param on_state_change: a function called with the new state when the state changes.
+        :param timer: a function returning the current time in seconds.
+        """
+        if failure_threshold < 1:
+            raise ValueError("failure_threshold must be > 0")
+        if reset_timeout < 0:
+            raise ValueError("reset_timeout must be >= 0")
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._on_state_change = on_state_change
+        self._timer = timer
+        self._state = BreakerState.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> BreakerState:
+        """
+        The current state of the breaker.
+        """
+        if (
+            self._state == BreakerState.OPEN
+            and self._timer() - self._opened_at >= self._reset_timeout
+        ):
+            self._set_state(BreakerState.HALF_OPEN)
+        return self._state
+
+    def check(self) -> None:
+        """
+        Check that a call may proceed. Every permitted call must be followed by a call to
+        :meth:`record_success` or :meth:`record_failure`.
+        :raises CircuitOpenError: if the breaker is rejecting calls.
+        """
+        state = self.state
+        if state == BreakerState.OPEN:
+            raise CircuitOpenError("Circuit breaker is open")
+        if state == BreakerState.HALF_OPEN:
+            if self._trial_in_flight:
+                raise CircuitOpenError("Circuit breaker is waiting on a trial call")
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        """
+        Record a successful call.
+        """
+        self._failures = 0
+        self._trial_in_flight = False
+        if self._state != BreakerState.CLOSED:
+            self._set_state(BreakerState.CLOSED)
+
+    def record_failure(self) -> None:
+        """
+        Record a failed call.
+        """
+        self._failures += 1
+        self._trial_in_flight = False
+        if (
+            self._state == BreakerState.HALF_OPEN
+            or self._failures >= self._failure_threshold
+        ):
+            self._opened_at = self._timer()
+            self._set_state(BreakerState.OPEN)
+
+    def _set_state(self, state: BreakerState) -> None:
+        self._state = state
+        if self._on_state_change:
+            self._on_state_change(state)
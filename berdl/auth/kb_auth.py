@@ -5,15 +5,29 @@ A client for the KBase Auth2 server.
 # Mostly copied from https://github.com/kbase/collections
 
 
+import asyncio
 import logging
+import random
+import time
 from enum import IntEnum
-from typing import NamedTuple, List
+from typing import NamedTuple, List, Optional
 
 import aiohttp
 from tornado import web
 
 from berdl.auth.arg_checkers import not_falsy as _not_falsy
+from berdl.auth.circuit_breaker import CircuitBreaker, CircuitOpenError
 from berdl.auth.kb_user import UserID
+from berdl.auth.single_flight import SingleFlight
+from berdl.auth.token_cache import TokenCache, hash_token
+from berdl.metrics import (
+    AUTH_LOOKUPS_DEDUPLICATED,
+    AUTH_REQUEST_DURATION_SECONDS,
+    AuthRequestStatus,
+)
+
+# Errors that indicate the auth server is unavailable, rather than that the token is bad
+_TRANSIENT_ERRORS = (IOError, aiohttp.ClientError, asyncio.TimeoutError)
 
 
 class AdminPermission(IntEnum):
@@ -32,11 +46,10 @@ class KBaseUser(NamedTuple):
     token: str
 
 
-async def _get(url, headers):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as r:
-            await _check_error(r)
-            return await r.json()
+async def _get(session, url, headers):
+    async with session.get(url, headers=headers) as r:
+        await _check_error(r)
+        return await r.json()
 
 
 async def _check_error(r):
@@ -59,25 +72,187 @@ async def _check_error(r):
 
 
 class KBaseAuth:
-    """A client for contacting the KBase authentication server."""
+    """
+    A client for contacting the KBase authentication server.
 
-    def __init__(self, auth_url: str, full_admin_roles: List[str]):
+    The client owns a long lived HTTP session with a keep alive connection pool, so it should be
+    created once and shared. Call :meth:`close` when the client is no longer needed.
+
+    Each request to the auth server has a deadline, transient failures are retried, and an
+    optional circuit breaker stops requests to the server while it is failing. If the cache
+    retains stale entries, a recently validated token is honored while the server is unavailable.
+    """
+
+    def __init__(
+        self,
+        auth_url: str,
+        full_admin_roles: List[str],
+        cache: Optional[TokenCache] = None,
+        connection_limit: int = 100,
+        connection_limit_per_host: int = 20,
+        dns_cache_ttl: int = 300,
+        keepalive_timeout: float = 60,
+        request_timeout: float = 10,
+        max_retries: int = 1,
+        breaker: Optional[CircuitBreaker] = None,
+    ):
+        """
+        Create the client.
+        :param auth_url: the root URL of the KBase auth server.
+        :param full_admin_roles: the KBase custom roles that grant full admin permission.
+        :param cache: a cache for token validation results. If None, every lookup contacts
+            the auth server.
+        :param connection_limit: the maximum number of pooled connections.
+        :param connection_limit_per_host: the maximum number of pooled connections per host.
+        :param dns_cache_ttl: seconds to cache DNS lookups.
+        :param keepalive_timeout: seconds to keep an idle connection open.
+        :param request_timeout: the deadline, in seconds, for each request to the auth server.
+        :param max_retries: the number of times to retry a request that failed with a transient
+            error.
+        :param breaker: a circuit breaker guarding requests to the auth server.
+        """
         self._url = auth_url
         self._me_url = self._url + "api/V2/me"
         self._full_roles = set(full_admin_roles) if full_admin_roles else set()
+        self._cache = cache
+        self._connection_limit = connection_limit
+        self._connection_limit_per_host = connection_limit_per_host
+        self._dns_cache_ttl = dns_cache_ttl
+        self._keepalive_timeout = keepalive_timeout
+        self._request_timeout = request_timeout
+        self._max_retries = max_retries
+        self._breaker = breaker
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._single_flight = SingleFlight(on_join=AUTH_LOOKUPS_DEDUPLICATED.inc)
 
-    async def get_user(self, token: str) -> KBaseUser:
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily since aiohttp sessions must be created inside the running event loop.
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._connection_limit,
+                limit_per_host=self._connection_limit_per_host,
+                ttl_dns_cache=self._dns_cache_ttl,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self._request_timeout),
+            )
+        return self._session
+
+    async def close(self) -> None:
+        """
+        Close the HTTP session and its pooled connections.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def get_user(self, token: str, refresh: bool = False) -> KBaseUser:
         """
         Get a username from a token as well as the user's administration status.
         :param token: The user's token.
+        :param refresh: True to ignore any cached result and revalidate the token with the auth
+            server. The new result is cached.
         :returns: the user.
         """
         # TODO CODE should check the token for \n etc.
         _not_falsy(token, "token")
+        if self._cache is not None and not refresh:
+            cached = self._cache.get(token)
+            if isinstance(cached, InvalidTokenError):
+                raise cached
+            if cached is not None:
+                return cached
+        # concurrent lookups of the same token share a single request to the auth server
+        return await self._single_flight.do(
+            hash_token(token), lambda: self._fetch_user(token)
+        )
 
-        j = await _get(self._me_url, {"Authorization": token})
+    async def _fetch_user(self, token: str) -> KBaseUser:
+        try:
+            j = await self._get_me(token)
+        except InvalidTokenError as e:
+            if self._cache is not None:
+                self._cache.put_invalid(token, e)
+            raise
+        except _TRANSIENT_ERRORS:
+            stale = self._cache.get_stale(token) if self._cache is not None else None
+            if stale is None:
+                raise
+            logging.getLogger(__name__).warning(
+                "KBase auth server unavailable, using previous validation for user %s",
+                stale.user,
+                exc_info=True,
+            )
+            return stale
         v = (self._get_role(j["customroles"]), UserID(j["user"]))
-        return KBaseUser(v[1], v[0], token)
+        user = KBaseUser(v[1], v[0], token)
+        if self._cache is not None:
+            self._cache.put(token, user)
+        return user
+
+    async def _get_me(self, token: str) -> dict:
+        attempt = 0
+        while True:
+            try:
+                return await self._timed_get_me(token)
+            except CircuitOpenError:
+                raise
+            except _TRANSIENT_ERRORS:
+                if attempt >= self._max_retries:
+                    raise
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, 0.1 * 2**attempt))
+
+    async def _timed_get_me(self, token: str) -> dict:
+        if self._breaker is not None:
+            try:
+                self._breaker.check()
+            except CircuitOpenError:
+                AUTH_REQUEST_DURATION_SECONDS.labels(
+                    status=AuthRequestStatus.rejected
+                ).observe(0)
+                raise
+        status = AuthRequestStatus.failure
+        start = time.perf_counter()
+        try:
+            j = await _get(
+                self._get_session(), self._me_url, {"Authorization": token}
+            )
+            status = AuthRequestStatus.success
+            return j
+        except InvalidTokenError:
+            status = AuthRequestStatus.invalid_token
+            raise
+        except asyncio.TimeoutError:
+            status = AuthRequestStatus.timeout
+            raise
+        finally:
+            AUTH_REQUEST_DURATION_SECONDS.labels(status=status).observe(
+                time.perf_counter() - start
+            )
+            if self._breaker is not None:
+                # a rejected token means the server is healthy
+                if status in (AuthRequestStatus.success, AuthRequestStatus.invalid_token):
+                    self._breaker.record_success()
+                else:
+                    self._breaker.record_failure()
+
+    @property
+    def cache(self) -> Optional[TokenCache]:
+        """
+        The token validation cache, if any.
+        """
+        return self._cache
+
+    @property
+    def deduplicated_lookups(self) -> int:
+        """
+        The number of lookups that joined an identical in flight lookup rather than contacting
+        the auth server.
+        """
+        return self._single_flight.deduplicated
 
     def _get_role(self, roles):
         r = set(roles)
@@ -2,9 +2,20 @@ import logging
 import os
 
 from jupyterhub.auth import Authenticator
-from traitlets import Unicode, List
+from traitlets import Unicode, List, Integer, Float
 
-from berdl.auth.kb_auth import KBaseAuth, MissingTokenError, AdminPermission
+from berdl.auth.circuit_breaker import CircuitBreaker
+from berdl.auth.kb_auth import (
+    KBaseAuth,
+    MissingTokenError,
+    AdminPermission,
+    InvalidTokenError,
+)
+from berdl.auth.spawn_context import SpawnContext
+from berdl.auth.token_cache import TokenCache
+from berdl.auth.token_refresher import TokenRefresher
+from berdl.lifecycle import on_shutdown
+from berdl.metrics import AUTH_CIRCUIT_BREAKER_STATE
 
 logger = logging.getLogger(__name__)
 
@@ -36,10 +47,163 @@ class KBaseAuthenticator(Authenticator):
         help="Comma-separated list of KBase roles with full administrative access to JupyterHub.",
     )
 
-    async def authenticate(self, handler, data=None) -> dict:
+    token_cache_max_size = Integer(
+        default_value=int(os.getenv("KBASE_TOKEN_CACHE_MAX_SIZE", "10000")),
+        config=True,
+        help="Maximum number of validated tokens to cache. Least recently used entries are evicted first.",
+    )
+
+    token_cache_ttl = Float(
+        default_value=float(os.getenv("KBASE_TOKEN_CACHE_TTL_SECONDS", "300")),
+        config=True,
+        help="Seconds to cache a successful token validation. 0 disables the cache.",
+    )
+
+    token_cache_negative_ttl = Float(
+        default_value=float(os.getenv("KBASE_TOKEN_CACHE_NEGATIVE_TTL_SECONDS", "30")),
+        config=True,
+        help="Seconds to cache a token the KBase auth server reported as invalid. 0 disables negative caching.",
+    )
+
+    token_cache_stale_ttl = Float(
+        default_value=float(os.getenv("KBASE_TOKEN_CACHE_STALE_TTL_SECONDS", "0")),
+        config=True,
+        help="""Seconds past expiry that a cached token validation is still honored while the
+        KBase auth server is unavailable (stale-while-revalidate). 0 disables this.""",
+    )
+
+    auth_request_timeout = Float(
+        default_value=float(os.getenv("KBASE_AUTH_REQUEST_TIMEOUT_SECONDS", "10")),
+        config=True,
+        help="Deadline, in seconds, for each request to the KBase auth server.",
+    )
+
+    auth_max_retries = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_MAX_RETRIES", "1")),
+        config=True,
+        help="Number of times to retry a request to the KBase auth server that failed with a transient error.",
+    )
+
+    auth_breaker_failure_threshold = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_BREAKER_FAILURE_THRESHOLD", "5")),
+        config=True,
+        help="Consecutive KBase auth server failures that open the circuit breaker.",
+    )
+
+    auth_breaker_reset_timeout = Float(
+        default_value=float(os.getenv("KBASE_AUTH_BREAKER_RESET_SECONDS", "30")),
+        config=True,
+        help="Seconds the circuit breaker stays open before a trial request to the KBase auth server.",
+    )
+
+    auth_connection_limit = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_CONNECTION_LIMIT", "100")),
+        config=True,
+        help="Maximum number of pooled connections to the KBase auth server.",
+    )
+
+    auth_connection_limit_per_host = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_CONNECTION_LIMIT_PER_HOST", "20")),
+        config=True,
+        help="Maximum number of pooled connections per KBase auth server host.",
+    )
+
+    auth_dns_cache_ttl = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_DNS_CACHE_TTL_SECONDS", "300")),
+        config=True,
+        help="Seconds to cache DNS lookups of the KBase auth server.",
+    )
+
+    auth_refresh_age = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_REFRESH_AGE_SECONDS", "300")),
+        config=True,
+        help="""Seconds after which a user's KBase token is revalidated in the background.
+        0 disables revalidation.""",
+    )
+
+    auth_refresh_max_concurrency = Integer(
+        default_value=int(os.getenv("KBASE_AUTH_REFRESH_MAX_CONCURRENCY", "10")),
+        config=True,
+        help="Maximum number of background token revalidations to run at once.",
+    )
+
+    auth_refresh_max_jitter = Float(
+        default_value=float(os.getenv("KBASE_AUTH_REFRESH_MAX_JITTER_SECONDS", "30")),
+        config=True,
+        help="Maximum random delay, in seconds, before a background token revalidation starts.",
+    )
+
+    extra_handlers = List(
+        config=True,
+        help="Additional (url, handler) tuples to serve under the hub prefix, e.g. BERDL API endpoints.",
+    )
+
+    _token_cache = None
+    _kb_auth = None
+    _token_refresher = None
+
+    @property
+    def token_cache(self) -> TokenCache | None:
         """
-        Authenticate user using KBase session cookie and API validation
+        The token validation cache shared by all logins, or None if caching is disabled.
+        """
+        if self._token_cache is None and self.token_cache_ttl > 0:
+            self._token_cache = TokenCache(
+                max_size=self.token_cache_max_size,
+                ttl=self.token_cache_ttl,
+                negative_ttl=self.token_cache_negative_ttl,
+                stale_ttl=self.token_cache_stale_ttl,
+            )
+        return self._token_cache
 
+    @property
+    def kb_auth(self) -> KBaseAuth:
+        """
+        The KBase auth client shared by all logins.
+        Its connection pool is closed when the hub shuts down.
+        """
+        if self._kb_auth is None:
+            self._kb_auth = KBaseAuth(
+                self.kbase_auth_url,
+                self.auth_full_admin_roles,
+                cache=self.token_cache,
+                connection_limit=self.auth_connection_limit,
+                connection_limit_per_host=self.auth_connection_limit_per_host,
+                dns_cache_ttl=self.auth_dns_cache_ttl,
+                request_timeout=self.auth_request_timeout,
+                max_retries=self.auth_max_retries,
+                breaker=CircuitBreaker(
+                    failure_threshold=self.auth_breaker_failure_threshold,
+                    reset_timeout=self.auth_breaker_reset_timeout,
+                    on_state_change=AUTH_CIRCUIT_BREAKER_STATE.set,
+                ),
+            )
+            on_shutdown(self._kb_auth.close)
+        return self._kb_auth
+
+    @property
+    def token_refresher(self) -> TokenRefresher:
+        """
+        The scheduler for background token revalidation.
+        """
+        if self._token_refresher is None:
+            self._token_refresher = TokenRefresher(
+                lambda token: self.kb_auth.get_user(token, refresh=True),
+                max_concurrency=self.auth_refresh_max_concurrency,
+                max_jitter=self.auth_refresh_max_jitter,
+            )
+        return self._token_refresher
+
+    def get_handlers(self, app):
+        """
+        Register the login handler and any extra handlers.
+        """
+        return super().get_handlers(app) + list(self.extra_handlers)
+
+    async def authenticate(self, handler, data=None) -> dict:
+        """
+        Authenticate user using KBase session cookie and API validation.
+        The new KBase token is merged into the user's existing auth_state.
         """
         session_token = handler.get_cookie(self.SESSION_COOKIE_NAME)
 
@@ -51,26 +215,64 @@ class KBaseAuthenticator(Authenticator):
                 f"Authentication required - missing {self.SESSION_COOKIE_NAME} and {self.SESSION_COOKIE_BACKUP} cookie."
             )
 
-        kb_auth = KBaseAuth(self.kbase_auth_url, self.auth_full_admin_roles)
-        kb_user = await kb_auth.get_user(session_token)
+        kb_user = await self.kb_auth.get_user(session_token)
+        username = str(kb_user.user)
+
+        # The hub replaces the stored auth_state with the one returned here, so keep what was
+        # cached in it, e.g. MinIO credentials and the shape of the user's Spark cluster
+        user = handler.find_user(username)
+        auth_state = (await user.get_auth_state() if user else None) or {}
+        auth_state["kbase_token"] = session_token
 
         logger.info(f"Authenticated user: {kb_user.user}")
         return {
-            "name": str(kb_user.user),
+            "name": username,
             "admin": kb_user.admin_perm == AdminPermission.FULL,
-            "auth_state": {
-                "kbase_token": session_token,
-            },
+            "auth_state": auth_state,
         }
 
-    async def pre_spawn_start(self, user, spawner) -> None:
+    async def refresh_user(self, user, handler=None) -> bool:
         """
-        Pass KBase authentication token to spawner environment
+        Check the user's KBase token without waiting on the KBase auth server.
+
+        The answer is based on the last background revalidation of the token, and a new
+        revalidation is scheduled for the next check.
+        Returns False, forcing a new login, if the token is missing or was found to be invalid.
         """
         auth_state = await user.get_auth_state() or {}
         kbase_auth_token = auth_state.get("kbase_token")
 
         if not kbase_auth_token:
-            raise MissingTokenError("Missing KBase authentication token in auth state")
+            return False
+
+        if self.token_refresher.is_invalid(kbase_auth_token):
+            logger.info(f"KBase token for user {user.name} is no longer valid")
+            return False
+
+        self.token_refresher.schedule(kbase_auth_token)
+        return True
+
+    async def pre_spawn_start(self, user, spawner) -> None:
+        """
+        Load the spawn context, validate the KBase authentication token and pass it to the
+        spawner environment.
+        Fails the spawn before any pre-spawn hooks run if the token is invalid.
+        """
+        # Loads auth_state once for the whole spawn, the pre-spawn hooks reuse the context
+        context = await SpawnContext.load(spawner)
+        kbase_auth_token = context.kbase_token
+
+        try:
+            await self.kb_auth.get_user(kbase_auth_token)
+        except InvalidTokenError:
+            raise InvalidTokenError(
+                f"KBase token for user {user.name} has expired - please log in again."
+            )
+        except Exception:
+            # Don't block spawns on auth server trouble, the hooks will surface real failures
+            logger.warning(
+                f"Unable to validate KBase token for user {user.name} before spawn",
+                exc_info=True,
+            )
 
         spawner.environment["KBASE_AUTH_TOKEN"] = kbase_auth_token
@@ -0,0 +1,65 @@
+"""
+Coalescing of concurrent identical asynchronous calls.
+"""
+
+import asyncio
+from typing import Awaitable, Callable, Dict, Hashable, Optional, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Ensures that only one call per key is in flight at a time.
+
+    Callers that arrive while a call for the same key is running wait for that call instead of
+    starting their own, and receive its result or its exception.
+    """
+
+    def __init__(self, on_join: Optional[Callable[[], None]] = None):
+        """
+        Create the coalescer.
+        :param on_join: a function called whenever a call joins one already in flight.
+        """
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._deduplicated = 0
+        self._on_join = on_join
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run a call, or join a call for the same key that is already in flight.
+        :param key: the key identifying identical calls.
+        :param fn: a coroutine function that performs the call.
+        :returns: the result of the call.
+        """
+        task = self._inflight.get(key)
+        if task is not None:
+            self._deduplicated += 1
+            if self._on_join:
+                self._on_join()
+        else:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        # shield the shared call so that one cancelled waiter does not cancel it for the others
+        return await asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved in case every waiter was cancelled
+
+    @property
+    def deduplicated(self) -> int:
+        """
+        The number of calls that joined an in flight call rather than starting a new one.
+        """
+        return self._deduplicated
+
+    @property
+    def inflight(self) -> int:
+        """
+        The number of calls currently in flight.
+        """
+        return len(self._inflight)
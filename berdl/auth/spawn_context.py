@@ -0,0 +1,122 @@
+"""
+Per-spawn state shared by the authenticator and the spawner hooks.
+"""
+
+import asyncio
+import weakref
+from typing import Any
+
+from berdl.auth.kb_auth import MissingTokenError
+from berdl.metrics import AUTH_STATE_LOAD_DURATION_SECONDS, observe_duration
+
+# Keyed by spawner. Spawners are reused for each spawn of the same server, so the context is
+# replaced at the start of every spawn.
+_contexts: "weakref.WeakKeyDictionary[Any, SpawnContext]" = weakref.WeakKeyDictionary()
+
+# Keyed by user name. A lock lives while an update holds it.
+_auth_state_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = (
+    weakref.WeakValueDictionary()
+)
+
+
+async def update_auth_state(user: Any, changes: dict) -> dict | None:
+    """
+    Merge changes into the user's stored auth_state. Keys with a None value are removed.
+
+    The auth_state is read again under a per-user lock rather than taken from a SpawnContext,
+    so that concurrent updates of other keys, e.g. by the governance and Spark steps of the same
+    spawn, and a KBase token stored after the context was loaded are kept.
+    :param user: the user.
+    :param changes: the keys to set or remove.
+    :returns: the updated auth_state, or None if the user has no auth_state.
+    """
+    lock = _auth_state_locks.get(user.name)
+    if lock is None:
+        lock = _auth_state_locks[user.name] = asyncio.Lock()
+    async with lock:
+        auth_state = await user.get_auth_state()
+        if not auth_state:
+            return None
+        for key, value in changes.items():
+            if value is None:
+                auth_state.pop(key, None)
+            else:
+                auth_state[key] = value
+        await user.save_auth_state(auth_state)
+        return auth_state
+
+
+class SpawnContext:
+    """
+    The user's validated auth_state for a single spawn.
+
+    Loading auth_state means a database read and a decryption, so it is loaded once when the
+    spawn starts and then shared by every hook and utility that needs the user's credentials.
+    The context ends with the server: the post-stop hook loads the auth_state again, since the
+    user may have logged in with a new token since the spawn, and then discards the context.
+    """
+
+    def __init__(self, username: str, kbase_token: str, auth_state: dict):
+        """
+        Create the context.
+        :param username: the name of the user being spawned.
+        :param kbase_token: the user's KBase token.
+        :param auth_state: the user's decrypted auth_state, as loaded at the start of the
+            spawn. Changes are not persisted unless saved with `update_auth_state`.
+        """
+        self.username = username
+        self.kbase_token = kbase_token
+        self.auth_state = auth_state
+
+    @classmethod
+    async def load(cls, spawner: Any) -> "SpawnContext":
+        """
+        Load and validate the user's auth_state and attach a new context to the spawner,
+        replacing any previous context.
+        :param spawner: the spawner being started.
+        :returns: the context.
+        :raises MissingTokenError: if the auth_state or KBase token is missing.
+        """
+        with observe_duration(AUTH_STATE_LOAD_DURATION_SECONDS):
+            auth_state = await spawner.user.get_auth_state()
+        if not auth_state:
+            spawner.log.error(
+                "KBase auth_state not found for user %s.", spawner.user.name
+            )
+            raise MissingTokenError("KBase authentication state is missing.")
+
+        kbase_token = auth_state.get("kbase_token")
+        if not kbase_token:
+            spawner.log.error(
+                "KBase token not found in auth_state for user %s.", spawner.user.name
+            )
+            raise MissingTokenError(
+                "KBase authentication token is missing from auth_state."
+            )
+
+        context = cls(spawner.user.name, kbase_token, auth_state)
+        _contexts[spawner] = context
+        return context
+
+    @classmethod
+    async def get(cls, spawner: Any) -> "SpawnContext":
+        """
+        Get the context attached to the spawner, loading it if there is none, e.g. when the hub
+        restarted since the server was spawned.
+        :param spawner: the spawner.
+        :returns: the context.
+        :raises MissingTokenError: if the context must be loaded and the auth_state or KBase
+            token is missing.
+        """
+        context = _contexts.get(spawner)
+        if context is None:
+            context = await cls.load(spawner)
+        return context
+
+    @classmethod
+    def discard(cls, spawner: Any) -> None:
+        """
+        Remove the context attached to the spawner, if any.
+        :param spawner: the spawner.
+        """
+        _contexts.pop(spawner, None)
@@ -0,0 +1,184 @@
+"""
+An in memory cache for the results of KBase token validation.
+"""
+
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Callable, NamedTuple, Optional
+
+from berdl.auth.arg_checkers import not_falsy as _not_falsy
+from berdl.metrics import TOKEN_CACHE_EVICTIONS, TOKEN_CACHE_LOOKUPS, TokenCacheResult
+
+
+class CacheStats(NamedTuple):
+    """
+    Counters describing the behavior of a token cache.
+    """
+
+    hits: int
+    negative_hits: int
+    stale_hits: int
+    misses: int
+    evictions: int
+    size: int
+
+
+class _Entry(NamedTuple):
+    expires: float
+    value: Any  # a KBaseUser or an InvalidTokenError
+
+
+def hash_token(token: str) -> str:
+    """
+    Hash a token so that it can be used as a key without storing the raw token.
+    :param token: the token to hash.
+    :returns: the hex encoded SHA-256 digest of the token.
+    """
+    return hashlib.sha256(_not_falsy(token, "token").encode("utf-8")).hexdigest()
+
+
+class TokenCache:
+    """
+    A size bounded, TTL based LRU cache for token validation results.
+
+    Successful lookups are cached for `ttl` seconds. Invalid token errors are cached for
+    `negative_ttl` seconds so that clients retrying with a bad token do not hammer the auth
+    server. Tokens are never stored as keys; the SHA-256 hash of the token is used instead.
+
+    If `stale_ttl` is set, successful lookups are retained for that many seconds after they
+    expire and can be retrieved with :meth:`get_stale`, so that a recently validated token can
+    still be honored while the auth server is unavailable.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 10000,
+        ttl: float = 300,
+        negative_ttl: float = 30,
+        stale_ttl: float = 0,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Create the cache.
+        :param max_size: the maximum number of entries in the cache.
+        :param ttl: the number of seconds to cache a successful lookup.
+        :param negative_ttl: the number of seconds to cache an invalid token result.
+            0 disables negative caching.
+        :param stale_ttl: the number of seconds past expiry a successful lookup may still be
+            retrieved with :meth:`get_stale`. 0 disables stale lookups.
+        :param timer: a function returning the current time in seconds.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be > 0")
+        if ttl < 0 or negative_ttl < 0 or stale_ttl < 0:
+            raise ValueError("ttl, negative_ttl and stale_ttl must be >= 0")
+        self._max_size = max_size
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._stale_ttl = stale_ttl
+        self._timer = timer
+        self._cache: OrderedDict[str, _Entry] = OrderedDict()
+        self._hits = 0
+        self._negative_hits = 0
+        self._stale_hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, token: str) -> Optional[Any]:
+        """
+        Get a cached validation result.
+        :param token: the token to look up.
+        :returns: the cached user, the cached invalid token error, or None if there is no
+            unexpired entry for the token.
+        """
+        key = hash_token(token)
+        entry = self._cache.get(key)
+        if entry is None or entry.expires <= self._timer():
+            if entry is not None and not self._within_stale_window(entry):
+                del self._cache[key]
+            self._misses += 1
+            TOKEN_CACHE_LOOKUPS.labels(result=TokenCacheResult.miss).inc()
+            return None
+        self._cache.move_to_end(key)
+        if isinstance(entry.value, Exception):
+            self._negative_hits += 1
+            TOKEN_CACHE_LOOKUPS.labels(result=TokenCacheResult.negative_hit).inc()
+        else:
+            self._hits += 1
+            TOKEN_CACHE_LOOKUPS.labels(result=TokenCacheResult.hit).inc()
+        return entry.value
+
+    def get_stale(self, token: str) -> Optional[Any]:
+        """
+        Get a successful validation result that may have expired, but is still within the
+        stale window.
+        :param token: the token to look up.
+        :returns: the cached user, or None if there is no such entry for the token.
+        """
+        entry = self._cache.get(hash_token(token))
+        if entry is None or not self._within_stale_window(entry):
+            return None
+        self._stale_hits += 1
+        TOKEN_CACHE_LOOKUPS.labels(result=TokenCacheResult.stale).inc()
+        return entry.value
+
+    def put(self, token: str, user: Any) -> None:
+        """
+        Cache a successful validation result.
+        :param token: the token that was validated.
+        :param user: the user the token resolved to.
+        """
+        self._put(token, user, self._ttl)
+
+    def put_invalid(self, token: str, error: Exception) -> None:
+        """
+        Cache an invalid token result.
+        :param token: the token that was rejected.
+        :param error: the error to raise for subsequent lookups of the token.
+        """
+        self._put(token, error, self._negative_ttl)
+
+    def invalidate(self, token: str) -> None:
+        """
+        Remove any cached result for a token.
+        :param token: the token to remove.
+        """
+        self._cache.pop(hash_token(token), None)
+
+    def clear(self) -> None:
+        """
+        Remove all entries from the cache.
+        """
+        self._cache.clear()
+
+    @property
+    def stats(self) -> CacheStats:
+        """
+        The cache counters.
+        """
+        return CacheStats(
+            self._hits,
+            self._negative_hits,
+            self._stale_hits,
+            self._misses,
+            self._evictions,
+            len(self._cache),
+        )
+
+    def _within_stale_window(self, entry: _Entry) -> bool:
+        return (
+            not isinstance(entry.value, Exception)
+            and self._timer() < entry.expires + self._stale_ttl
+        )
+
+    def _put(self, token: str, value: Any, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        key = hash_token(token)
+        self._cache[key] = _Entry(self._timer() + ttl, value)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+            self._evictions += 1
+            TOKEN_CACHE_EVICTIONS.inc()
@@ -0,0 +1,102 @@
+"""
+Background revalidation of KBase tokens held in users' auth_state.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from berdl.auth.kb_auth import InvalidTokenError
+from berdl.auth.token_cache import hash_token
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRefresher:
+    """
+    Revalidates tokens against the auth server in the background.
+
+    Each revalidation starts after a random delay and at most `max_concurrency` revalidations
+    run at once, so that a large number of users whose auth info goes stale at the same time
+    are spread out over the jitter window rather than hitting the auth server together.
+    The outcome is recorded so that later checks can be answered without waiting on the
+    auth server.
+    """
+
+    def __init__(
+        self,
+        validate: Callable[[str], Awaitable[Any]],
+        max_concurrency: int = 10,
+        max_jitter: float = 30,
+        max_entries: int = 10000,
+        timer: Callable[[], float] = time.monotonic,
+    ):
+        """
+        Create the refresher.
+        :param validate: a coroutine function that validates a token against the auth server,
+            raising InvalidTokenError if the token is invalid.
+        :param max_concurrency: the maximum number of revalidations to run at once.
+        :param max_jitter: the maximum number of seconds to delay a revalidation.
+        :param max_entries: the maximum number of token outcomes to remember.
+        :param timer: a function returning the current time in seconds.
+        """
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be > 0")
+        if max_jitter < 0:
+            raise ValueError("max_jitter must be >= 0")
+        self._validate = validate
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_jitter = max_jitter
+        self._max_entries = max_entries
+        self._timer = timer
+        self._pending: Dict[str, asyncio.Task] = {}
+        # token hash -> (time of the last revalidation, whether the token was valid)
+        self._outcomes: OrderedDict[str, tuple[float, bool]] = OrderedDict()
+
+    def schedule(self, token: str) -> None:
+        """
+        Schedule a background revalidation of a token, unless one is already pending.
+        :param token: the token to revalidate.
+        """
+        key = hash_token(token)
+        if key in self._pending:
+            return
+        task = asyncio.ensure_future(self._revalidate(key, token))
+        self._pending[key] = task
+        task.add_done_callback(lambda _: self._pending.pop(key, None))
+
+    def is_invalid(self, token: str) -> bool:
+        """
+        Check whether the last revalidation of a token found it to be invalid.
+        :param token: the token to check.
+        :returns: True if the token is known to be invalid.
+        """
+        outcome = self._outcomes.get(hash_token(token))
+        return outcome is not None and not outcome[1]
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of scheduled or running revalidations.
+        """
+        return len(self._pending)
+
+    async def _revalidate(self, key: str, token: str) -> None:
+        await asyncio.sleep(random.uniform(0, self._max_jitter))
+        async with self._semaphore:
+            try:
+                await self._validate(token)
+                valid = True
+            except InvalidTokenError:
+                valid = False
+            except Exception:
+                # The auth server may be down; keep the previous outcome and try again later
+                logger.warning("Failed to revalidate KBase token", exc_info=True)
+                return
+        self._outcomes[key] = (self._timer(), valid)
+        self._outcomes.move_to_end(key)
+        while len(self._outcomes) > self._max_entries:
+            self._outcomes.popitem(last=False)
@@ -0,0 +1,65 @@
+"""
+A shared Kubernetes API client for the hub's own use, e.g. pre-pulling images and placing
+notebooks on nodes. KubeSpawner keeps its own client for the user pods.
+"""
+
+import asyncio
+import os
+from typing import Any
+
+from kubernetes_asyncio import client as k8s
+from kubernetes_asyncio import config as k8s_config
+
+from berdl.lifecycle import on_shutdown
+
+_SERVICE_ACCOUNT_NAMESPACE = "/var/run/secrets/kubernetes.io/serviceaccount/namespace"
+
+_api_client: Any = None
+_lock: asyncio.Lock | None = None
+
+
+def hub_namespace() -> str:
+    """
+    Get the namespace the hub runs in, as KubeSpawner determines it.
+    """
+    if os.environ.get("POD_NAMESPACE"):
+        return os.environ["POD_NAMESPACE"]
+    if os.path.exists(_SERVICE_ACCOUNT_NAMESPACE):
+        with open(_SERVICE_ACCOUNT_NAMESPACE) as f:
+            return f.read().strip()
+    return "default"
+
+
+async def _get_api_client() -> Any:
+    """
+    Get the ApiClient shared by the hub's API objects, for the cluster the hub runs in, or the
+    cluster of the local kube config. The client is closed when the hub shuts down.
+    """
+    global _api_client, _lock
+    if _api_client is None:
+        _lock = _lock or asyncio.Lock()
+        async with _lock:
+            if _api_client is None:
+                try:
+                    k8s_config.load_incluster_config()
+                except k8s_config.ConfigException:
+                    await k8s_config.load_kube_config()
+                api_client = k8s.ApiClient()
+                on_shutdown(api_client.close)
+                _api_client = api_client
+    return _api_client
+
+
+async def core_v1_api() -> Any:
+    """
+    Get a CoreV1Api for the cluster the hub runs in, or the cluster of the local kube config.
+    The client is closed when the hub shuts down.
+    """
+    return k8s.CoreV1Api(await _get_api_client())
+
+
+async def networking_v1_api() -> Any:
+    """
+    Get a NetworkingV1Api for the same cluster as `core_v1_api`.
+    """
+    return k8s.NetworkingV1Api(await _get_api_client())
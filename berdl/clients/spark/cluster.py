@@ -1,9 +1,14 @@
 """
 CDM Spark Cluster Manager API Client Wrapper
+
+The async functions are for use inside the hub's event loop. They share a single connection pool
+across users, and must not be mixed with the sync functions, which are intended for scripts.
 """
 
 import os
+from typing import NamedTuple
 
+import httpx
 from spark_manager_client import AuthenticatedClient, Client
 from spark_manager_client.api.clusters import (
     create_cluster_clusters_post,
@@ -18,6 +23,7 @@ from spark_manager_client.types import Response
 
 # So this is not part of the client, but it depends on outside code
 from berdl.auth.arg_checkers import not_falsy
+from berdl.lifecycle import on_shutdown
 
 DEFAULT_WORKER_COUNT = int(os.environ.get("DEFAULT_WORKER_COUNT", 2))
 DEFAULT_WORKER_CORES = int(os.environ.get("DEFAULT_WORKER_CORES", 1))
@@ -26,6 +32,37 @@ DEFAULT_MASTER_CORES = int(os.environ.get("DEFAULT_MASTER_CORES", 1))
 DEFAULT_MASTER_MEMORY = os.environ.get("DEFAULT_MASTER_MEMORY", "10GiB")
 
 
+class ClusterShape(NamedTuple):
+    """
+    The resources of a Spark cluster. Pass to the create functions with `**shape._asdict()`.
+    """
+
+    worker_count: int = DEFAULT_WORKER_COUNT
+    worker_cores: int = DEFAULT_WORKER_CORES
+    worker_memory: str = DEFAULT_WORKER_MEMORY
+    master_cores: int = DEFAULT_MASTER_CORES
+    master_memory: str = DEFAULT_MASTER_MEMORY
+
+
+DEFAULT_CLUSTER_SHAPE = ClusterShape()
+
+# The shape of the user's current cluster, stored as a list in the user's auth_state since the
+# cluster manager does not report it
+AUTH_STATE_SHAPE_KEY = "spark_cluster_shape"
+# The time, in seconds since the epoch, until which the user's cluster is held by the hub's warm
+# pool for a spawn that has not started yet. Stored in the user's auth_state so that the orphan
+# reaper, a separate process, does not delete it.
+AUTH_STATE_WARM_UNTIL_KEY = "spark_warm_until"
+
+# Connection pool and deadlines for the async client
+MAX_CONNECTIONS = int(os.environ.get("SPARK_CLUSTER_MANAGER_MAX_CONNECTIONS", 20))
+CONNECT_TIMEOUT = float(os.environ.get("SPARK_CLUSTER_MANAGER_CONNECT_TIMEOUT", 10))
+# Cluster creation waits on Kubernetes, so allow plenty of time for a response
+READ_TIMEOUT = float(os.environ.get("SPARK_CLUSTER_MANAGER_READ_TIMEOUT", 300))
+
+_async_transport: httpx.AsyncHTTPTransport | None = None
+
+
 def _get_client() -> Client:
     """
     Get an unauthenticated client for the Spark Cluster Manager API.
@@ -48,6 +85,54 @@ def _get_authenticated_client(
     return AuthenticatedClient(base_url=str(api_url), token=str(kbase_auth_token))
 
 
+def _get_async_transport() -> httpx.AsyncHTTPTransport:
+    """
+    Get the connection pool shared by all async clients, creating it if necessary.
+    The pool is closed when the hub shuts down.
+    """
+    global _async_transport
+    if _async_transport is None:
+        _async_transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=MAX_CONNECTIONS,
+                max_keepalive_connections=MAX_CONNECTIONS,
+            )
+        )
+        on_shutdown(close_async_transport)
+    return _async_transport
+
+
+async def close_async_transport() -> None:
+    """
+    Close the connection pool shared by the async clients.
+    """
+    global _async_transport
+    if _async_transport is not None:
+        transport, _async_transport = _async_transport, None
+        await transport.aclose()
+
+
+def _get_async_authenticated_client(
+    kbase_auth_token: str | None = None,
+) -> AuthenticatedClient:
+    """
+    Get an authenticated client for the Spark Cluster Manager API that uses the shared
+    connection pool.
+    """
+    client = _get_authenticated_client(kbase_auth_token)
+    # The httpx client only holds the user's auth header; connections live in the shared
+    # transport, so the httpx client must not be closed.
+    client.set_async_httpx_client(
+        httpx.AsyncClient(
+            base_url=os.environ["SPARK_CLUSTER_MANAGER_API_URL"],
+            headers={client.auth_header_name: f"{client.prefix} {client.token}"},
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+            transport=_get_async_transport(),
+        )
+    )
+    return client
+
+
 def _raise_api_error(response: Response) -> None:
     """
     Process the API error response and raise an error.
@@ -104,6 +189,36 @@ def create_cluster(
     _raise_api_error(response)
 
 
+async def create_cluster_async(
+    kbase_auth_token: str | None = None,
+    worker_count: int = DEFAULT_WORKER_COUNT,
+    worker_cores: int = DEFAULT_WORKER_CORES,
+    worker_memory: str = DEFAULT_WORKER_MEMORY,
+    master_cores: int = DEFAULT_MASTER_CORES,
+    master_memory: str = DEFAULT_MASTER_MEMORY,
+) -> SparkClusterCreateResponse | None:
+    """
+    Create a new Spark cluster with the given configuration without blocking the event loop.
+    See :func:`create_cluster` for the arguments.
+    """
+    client = _get_async_authenticated_client(kbase_auth_token)
+    config = SparkClusterConfig(
+        worker_count=worker_count,
+        worker_cores=worker_cores,
+        worker_memory=worker_memory,
+        master_cores=master_cores,
+        master_memory=master_memory,
+    )
+    response: Response[SparkClusterCreateResponse] = (
+        await create_cluster_clusters_post.asyncio_detailed(client=client, body=config)
+    )
+
+    if response.status_code == 201 and response.parsed:
+        return response.parsed
+
+    _raise_api_error(response)
+
+
 def delete_cluster(kbase_auth_token: str | None = None) -> ClusterDeleteResponse | None:
     """
     Delete the user's Spark cluster.
@@ -118,3 +233,44 @@ def delete_cluster(kbase_auth_token: str | None = None) -> ClusterDeleteResponse
         return response.parsed
 
     _raise_api_error(response)
+
+
+async def delete_cluster_async(
+    kbase_auth_token: str | None = None,
+) -> ClusterDeleteResponse | None:
+    """
+    Delete the user's Spark cluster without blocking the event loop.
+    Returns None if the user has no cluster, so that a retried delete succeeds.
+    """
+    client = _get_async_authenticated_client(kbase_auth_token)
+    response: Response[ClusterDeleteResponse] = (
+        await delete_cluster_clusters_delete.asyncio_detailed(client=client)
+    )
+
+    if response.status_code == 200 and response.parsed:
+        return response.parsed
+    if response.status_code == 404:
+        return None
+
+    _raise_api_error(response)
+
+
+async def get_cluster_status_async(
+    kbase_auth_token: str | None = None,
+) -> dict | None:
+    """
+    Get the status of the user's Spark cluster without blocking the event loop.
+    Returns None if the user has no cluster.
+
+    The request is made directly against the API, using the shared connection pool, so that
+    it does not depend on a generated function for the status endpoint.
+    """
+    client = _get_async_authenticated_client(kbase_auth_token)
+    response = await client.get_async_httpx_client().get("/clusters")
+
+    if response.status_code == 404:
+        return None
+    if response.status_code == 200:
+        return response.json()
+
+    _raise_api_error(response)
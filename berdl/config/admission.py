@@ -0,0 +1,245 @@
+"""
+Admission control for spawns and the downstream services they call.
+
+A burst of spawns, e.g. a class starting at the same time, would otherwise send every request to
+the governance API and the Spark cluster manager at once. Each AdmissionController admits a
+limited number of callers at a time and queues the rest. The queue is fair across users: waiting
+users are served in turn, in order of arrival, so a user with several pending requests cannot
+delay everyone else.
+
+The limit of a downstream controller adapts to the downstream service: it grows slowly while
+requests succeed within the latency target, and shrinks quickly when requests fail or are slow
+(additive increase, multiplicative decrease).
+"""
+
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Hashable, Optional
+
+from berdl.metrics import (
+    ADMISSION_IN_FLIGHT,
+    ADMISSION_LIMIT,
+    ADMISSION_QUEUE_LENGTH,
+    ADMISSION_WAIT_DURATION_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+QUEUE_TIMEOUT = float(os.environ.get("BERDL_ADMISSION_QUEUE_TIMEOUT_SECONDS", 600))
+
+
+class AdmissionTimeoutError(asyncio.TimeoutError):
+    """
+    An error thrown when a caller waits in the admission queue for too long.
+    """
+
+
+class _Waiter:
+    def __init__(self, on_position: Optional[Callable[[int], None]]):
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.position: int | None = None
+
+
+class AdmissionController:
+    """
+    Limits the number of concurrent callers, queueing the rest fairly across keys, e.g. users.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        max_limit: int | None = None,
+        min_limit: int = 1,
+        latency_target: float | None = None,
+        queue_timeout: float | None = QUEUE_TIMEOUT,
+        backoff: float = 0.7,
+        cooldown: float = 5,
+    ):
+        """
+        Create the controller.
+        :param name: the name of the controller, for metrics and messages.
+        :param limit: the initial number of concurrent callers.
+        :param max_limit: the maximum the limit may grow to. Defaults to `limit`, which, with
+            no latency target, keeps the limit fixed unless calls fail.
+        :param min_limit: the minimum the limit may shrink to.
+        :param latency_target: calls slower than this many seconds shrink the limit. None only
+            shrinks the limit on failures.
+        :param queue_timeout: the maximum number of seconds to wait in the queue. None waits
+            forever.
+        :param backoff: the factor the limit is multiplied by when it shrinks.
+        :param cooldown: the minimum number of seconds between shrinks, so that one burst of
+            slow calls shrinks the limit once.
+        """
+        self.name = name
+        self._limit = float(limit)
+        self._max_limit = float(max_limit or limit)
+        self._min_limit = float(min_limit)
+        self._latency_target = latency_target
+        self._queue_timeout = queue_timeout
+        self._backoff = backoff
+        self._cooldown = cooldown
+        self._last_shrink = 0.0
+        self._in_flight = 0
+        # key -> that key's waiters; the order of the keys is the order they are served in
+        self._queues: "OrderedDict[Hashable, Deque[_Waiter]]" = OrderedDict()
+        ADMISSION_LIMIT.labels(controller=name).set(self._limit)
+
+    @property
+    def limit(self) -> int:
+        """
+        The current number of concurrent callers admitted.
+        """
+        return max(1, int(self._limit))
+
+    @property
+    def queued(self) -> int:
+        """
+        The number of callers waiting.
+        """
+        return sum(len(q) for q in self._queues.values())
+
+    @asynccontextmanager
+    async def slot(
+        self, key: Hashable, on_position: Optional[Callable[[int], None]] = None
+    ):
+        """
+        Wait for a slot, then run the enclosed block. The duration and outcome of the block
+        adapt the limit.
+        :param key: the key the queue is fair across, e.g. the user name.
+        :param on_position: called with the caller's 1-based position in the queue whenever it
+            changes, while the caller waits.
+        :raises AdmissionTimeoutError: if no slot is available within the queue timeout.
+        """
+        await self._acquire(key, on_position)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self._adapt(time.perf_counter() - start, failed=True)
+            raise
+        else:
+            self._adapt(time.perf_counter() - start, failed=False)
+        finally:
+            self._in_flight -= 1
+            self._dispatch()
+
+    async def _acquire(
+        self, key: Hashable, on_position: Optional[Callable[[int], None]]
+    ) -> None:
+        start = time.perf_counter()
+        if self._in_flight < self.limit and not self._queues:
+            self._in_flight += 1
+            self._observe_wait(start)
+            return
+        waiter = _Waiter(on_position)
+        self._queues.setdefault(key, deque()).append(waiter)
+        self._update_positions()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self._queue_timeout)
+        except BaseException as e:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # admitted just as the wait ended, give the slot to the next caller
+                self._in_flight -= 1
+                self._dispatch()
+            else:
+                waiter.future.cancel()
+                self._remove(key, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise AdmissionTimeoutError(
+                    f"Timed out after {self._queue_timeout:g} seconds waiting for {self.name}"
+                ) from e
+            raise
+        self._observe_wait(start)
+
+    def _remove(self, key: Hashable, waiter: _Waiter) -> None:
+        queue = self._queues.get(key)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del self._queues[key]
+        self._update_positions()
+
+    def _dispatch(self) -> None:
+        while self._in_flight < self.limit and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(key)  # the key waits for its next turn
+            else:
+                del self._queues[key]
+            if waiter.future.done():
+                continue
+            self._in_flight += 1
+            waiter.future.set_result(None)
+        self._update_positions()
+
+    def _update_positions(self) -> None:
+        # Simulate the order waiters will be served in: a round over the keys in order, taking
+        # the next waiter of each key, repeated until every waiter is placed
+        queues = [list(q) for q in self._queues.values()]
+        position = 0
+        for turn in range(max((len(q) for q in queues), default=0)):
+            for queue in queues:
+                if turn < len(queue):
+                    position += 1
+                    waiter = queue[turn]
+                    if waiter.position != position:
+                        waiter.position = position
+                        if waiter.on_position:
+                            waiter.on_position(position)
+        ADMISSION_QUEUE_LENGTH.labels(controller=self.name).set(position)
+        ADMISSION_IN_FLIGHT.labels(controller=self.name).set(self._in_flight)
+
+    def _adapt(self, latency: float, failed: bool) -> None:
+        slow = self._latency_target is not None and latency > self._latency_target
+        now = time.monotonic()
+        if failed or slow:
+            if now - self._last_shrink < self._cooldown:
+                return
+            self._last_shrink = now
+            limit = max(self._min_limit, self._limit * self._backoff)
+            if int(limit) < int(self._limit):
+                logger.warning(
+                    "Lowering %s admission limit to %s after a %s call",
+                    self.name,
+                    int(limit),
+                    "failed" if failed else "slow",
+                )
+        else:
+            limit = min(self._max_limit, self._limit + 1 / self._limit)
+        self._limit = limit
+        ADMISSION_LIMIT.labels(controller=self.name).set(self._limit)
+
+    def _observe_wait(self, start: float) -> None:
+        ADMISSION_WAIT_DURATION_SECONDS.labels(controller=self.name).observe(
+            time.perf_counter() - start
+        )
+
+
+# Spawns running the pre-spawn hook at once. Fixed, the downstream controllers adapt.
+_max_spawns = int(os.environ.get("BERDL_ADMISSION_MAX_SPAWNS", 20))
+spawn_admission = AdmissionController("spawns", _max_spawns, min_limit=_max_spawns)
+
+governance_admission = AdmissionController(
+    "governance",
+    int(os.environ.get("BERDL_ADMISSION_GOVERNANCE_LIMIT", 10)),
+    max_limit=int(os.environ.get("BERDL_ADMISSION_GOVERNANCE_MAX_LIMIT", 20)),
+    latency_target=float(
+        os.environ.get("BERDL_ADMISSION_GOVERNANCE_LATENCY_TARGET_SECONDS", 5)
+    ),
+)
+
+spark_admission = AdmissionController(
+    "spark-cluster-manager",
+    int(os.environ.get("BERDL_ADMISSION_SPARK_LIMIT", 5)),
+    max_limit=int(os.environ.get("BERDL_ADMISSION_SPARK_MAX_LIMIT", 10)),
+    latency_target=float(
+        os.environ.get("BERDL_ADMISSION_SPARK_LATENCY_TARGET_SECONDS", 90)
+    ),
+)
@@ -0,0 +1,165 @@
+"""
+BERDL specific REST API endpoints served by the hub.
+
+The handlers are registered by the authenticator (see `KBaseAuthenticator.extra_handlers`), so
+they are served under the hub prefix, e.g. `/hub/api/berdl/...`, and use the hub's own
+authentication and scopes.
+"""
+
+import json
+
+import httpx
+from jupyterhub.apihandlers.base import APIHandler
+from jupyterhub.scopes import needs_scope
+from tornado import web
+
+from berdl.auth.kb_auth import MissingTokenError
+from berdl.auth.spawn_context import SpawnContext
+from berdl.clients.spark import cluster
+from berdl.config.governance_utils import GovernanceUtils
+from berdl.config.profiles import InvalidSparkShapeError, spark_shape
+from berdl.config.spark_readiness import is_cluster_ready
+from berdl.config.spark_utils import SparkClusterManager
+
+# Scope required to manage a user's Spark cluster. Granted to users for themselves and to their
+# notebook servers' tokens in jupyterhub_config.py.
+SPARK_CLUSTER_SCOPE = "custom:berdl:spark"
+# Scope required to invalidate a user's cached MinIO credentials. Granted the same way, so that
+# the notebook, which sees MinIO reject the credentials, can invalidate them.
+MINIO_CREDENTIALS_SCOPE = "custom:berdl:minio-credentials"
+
+
+class MinioCredentialsAPIHandler(APIHandler):
+    """
+    Manage a user's cached MinIO credentials.
+
+    DELETE invalidates the cached credentials, e.g. when MinIO rejected them.
+    POST forces new credentials to be fetched from the governance API. Admin only.
+    A running notebook keeps its old credentials until it is restarted.
+    """
+
+    def _get_user(self, user_name):
+        user = self.find_user(user_name)
+        if not user:
+            raise web.HTTPError(404, f"No such user: {user_name}")
+        return user
+
+    @needs_scope(MINIO_CREDENTIALS_SCOPE)
+    async def delete(self, user_name):
+        user = self._get_user(user_name)
+        await GovernanceUtils.invalidate_credentials(user)
+        self.log.info("Invalidated cached MinIO credentials for user %s", user_name)
+        self.set_status(204)
+
+    @needs_scope("admin:users")
+    async def post(self, user_name):
+        user = self._get_user(user_name)
+        try:
+            await GovernanceUtils.refresh_credentials(user)
+        except MissingTokenError:
+            raise web.HTTPError(
+                409, f"User {user_name} must log in before credentials can be fetched"
+            )
+        except httpx.HTTPError as e:
+            raise web.HTTPError(502, f"Failed to fetch credentials: {e}")
+        self.log.info("Refreshed cached MinIO credentials for user %s", user_name)
+        # never return the credentials themselves
+        self.write(json.dumps({"user": user_name, "refreshed": True}))
+
+
+class SparkClusterAPIHandler(APIHandler):
+    """
+    Manage the Spark cluster of a user's default server.
+
+    GET returns the status of the cluster from the cluster manager, with a "ready" field that
+    is true once the master and all workers are running.
+    POST returns the master URL of the cluster, creating the cluster if necessary. Servers
+    spawned with lazy Spark provisioning call this the first time they need Spark. A body of
+    {"worker_count": n} instead scales the existing cluster to n workers, at most the number the
+    server was spawned with; the idle scaler service uses this to remove the workers of idle
+    notebooks.
+    The cluster is deleted when the server stops.
+    """
+
+    def _get_active_spawner(self, user_name):
+        user = self.find_user(user_name)
+        if not user:
+            raise web.HTTPError(404, f"No such user: {user_name}")
+        spawner = user.spawners.get("")
+        if not spawner or not spawner.active:
+            raise web.HTTPError(
+                409, f"User {user_name} must have a running server to use Spark"
+            )
+        return spawner
+
+    @needs_scope(SPARK_CLUSTER_SCOPE)
+    async def get(self, user_name):
+        spawner = self._get_active_spawner(user_name)
+        try:
+            token = (await SpawnContext.get(spawner)).kbase_token
+            status = await cluster.get_cluster_status_async(kbase_auth_token=token)
+        except MissingTokenError:
+            raise web.HTTPError(
+                409, f"User {user_name} must log in before Spark can be used"
+            )
+        except (httpx.HTTPError, ValueError) as e:
+            raise web.HTTPError(502, f"Failed to get Spark cluster status: {e}")
+        if status is None:
+            raise web.HTTPError(404, f"User {user_name} has no Spark cluster")
+        try:
+            worker_count = spark_shape(spawner).worker_count
+        except InvalidSparkShapeError as e:
+            raise web.HTTPError(400, str(e))
+        self.write(
+            json.dumps({**status, "ready": is_cluster_ready(status, worker_count)})
+        )
+
+    def _get_worker_count(self, spawner):
+        body = self.get_json_body() or {}
+        worker_count = body.get("worker_count")
+        if worker_count is None:
+            return None
+        try:
+            max_count = spark_shape(spawner).worker_count
+        except InvalidSparkShapeError as e:
+            raise web.HTTPError(400, str(e))
+        if (
+            not isinstance(worker_count, int)
+            or isinstance(worker_count, bool)
+            or not 0 <= worker_count <= max_count
+        ):
+            raise web.HTTPError(
+                400, f"worker_count must be an integer from 0 to {max_count}"
+            )
+        return worker_count
+
+    @needs_scope(SPARK_CLUSTER_SCOPE)
+    async def post(self, user_name):
+        spawner = self._get_active_spawner(user_name)
+        worker_count = self._get_worker_count(spawner)
+        try:
+            if worker_count is None:
+                master_url = await SparkClusterManager.ensure_spark_cluster(spawner)
+            else:
+                master_url = await SparkClusterManager.scale_spark_cluster(
+                    spawner, worker_count
+                )
+        except MissingTokenError:
+            raise web.HTTPError(
+                409, f"User {user_name} must log in before Spark can be used"
+            )
+        except InvalidSparkShapeError as e:
+            raise web.HTTPError(400, str(e))
+        except Exception as e:
+            raise web.HTTPError(502, f"Failed to provision Spark cluster: {e}")
+        if master_url is None:
+            raise web.HTTPError(
+                409, f"User {user_name} must have a running server to use Spark"
+            )
+        self.write(json.dumps({"user": user_name, "master_url": master_url}))
+
+
+default_handlers = [
+    (r"/api/berdl/users/([^/]+)/minio-credentials", MinioCredentialsAPIHandler),
+    (r"/api/berdl/users/([^/]+)/spark-cluster", SparkClusterAPIHandler),
+]
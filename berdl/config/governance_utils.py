@@ -1,12 +1,33 @@
+import asyncio
+import importlib.util
+import logging
 import os
+import random
+import time
 import httpx
 from typing import Any
 
+from berdl.auth.kb_auth import MissingTokenError
+from berdl.auth.spawn_context import SpawnContext, update_auth_state
+from berdl.auth.token_cache import hash_token
+from berdl.config.admission import governance_admission
+from berdl.config.prefetch import CREDENTIALS, login_prefetch
+from berdl.lifecycle import on_shutdown
+from berdl.metrics import (
+    GOVERNANCE_CREDENTIALS_CACHE_LOOKUPS,
+    GOVERNANCE_CREDENTIALS_DURATION_SECONDS,
+    CredentialsCacheResult,
+    observe_duration,
+    profile_label,
+)
+
 
 class GovernanceUtils:
     """
     A utility class to manage MinIO credentials for a JupyterHub spawner.
-    # TODO MOVE AUTH TO A SHARED UTILS MODULE, or in a prior step in the spawner pre-spawn hooks.
+
+    Credentials fetched from the governance API are cached in the user's auth_state, which
+    JupyterHub encrypts at rest, so that respawns within the cache TTL skip the governance API.
     """
 
     # --- Configuration Constants to be read from the Hub's environment ---
@@ -21,39 +42,180 @@ class GovernanceUtils:
     MINIO_SECURE = "MINIO_SECURE"
     MINIO_CONFIG_ERROR = "MINIO_CONFIG_ERROR"
 
+    # --- Credential cache, stored in the user's auth_state ---
+    CREDENTIALS_CACHE_TTL = float(
+        os.environ.get("GOVERNANCE_CREDENTIALS_CACHE_TTL_SECONDS", 3600)
+    )
+    AUTH_STATE_CREDENTIALS_KEY = "minio_credentials"
+
+    # --- HTTP client settings for the governance API ---
+    HTTP2 = os.environ.get("GOVERNANCE_HTTP2", "false").lower() == "true"
+    CONNECT_TIMEOUT = float(os.environ.get("GOVERNANCE_CONNECT_TIMEOUT_SECONDS", 5))
+    READ_TIMEOUT = float(os.environ.get("GOVERNANCE_READ_TIMEOUT_SECONDS", 10))
+    MAX_CONNECTIONS = int(os.environ.get("GOVERNANCE_MAX_CONNECTIONS", 20))
+    MAX_RETRIES = int(os.environ.get("GOVERNANCE_MAX_RETRIES", 2))
+    RETRY_BACKOFF = float(os.environ.get("GOVERNANCE_RETRY_BACKOFF_SECONDS", 0.5))
+    # Responses worth retrying; anything else is returned to the caller immediately
+    RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+    _client: httpx.AsyncClient | None = None
+
     @staticmethod
-    async def _get_kbase_auth_token(spawner: Any) -> str:
-        """Helper method to retrieve the KBase auth token."""
-        auth_state = await spawner.user.get_auth_state()
-        if not auth_state:
-            spawner.log.error(
-                "KBase auth_state not found for user %s.", spawner.user.name
+    def _get_client() -> httpx.AsyncClient:
+        """
+        Get the pooled client shared by all spawns, creating it if necessary.
+        The client is closed when the hub shuts down.
+        """
+        if GovernanceUtils._client is None:
+            http2 = GovernanceUtils.HTTP2
+            if http2 and importlib.util.find_spec("h2") is None:
+                logging.getLogger(__name__).warning(
+                    "GOVERNANCE_HTTP2 is set but the h2 package is not installed, using HTTP/1.1"
+                )
+                http2 = False
+            GovernanceUtils._client = httpx.AsyncClient(
+                http2=http2,
+                timeout=httpx.Timeout(
+                    GovernanceUtils.READ_TIMEOUT,
+                    connect=GovernanceUtils.CONNECT_TIMEOUT,
+                ),
+                limits=httpx.Limits(
+                    max_connections=GovernanceUtils.MAX_CONNECTIONS,
+                    max_keepalive_connections=GovernanceUtils.MAX_CONNECTIONS,
+                ),
             )
-            raise RuntimeError("KBase authentication state is missing.")
+            on_shutdown(GovernanceUtils.close_client)
+        return GovernanceUtils._client
 
-        kbase_token = auth_state.get("kbase_token")
-        if not kbase_token:
-            spawner.log.error(
-                "KBase token not found in auth_state for user %s.", spawner.user.name
+    @staticmethod
+    async def close_client() -> None:
+        """Close the pooled client."""
+        client, GovernanceUtils._client = GovernanceUtils._client, None
+        if client is not None:
+            await client.aclose()
+
+    @staticmethod
+    async def _get_with_retries(url: str, headers: dict) -> httpx.Response:
+        """
+        GET a URL, retrying transport errors and retryable statuses with jittered exponential
+        backoff.
+        """
+        client = GovernanceUtils._get_client()
+        attempt = 0
+        while True:
+            try:
+                response = await client.get(url, headers=headers)
+                if (
+                    response.status_code not in GovernanceUtils.RETRY_STATUS_CODES
+                    or attempt >= GovernanceUtils.MAX_RETRIES
+                ):
+                    return response
+            except httpx.TransportError:
+                if attempt >= GovernanceUtils.MAX_RETRIES:
+                    raise
+            attempt += 1
+            await asyncio.sleep(
+                random.uniform(0, GovernanceUtils.RETRY_BACKOFF * 2 ** (attempt - 1))
             )
-            raise RuntimeError("KBase authentication token is missing from auth_state.")
 
-        return kbase_token
+    @staticmethod
+    async def _fetch_credentials(token: str, profile: str = "default") -> dict:
+        """Fetch the user's MinIO credentials from the governance API."""
+        gov_url = os.environ[GovernanceUtils.GOVERNANCE_API_URL_ENV]
+        headers = {"Authorization": f"Bearer {token}"}
+        async with governance_admission.slot(hash_token(token)):
+            with observe_duration(
+                GOVERNANCE_CREDENTIALS_DURATION_SECONDS, profile=profile
+            ):
+                response = await GovernanceUtils._get_with_retries(
+                    f"{gov_url}/credentials/", headers
+                )
+                response.raise_for_status()
+                return response.json()
+
+    @staticmethod
+    def _get_cached_credentials(auth_state: dict) -> dict | None:
+        """Get unexpired cached credentials from auth_state, if any."""
+        cached = auth_state.get(GovernanceUtils.AUTH_STATE_CREDENTIALS_KEY)
+        if (
+            cached
+            and time.time() - cached.get("fetched_at", 0)
+            < GovernanceUtils.CREDENTIALS_CACHE_TTL
+        ):
+            GOVERNANCE_CREDENTIALS_CACHE_LOOKUPS.labels(
+                result=CredentialsCacheResult.hit
+            ).inc()
+            return cached
+        GOVERNANCE_CREDENTIALS_CACHE_LOOKUPS.labels(
+            result=CredentialsCacheResult.miss
+        ).inc()
+        return None
+
+    @staticmethod
+    async def _cache_credentials(user: Any, auth_state: dict, credentials: dict) -> None:
+        """
+        Store credentials in the user's auth_state, and in the given copy of it, e.g. the
+        spawn's context.
+        """
+        if GovernanceUtils.CREDENTIALS_CACHE_TTL <= 0:
+            return
+        cached = {
+            "access_key": credentials["access_key"],
+            "secret_key": credentials["secret_key"],
+            "fetched_at": time.time(),
+        }
+        auth_state[GovernanceUtils.AUTH_STATE_CREDENTIALS_KEY] = cached
+        await update_auth_state(
+            user, {GovernanceUtils.AUTH_STATE_CREDENTIALS_KEY: cached}
+        )
+
+    @staticmethod
+    async def invalidate_credentials(user: Any) -> None:
+        """
+        Remove the user's cached credentials, e.g. because MinIO rejected them.
+        The next spawn fetches new credentials from the governance API.
+        """
+        await update_auth_state(user, {GovernanceUtils.AUTH_STATE_CREDENTIALS_KEY: None})
+
+    @staticmethod
+    async def refresh_credentials(user: Any) -> dict:
+        """
+        Fetch new credentials for the user from the governance API and cache them, regardless
+        of whether the cached credentials have expired.
+        :returns: the new credentials.
+        :raises MissingTokenError: if the user has no KBase token.
+        """
+        auth_state = await user.get_auth_state()
+        token = auth_state.get("kbase_token") if auth_state else None
+        if not token:
+            raise MissingTokenError(
+                "KBase authentication token is missing from auth_state."
+            )
+        credentials = await GovernanceUtils._fetch_credentials(token)
+        await GovernanceUtils._cache_credentials(user, auth_state, credentials)
+        return credentials
 
     @staticmethod
     async def set_governance_credentials(spawner: Any) -> None:
         """Main method to fetch credentials and mutate and update the spawner's environment."""
         try:
-            gov_url = os.environ[GovernanceUtils.GOVERNANCE_API_URL_ENV]
             minio_endpoint_url = os.environ[GovernanceUtils.MINIO_ENDPOINT_URL_ENV]
 
-            token = await GovernanceUtils._get_kbase_auth_token(spawner)
-            headers = {"Authorization": f"Bearer {token}"}
-
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{gov_url}/credentials/", headers=headers)
-                response.raise_for_status()
-                credentials = response.json()
+            context = await SpawnContext.get(spawner)
+            credentials = GovernanceUtils._get_cached_credentials(context.auth_state)
+            if credentials:
+                spawner.log.info(
+                    "Using cached MinIO credentials for user %s.", spawner.user.name
+                )
+            else:
+                credentials = await login_prefetch.take(
+                    CREDENTIALS, spawner.user.name, context.kbase_token
+                ) or await GovernanceUtils._fetch_credentials(
+                    context.kbase_token, profile_label(spawner)
+                )
+                await GovernanceUtils._cache_credentials(
+                    spawner.user, context.auth_state, credentials
+                )
 
             spawner.environment[GovernanceUtils.MINIO_ACCESS_KEY] = credentials[
                 "access_key"
@@ -70,18 +232,22 @@ class GovernanceUtils:
                 "Successfully set MinIO credentials for user %s.", spawner.user.name
             )
 
-        except (httpx.RequestError, RuntimeError) as e:
+        except (httpx.HTTPError, MissingTokenError) as e:
             # --- Graceful Failure Path (for API/auth errors ONLY) ---
             spawner.log.error(
                 "Failed to get governance credentials for user %s. Notebook will start with empty credentials.",
                 spawner.user.name,
                 exc_info=True,  # This will print the full exception traceback.
             )
+            GovernanceUtils.set_empty_credentials(spawner)
 
-            spawner.environment[GovernanceUtils.MINIO_ACCESS_KEY] = ""
-            spawner.environment[GovernanceUtils.MINIO_SECRET_KEY] = ""
-            spawner.environment[GovernanceUtils.MINIO_ENDPOINT] = ""
-            spawner.environment[GovernanceUtils.MINIO_SECURE] = "False"
-            spawner.environment[GovernanceUtils.MINIO_CONFIG_ERROR] = (
-                "Failed to retrieve MinIO credentials. Please contact an administrator."
-            )
+    @staticmethod
+    def set_empty_credentials(spawner: Any) -> None:
+        """Set empty MinIO credentials and an error message in the spawner's environment."""
+        spawner.environment[GovernanceUtils.MINIO_ACCESS_KEY] = ""
+        spawner.environment[GovernanceUtils.MINIO_SECRET_KEY] = ""
+        spawner.environment[GovernanceUtils.MINIO_ENDPOINT] = ""
+        spawner.environment[GovernanceUtils.MINIO_SECURE] = "False"
+        spawner.environment[GovernanceUtils.MINIO_CONFIG_ERROR] = (
+            "Failed to retrieve MinIO credentials. Please contact an administrator."
+        )
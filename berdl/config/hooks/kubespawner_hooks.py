@@ -1,87 +1,233 @@
+import asyncio
+import os
+import time
+
+from berdl.auth.spawn_context import SpawnContext
 from berdl.config.spark_utils import SparkClusterManager
+from berdl.config.admission import spawn_admission
 from berdl.config.governance_utils import GovernanceUtils
-from kubernetes import client
+from berdl.config.hooks.pipeline import HookPipeline, SpawnStep, StepStatus
+from berdl.config.images import image_pins
+from berdl.config.placement import HOME_MIGRATION_TIMEOUT, node_placement
+from berdl.config.pod_template import pod_templates
+from berdl.config.progress import SpawnProgress, publish
+from berdl.metrics import (
+    HOOK_STEP_DURATION_SECONDS,
+    HOOK_STEP_FAILURES,
+    MODIFY_POD_HOOK_DURATION_SECONDS,
+    PRE_SPAWN_HOOK_DURATION_SECONDS,
+    PreSpawnStatus,
+    observe_duration,
+    profile_label,
+)
+
+# Per-step deadlines for the pre-spawn hook
+GOVERNANCE_STEP_TIMEOUT = float(
+    os.environ.get("BERDL_GOVERNANCE_STEP_TIMEOUT_SECONDS", 30)
+)
+SPARK_STEP_TIMEOUT = float(os.environ.get("BERDL_SPARK_STEP_TIMEOUT_SECONDS", 300))
+# Placement may copy the user's home to another node
+PLACEMENT_STEP_TIMEOUT = float(
+    os.environ.get("BERDL_PLACEMENT_STEP_TIMEOUT_SECONDS", HOME_MIGRATION_TIMEOUT + 60)
+)
+
+# Steps run before the user's server starts. Steps without dependencies run concurrently, so
+# adding an independent integration does not add its latency to every spawn.
+PRE_SPAWN_PIPELINE = HookPipeline("pre-spawn")
+PRE_SPAWN_PIPELINE.add_step(
+    SpawnStep(
+        "governance",
+        GovernanceUtils.set_governance_credentials,
+        timeout=GOVERNANCE_STEP_TIMEOUT,
+        # The notebook starts with empty credentials and an error message instead
+        critical=False,
+        on_failure=lambda spawner, e: GovernanceUtils.set_empty_credentials(spawner),
+        description="Fetching MinIO credentials",
+    )
+)
+PRE_SPAWN_PIPELINE.add_step(
+    SpawnStep(
+        "spark",
+        SparkClusterManager.start_spark_cluster,
+        timeout=SPARK_STEP_TIMEOUT,
+        critical=True,
+        description="Setting up Spark cluster",
+    )
+)
+# Placement may copy the user's home for an hour without calling the services spawn admission
+# protects, so it runs alongside the admitted steps rather than holding a slot
+PLACEMENT_PIPELINE = HookPipeline("placement")
+if node_placement.enabled:
+    PLACEMENT_PIPELINE.add_step(
+        SpawnStep(
+            "placement",
+            node_placement.place,
+            # retries of a failed Kubernetes request must not extend a copy's deadline
+            deadline=PLACEMENT_STEP_TIMEOUT,
+            retries=2,
+            # A notebook on a node without the user's home would show an empty home
+            critical=True,
+            description="Choosing a node for your server",
+        )
+    )
+
+# Steps run after the user's server stops. Failures are logged and never block the stop.
+POST_STOP_PIPELINE = HookPipeline("post-stop")
+POST_STOP_PIPELINE.add_step(
+    SpawnStep(
+        "spark",
+        SparkClusterManager.stop_spark_cluster,
+        timeout=SPARK_STEP_TIMEOUT,
+        critical=False,
+    )
+)
+
+
+def _step_metrics_listener(pipeline):
+    def listener(spawner, result):
+        if result.status == StepStatus.skipped:
+            return
+        profile = profile_label(spawner)
+        HOOK_STEP_DURATION_SECONDS.labels(
+            pipeline=pipeline.name,
+            step=result.name,
+            status=result.status,
+            profile=profile,
+        ).observe(result.duration)
+        if result.status != StepStatus.success:
+            HOOK_STEP_FAILURES.labels(
+                pipeline=pipeline.name, step=result.name, profile=profile
+            ).inc()
+
+    return listener
+
+
+def _progress_start_listener(spawner, step, attempt):
+    retry = f" (attempt {attempt})" if attempt > 1 else ""
+    publish(
+        spawner,
+        f"{step.description}{retry}",
+        phase=step.name,
+        phase_status="started",
+    )
+
+
+def _pre_spawn_steps():
+    return PRE_SPAWN_PIPELINE.steps + PLACEMENT_PIPELINE.steps
+
+
+def _failed_step(results):
+    """
+    Name the step that failed a spawn or left it degraded, for the pre-spawn duration metric.
+    A failed critical step is preferred over a failed non critical one. Steps skipped because a
+    dependency failed are not named, since the dependency is.
+    """
+    failed = [
+        s
+        for s in _pre_spawn_steps()
+        if s.name in results
+        and results[s.name].status in (StepStatus.failure, StepStatus.timeout)
+    ]
+    return next(
+        (s.name for s in failed if s.critical), failed[0].name if failed else ""
+    )
+
+
+def _progress_listener(spawner, result):
+    step = next(s for s in _pre_spawn_steps() if s.name == result.name)
+    if result.status == StepStatus.success:
+        message = f"{step.description}: done in {result.duration:.1f}s"
+    elif result.status == StepStatus.skipped:
+        message = f"{step.description}: skipped"
+    else:
+        reason = str(result.error) or type(result.error).__name__
+        message = (
+            f"{step.description}: {result.status} after {result.duration:.1f}s: "
+            f"{reason[:200]}"
+        )
+        if not step.critical:
+            message += ", continuing without it"
+    publish(
+        spawner,
+        message,
+        phase=result.name,
+        phase_status=str(result.status),
+        duration=round(result.duration, 3),
+    )
+
+
+for _pipeline in (PRE_SPAWN_PIPELINE, PLACEMENT_PIPELINE):
+    _pipeline.add_listener(_step_metrics_listener(_pipeline))
+    # Users see each pre-spawn phase in the spawn progress bar, merged with the pod events
+    _pipeline.add_start_listener(_progress_start_listener)
+    _pipeline.add_listener(_progress_listener)
+POST_STOP_PIPELINE.add_listener(_step_metrics_listener(POST_STOP_PIPELINE))
 
 
 async def pre_spawn_hook(spawner):
     """
-    Hook to create a Spark cluster before the user's server starts.
-    # TODO MOVE AUTH TO A SHARED UTILS MODULE, or in a prior step in the spawner pre-spawn hooks.
-    # TODO TRY CATCH?
+    Hook to set MinIO credentials, create a Spark cluster and choose a node before the user's
+    server starts. See PRE_SPAWN_PIPELINE and PLACEMENT_PIPELINE for the steps.
     """
     spawner.log.info("Pre-spawn hook called for user %s", spawner.user.name)
-    await GovernanceUtils.set_governance_credentials(spawner)
-    await SparkClusterManager.start_spark_cluster(spawner)
+    progress = SpawnProgress.reset(spawner)
+    results = {}
+    status = PreSpawnStatus.failure
+    start = time.perf_counter()
+
+    async def admitted():
+        # limit the spawns calling the downstream services at once, see admission.py
+        async with spawn_admission.slot(
+            spawner.user.name,
+            on_position=lambda p: progress.publish(
+                f"The hub is busy, your server is number {p} in the queue"
+            ),
+        ):
+            await PRE_SPAWN_PIPELINE.run(spawner, results)
+
+    tasks = [asyncio.ensure_future(admitted())]
+    if PLACEMENT_PIPELINE.steps:
+        tasks.append(asyncio.ensure_future(PLACEMENT_PIPELINE.run(spawner, results)))
+    try:
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            # a critical failure of either fails the spawn, so stop the other
+            if not all(t.done() for t in tasks):
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        for task in done:
+            task.result()
+        degraded = any(r.status != StepStatus.success for r in results.values())
+        status = PreSpawnStatus.degraded if degraded else PreSpawnStatus.success
+    finally:
+        PRE_SPAWN_HOOK_DURATION_SECONDS.labels(
+            status=status,
+            profile=profile_label(spawner),
+            failed_step=_failed_step(results),
+        ).observe(time.perf_counter() - start)
 
 
 async def post_stop_hook(spawner):
     """
     Hook to delete the Spark cluster after the user's server stops.
+    See POST_STOP_PIPELINE for the steps.
     """
     spawner.log.info("Post-stop hook called for user %s", spawner.user.name)
-    await SparkClusterManager.stop_spark_cluster(spawner)
+    try:
+        await POST_STOP_PIPELINE.run(spawner)
+    finally:
+        SpawnContext.discard(spawner)
 
 
 def modify_pod_hook(spawner, pod):
-
-    pod.spec.containers[0].env.append(
-        client.V1EnvVar(
-            "BERDL_POD_IP",
-            None,
-            client.V1EnvVarSource(
-                field_ref=client.V1ObjectFieldSelector(field_path="status.podIP")
-            ),
-        )
-    )
-    pod.spec.containers[0].env.append(
-        client.V1EnvVar(
-            "BERDL_POD_NAME",
-            None,
-            client.V1EnvVarSource(
-                field_ref=client.V1ObjectFieldSelector(field_path="metadata.name")
-            ),
-        )
-    )
-    pod.spec.containers[0].env.append(
-        client.V1EnvVar(
-            "BERDL_CPU_REQUEST",
-            None,
-            client.V1EnvVarSource(
-                resource_field_ref=client.V1ResourceFieldSelector(
-                    resource="requests.cpu"
-                )
-            ),
-        )
-    )
-    pod.spec.containers[0].env.append(
-        client.V1EnvVar(
-            "BERDL_CPU_LIMIT",
-            None,
-            client.V1EnvVarSource(
-                resource_field_ref=client.V1ResourceFieldSelector(resource="limits.cpu")
-            ),
-        )
-    )
-    pod.spec.containers[0].env.append(
-        client.V1EnvVar(
-            "BERDL_MEMORY_REQUEST",
-            None,
-            client.V1EnvVarSource(
-                resource_field_ref=client.V1ResourceFieldSelector(
-                    resource="requests.memory"
-                )
-            ),
-        )
-    )
-    pod.spec.containers[0].env.append(
-        client.V1EnvVar(
-            "BERDL_MEMORY_LIMIT",
-            None,
-            client.V1EnvVarSource(
-                resource_field_ref=client.V1ResourceFieldSelector(
-                    resource="limits.memory"
-                )
-            ),
-        )
-    )
-    return pod
+    """
+    Hook to apply the pod template of the user's profile, e.g. the BERDL environment
+    variables, to the user's pod, and pin its images to digests. See pod_template.py and
+    images.py.
+    """
+    with observe_duration(
+        MODIFY_POD_HOOK_DURATION_SECONDS, profile=profile_label(spawner)
+    ):
+        return image_pins.pin(pod_templates.get(spawner).apply(pod))
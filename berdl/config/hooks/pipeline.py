@@ -0,0 +1,297 @@
+"""
+A small engine for running spawner hook steps as a dependency graph.
+
+Each step declares the steps it depends on and starts as soon as they have succeeded, so
+independent steps run concurrently. Steps have their own timeout, retry policy and criticality:
+a failed critical step fails the whole hook, while a failed non critical step only skips the
+steps that depend on it.
+"""
+
+import asyncio
+import time
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+
+class StepStatus(Enum):
+    """
+    The outcome of a step.
+    """
+
+    success = "success"
+    failure = "failure"
+    timeout = "timeout"
+    skipped = "skipped"  # a dependency did not succeed
+
+    def __str__(self):
+        return self.value
+
+
+class StepResult(NamedTuple):
+    """
+    The outcome and timing of a step.
+    """
+
+    name: str
+    status: StepStatus
+    duration: float
+    attempts: int
+    error: Optional[BaseException] = None
+
+
+class SpawnStep:
+    """
+    A single step in a hook pipeline.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[Any], Awaitable[None]],
+        depends_on: Iterable[str] = (),
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        retries: int = 0,
+        retry_delay: float = 1,
+        critical: bool = True,
+        on_failure: Optional[Callable[[Any, BaseException], None]] = None,
+        description: Optional[str] = None,
+    ):
+        """
+        Create the step.
+        :param name: the unique name of the step.
+        :param run: a coroutine function that takes the spawner and performs the step.
+        :param depends_on: the names of the steps that must succeed before this step runs.
+        :param timeout: the deadline, in seconds, for each attempt. None for no deadline.
+        :param deadline: the deadline, in seconds, for all attempts together, including the
+            delays between them. No retry starts after it. None for no deadline.
+        :param retries: the number of times to retry the step after a failed attempt.
+        :param retry_delay: the number of seconds to wait before the first retry. The delay
+            doubles for each subsequent retry.
+        :param critical: True if a failure of this step should fail the hook.
+        :param on_failure: a function called with the spawner and the error when the step
+            fails, for example to put the spawner into a degraded state.
+        :param description: a short description of the step for users, e.g. in spawn progress
+            messages. Defaults to the name.
+        """
+        if retries < 0:
+            raise ValueError("retries must be >= 0")
+        self.name = name
+        self.run = run
+        self.depends_on = tuple(depends_on)
+        self.timeout = timeout
+        self.deadline = deadline
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.critical = critical
+        self.on_failure = on_failure
+        self.description = description or name
+
+
+class HookPipeline:
+    """
+    A set of spawn steps and their dependencies.
+    """
+
+    def __init__(self, name: str):
+        """
+        Create the pipeline.
+        :param name: the name of the pipeline, used in log messages.
+        """
+        self.name = name
+        self._steps: Dict[str, SpawnStep] = {}
+        self._listeners: List[Callable[[Any, StepResult], None]] = []
+        self._start_listeners: List[Callable[[Any, SpawnStep, int], None]] = []
+
+    def add_listener(self, listener: Callable[[Any, StepResult], None]) -> None:
+        """
+        Add a function to be called with the spawner and the result whenever a step finishes.
+        :param listener: the function to call. Errors it raises are logged and ignored.
+        """
+        self._listeners.append(listener)
+
+    def add_start_listener(self, listener: Callable[[Any, SpawnStep, int], None]) -> None:
+        """
+        Add a function to be called with the spawner, the step and the attempt number, starting
+        at 1, whenever an attempt of a step starts.
+        :param listener: the function to call. Errors it raises are logged and ignored.
+        """
+        self._start_listeners.append(listener)
+
+    def add_step(self, step: SpawnStep) -> SpawnStep:
+        """
+        Add a step to the pipeline. A step's dependencies must be added before the step, which
+        guarantees that the graph has no cycles.
+        :param step: the step to add.
+        :returns: the step.
+        """
+        if step.name in self._steps:
+            raise ValueError(f"Step {step.name} is already in pipeline {self.name}")
+        for dep in step.depends_on:
+            if dep not in self._steps:
+                raise ValueError(
+                    f"Step {step.name} depends on unknown step {dep} in pipeline {self.name}"
+                )
+        self._steps[step.name] = step
+        return step
+
+    @property
+    def steps(self) -> List[SpawnStep]:
+        """
+        The steps in the order they were added.
+        """
+        return list(self._steps.values())
+
+    async def run(
+        self, spawner: Any, results: Optional[Dict[str, StepResult]] = None
+    ) -> Dict[str, StepResult]:
+        """
+        Run the pipeline for a spawner.
+        :param spawner: the spawner passed to each step.
+        :param results: a dict to fill with the result of each step as it finishes. Useful to
+            find out which step failed if the pipeline raises.
+        :returns: the result of each step, keyed by step name.
+        :raises: the error from the first critical step that fails. Any steps still running
+            are cancelled.
+        """
+        results = {} if results is None else results
+        tasks: Dict[str, asyncio.Task] = {}
+        if not self._steps:
+            return results
+        for step in self._steps.values():
+            tasks[step.name] = asyncio.ensure_future(
+                self._run_step(step, spawner, tasks, results)
+            )
+        try:
+            done, pending = await asyncio.wait(
+                tasks.values(), return_when=asyncio.FIRST_EXCEPTION
+            )
+            failed = [t for t in done if not t.cancelled() and t.exception()]
+            if failed:
+                for t in pending:
+                    t.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+                raise failed[0].exception()
+        except asyncio.CancelledError:
+            for t in tasks.values():
+                t.cancel()
+            raise
+        spawner.log.info(
+            "%s pipeline for user %s: %s",
+            self.name,
+            spawner.user.name,
+            ", ".join(
+                f"{r.name}={r.status} ({r.duration:.2f}s)" for r in results.values()
+            ),
+        )
+        return results
+
+    async def _run_step(
+        self,
+        step: SpawnStep,
+        spawner: Any,
+        tasks: Dict[str, asyncio.Task],
+        results: Dict[str, StepResult],
+    ) -> bool:
+        for dep in step.depends_on:
+            try:
+                ok = await tasks[dep]
+            except Exception:
+                ok = False
+            if not ok:
+                spawner.log.warning(
+                    "Skipping %s step %s for user %s: dependency %s did not succeed",
+                    self.name,
+                    step.name,
+                    spawner.user.name,
+                    dep,
+                )
+                self._record(
+                    spawner, results, StepResult(step.name, StepStatus.skipped, 0, 0)
+                )
+                return False
+
+        start = time.perf_counter()
+        attempt = 0
+        while True:
+            attempt += 1
+            self._notify_start(spawner, step, attempt)
+            timeout = step.timeout
+            if step.deadline is not None:
+                remaining = step.deadline - (time.perf_counter() - start)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            try:
+                await asyncio.wait_for(step.run(spawner), timeout)
+                self._record(
+                    spawner,
+                    results,
+                    StepResult(
+                        step.name,
+                        StepStatus.success,
+                        time.perf_counter() - start,
+                        attempt,
+                    ),
+                )
+                return True
+            except Exception as e:
+                delay = step.retry_delay * 2 ** (attempt - 1)
+                if attempt <= step.retries and (
+                    step.deadline is None
+                    or time.perf_counter() - start + delay < step.deadline
+                ):
+                    spawner.log.warning(
+                        "%s step %s failed for user %s, retrying in %ss: %s",
+                        self.name,
+                        step.name,
+                        spawner.user.name,
+                        delay,
+                        e,
+                    )
+                    await asyncio.sleep(delay)
+                    continue
+                status = (
+                    StepStatus.timeout
+                    if isinstance(e, asyncio.TimeoutError)
+                    else StepStatus.failure
+                )
+                self._record(
+                    spawner,
+                    results,
+                    StepResult(
+                        step.name, status, time.perf_counter() - start, attempt, e
+                    ),
+                )
+                spawner.log.error(
+                    "%s step %s failed for user %s after %s attempt(s)",
+                    self.name,
+                    step.name,
+                    spawner.user.name,
+                    attempt,
+                    exc_info=True,
+                )
+                if step.on_failure:
+                    step.on_failure(spawner, e)
+                if step.critical:
+                    raise
+                return False
+
+    def _notify_start(self, spawner: Any, step: SpawnStep, attempt: int) -> None:
+        for listener in self._start_listeners:
+            try:
+                listener(spawner, step, attempt)
+            except Exception:
+                spawner.log.exception(
+                    "Error in %s pipeline start listener for step %s", self.name, step.name
+                )
+
+    def _record(
+        self, spawner: Any, results: Dict[str, StepResult], result: StepResult
+    ) -> None:
+        results[result.name] = result
+        for listener in self._listeners:
+            try:
+                listener(spawner, result)
+            except Exception:
+                spawner.log.exception(
+                    "Error in %s pipeline listener for step %s", self.name, result.name
+                )
@@ -0,0 +1,386 @@
+"""
+Pins the images of the hub's profiles to digests, so spawns do not check the registry.
+
+Profiles name images by mutable tags, e.g. ghcr.io/bio-boris/berdl_notebook:main, and so must be
+pulled with the Always policy to pick up new builds, which makes every spawn ask the registry
+for the tag, and a spawn after a new build wait for the whole image.
+
+Instead, the hub resolves each tag to the digest of its current manifest when it starts, and
+again every BERDL_IMAGE_REFRESH_SECONDS. When a tag moves to a new digest, the new image is
+first pulled onto the notebook nodes by short-lived pods, and only then used for new spawns.
+`ImagePins.pin` rewrites the images of a pod to the pinned digests and sets their pull policy
+to IfNotPresent. Images that could not be resolved keep their tag and the configured policy.
+
+Only registries that allow anonymous pulls are supported.
+"""
+
+import asyncio
+import copy
+import hashlib
+import logging
+import os
+import re
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, NamedTuple
+
+import httpx
+from kubernetes_asyncio import client as k8s
+
+from berdl.clients.kube import core_v1_api, hub_namespace
+from berdl.lifecycle import on_shutdown
+from berdl.metrics import (
+    IMAGE_PREPULL_DURATION_SECONDS,
+    IMAGE_RESOLVE_DURATION_SECONDS,
+    observe_duration,
+)
+
+logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL = float(os.environ.get("BERDL_IMAGE_REFRESH_SECONDS", 600))
+PREPULL_TIMEOUT = float(os.environ.get("BERDL_IMAGE_PREPULL_TIMEOUT_SECONDS", 1800))
+
+DOCKER_HUB = "docker.io"
+_DOCKER_HUB_API = "registry-1.docker.io"
+
+# Manifest lists and OCI indexes first, so multi-arch images resolve to the digest the
+# container runtime resolves the tag to
+_MANIFEST_TYPES = ", ".join(
+    [
+        "application/vnd.oci.image.index.v1+json",
+        "application/vnd.docker.distribution.manifest.list.v2+json",
+        "application/vnd.oci.image.manifest.v1+json",
+        "application/vnd.docker.distribution.manifest.v2+json",
+    ]
+)
+_CHALLENGE_PARAM = re.compile(r'(\w+)="([^"]*)"')
+
+
+class ImageReference(NamedTuple):
+    """
+    A parsed image name, e.g. ghcr.io/bio-boris/berdl_notebook:main.
+    """
+
+    image: str  # the image as written
+    registry: str
+    repository: str
+    tag: str
+    digest: str | None
+
+    def pinned(self, digest: str) -> str:
+        """
+        Get the image as written, with the tag replaced by a digest.
+        """
+        name = self.image.split("@")[0]
+        if name.rsplit("/", 1)[-1].count(":"):
+            name = name.rsplit(":", 1)[0]
+        return f"{name}@{digest}"
+
+
+def parse_image(image: str) -> ImageReference:
+    """
+    Parse an image name. Images without a registry are on Docker Hub, and images without a tag
+    or digest are tagged latest.
+    """
+    name, _, digest = image.partition("@")
+    first, _, rest = name.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        registry, path = first, rest
+    else:
+        registry, path = DOCKER_HUB, name
+    repository, _, tag = path.rpartition(":") if ":" in path else (path, "", "")
+    if registry == DOCKER_HUB and "/" not in repository:
+        repository = f"library/{repository}"
+    return ImageReference(image, registry, repository, tag or "latest", digest or None)
+
+
+class RegistryClient:
+    """
+    Resolves image tags to digests with the registry HTTP API.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        """
+        Create the client.
+        :param transport: the transport for registry requests, e.g. httpx.MockTransport for a
+            stub registry.
+        """
+        self._http = httpx.AsyncClient(
+            transport=transport, timeout=30, follow_redirects=True
+        )
+
+    async def close(self) -> None:
+        await self._http.aclose()
+
+    @staticmethod
+    def _base_url(ref: ImageReference) -> str:
+        host = _DOCKER_HUB_API if ref.registry == DOCKER_HUB else ref.registry
+        # a local registry, e.g. a stub, is usually served without TLS
+        scheme = "http" if host.split(":")[0] in ("localhost", "127.0.0.1") else "https"
+        return f"{scheme}://{host}/v2/{ref.repository}"
+
+    async def _token(self, challenge: str, ref: ImageReference) -> str:
+        """Get an anonymous pull token for a Bearer challenge."""
+        scheme, _, params = challenge.partition(" ")
+        params = dict(_CHALLENGE_PARAM.findall(params))
+        if scheme.lower() != "bearer" or "realm" not in params:
+            raise ValueError(f"Unsupported registry authentication for {ref.image}")
+        response = await self._http.get(
+            params["realm"],
+            params={
+                "service": params.get("service", ""),
+                "scope": params.get("scope", f"repository:{ref.repository}:pull"),
+            },
+        )
+        response.raise_for_status()
+        body = response.json()
+        return body.get("token") or body["access_token"]
+
+    async def resolve(self, image: str) -> str:
+        """
+        Get the digest the image's tag currently points to.
+        :returns: the digest, e.g. sha256:...
+        :raises httpx.HTTPError: if the registry request fails.
+        :raises ValueError: if the registry's response has no digest.
+        """
+        ref = parse_image(image)
+        if ref.digest:
+            return ref.digest
+        url = f"{self._base_url(ref)}/manifests/{ref.tag}"
+        headers = {"Accept": _MANIFEST_TYPES}
+        with observe_duration(IMAGE_RESOLVE_DURATION_SECONDS):
+            response = await self._http.head(url, headers=headers)
+            if response.status_code == 401:
+                challenge = response.headers.get("www-authenticate", "")
+                token = await self._token(challenge, ref)
+                headers["Authorization"] = f"Bearer {token}"
+                response = await self._http.head(url, headers=headers)
+            response.raise_for_status()
+            digest = response.headers.get("docker-content-digest")
+            if not digest:
+                # some registries only send the digest with the manifest itself
+                response = await self._http.get(url, headers=headers)
+                response.raise_for_status()
+                digest = response.headers.get("docker-content-digest")
+                if not digest:
+                    digest = f"sha256:{hashlib.sha256(response.content).hexdigest()}"
+        return digest
+
+
+class ImagePrePuller:
+    """
+    Pulls images onto nodes with pods that exit immediately.
+    """
+
+    def __init__(
+        self,
+        api: Any = None,
+        namespace: str | None = None,
+        timeout: float = PREPULL_TIMEOUT,
+        poll_interval: float = 5,
+    ):
+        """
+        Create the pre-puller.
+        :param api: a kubernetes_asyncio CoreV1Api, or a fake. Defaults to a client for the
+            cluster the hub runs in.
+        :param namespace: the namespace of the pre-pull pods. Defaults to the hub's.
+        :param timeout: the maximum number of seconds to wait for a pull.
+        :param poll_interval: the number of seconds between checks of a pre-pull pod.
+        """
+        self._api = api
+        self._namespace = namespace or hub_namespace()
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+
+    async def pull(self, image: str, nodes: Iterable[str]) -> None:
+        """
+        Pull an image onto nodes.
+        :param nodes: the nodes' kubernetes.io/hostname labels, which need not be their names,
+            as the notebooks' node selectors name them.
+        :raises RuntimeError: if the image could not be pulled onto a node.
+        :raises asyncio.TimeoutError: if a pull does not finish within the timeout.
+        """
+        await asyncio.gather(*(self._pull(image, node) for node in nodes))
+
+    async def _pull(self, image: str, node: str) -> None:
+        api = self._api or await core_v1_api()
+        suffix = hashlib.sha256(f"{image} {node}".encode()).hexdigest()[:12]
+        name = f"berdl-prepull-{suffix}"
+        pod = {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "metadata": {
+                "name": name,
+                "labels": {"app": "berdl-prepull"},
+            },
+            "spec": {
+                # scheduled by label, like the notebooks; a hostname need not be a node name
+                "nodeSelector": {"kubernetes.io/hostname": node},
+                "restartPolicy": "Never",
+                "tolerations": [{"operator": "Exists"}],
+                "containers": [
+                    {
+                        "name": "prepull",
+                        "image": image,
+                        "imagePullPolicy": "IfNotPresent",
+                        "command": ["true"],
+                        "resources": {"requests": {"cpu": "1m", "memory": "8Mi"}},
+                    }
+                ],
+            },
+        }
+        with observe_duration(IMAGE_PREPULL_DURATION_SECONDS):
+            try:
+                await api.create_namespaced_pod(self._namespace, pod)
+            except k8s.ApiException as e:
+                if e.status != 409:  # left over from a pull the hub did not finish
+                    raise
+            try:
+                await asyncio.wait_for(self._wait(api, name, image, node), self._timeout)
+            finally:
+                try:
+                    await api.delete_namespaced_pod(name, self._namespace)
+                except k8s.ApiException as e:
+                    if e.status != 404:
+                        logger.warning("Failed to delete pre-pull pod %s: %s", name, e)
+
+    async def _wait(self, api: Any, name: str, image: str, node: str) -> None:
+        while True:
+            pod = await api.read_namespaced_pod(name, self._namespace)
+            if pod.status.phase in ("Succeeded", "Failed"):
+                # the image was pulled, even if the container could not run `true`
+                return
+            for status in pod.status.container_statuses or []:
+                waiting = status.state and status.state.waiting
+                if waiting and waiting.reason in (
+                    "ErrImagePull",
+                    "ImagePullBackOff",
+                    "InvalidImageName",
+                ):
+                    raise RuntimeError(
+                        f"Failed to pull {image} onto node {node}: {waiting.reason}"
+                    )
+                if status.state and (status.state.running or status.state.terminated):
+                    return
+            await asyncio.sleep(self._poll_interval)
+
+
+class ImagePins:
+    """
+    The digests the hub's images are pinned to, refreshed in the background.
+    """
+
+    def __init__(
+        self,
+        registry: RegistryClient | None = None,
+        prepuller: ImagePrePuller | None = None,
+        refresh_interval: float = REFRESH_INTERVAL,
+    ):
+        """
+        Create the pins.
+        :param registry: the client for resolving tags. Defaults to a client for the public
+            registries.
+        :param prepuller: pulls new digests onto the nodes before they are used. None uses new
+            digests at once.
+        :param refresh_interval: the number of seconds between refreshes. 0 resolves the
+            images once.
+        """
+        self._registry = registry
+        self._prepuller = prepuller
+        self._refresh_interval = refresh_interval
+        self._images: List[str] = []
+        self._nodes: List[str] | Callable[[], Awaitable[List[str]]] = []
+        # image as configured -> image pinned to a digest
+        self._pins: Dict[str, str] = {}
+        self._task: asyncio.Task | None = None
+
+    def start(
+        self,
+        profile_list: Any,
+        nodes: Iterable[str] | Callable[[], Awaitable[List[str]]] = (),
+    ) -> None:
+        """
+        Start pinning the images of a profile_list. Must be called while the hub's event loop
+        is running, which it is while the hub loads its config.
+        :param profile_list: the KubeSpawner profile_list.
+        :param nodes: the kubernetes.io/hostname labels of the nodes new digests are pulled
+            onto before they are used, or a coroutine function returning them, e.g.
+            NodePlacement.node_hostnames.
+        """
+        images = {
+            profile.get("kubespawner_override", {}).get("image")
+            for profile in (profile_list if isinstance(profile_list, list) else [])
+        }
+        self._images = sorted(i for i in images if i and not parse_image(i).digest)
+        self._nodes = nodes if callable(nodes) else list(nodes)
+        if self._registry is None:
+            self._registry = RegistryClient()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+            on_shutdown(self.stop)
+
+    async def stop(self) -> None:
+        """
+        Stop refreshing the pins.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        if self._registry is not None:
+            await self._registry.close()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh image digests")
+            if not self._refresh_interval:
+                return
+            await asyncio.sleep(self._refresh_interval)
+
+    async def refresh(self) -> None:
+        """
+        Resolve every image, and pin the images whose digest changed, after pulling them onto
+        the nodes.
+        """
+        await asyncio.gather(*(self._refresh(image) for image in self._images))
+
+    async def _refresh(self, image: str) -> None:
+        try:
+            digest = await self._registry.resolve(image)
+        except (httpx.HTTPError, ValueError, KeyError) as e:
+            logger.warning(
+                "Failed to resolve %s, spawns use %s: %s",
+                image,
+                self._pins.get(image, "the tag"),
+                e,
+            )
+            return
+        pinned = parse_image(image).pinned(digest)
+        if self._pins.get(image) == pinned:
+            return
+        if self._prepuller is not None and self._nodes:
+            try:
+                nodes = await self._nodes() if callable(self._nodes) else self._nodes
+                logger.info("Pulling %s onto nodes %s", pinned, ", ".join(nodes))
+                await self._prepuller.pull(pinned, nodes)
+            except Exception as e:
+                # the first spawns on a node pull the image instead, as they did before
+                logger.warning("Failed to pre-pull %s: %s", pinned, e)
+        logger.info("Pinning %s to %s", image, pinned)
+        self._pins[image] = pinned
+
+    def pin(self, pod: Any) -> Any:
+        """
+        Replace the images of a pod's containers with their pinned digests. Pinned containers
+        are copies, since sidecars are shared by every pod of a compiled template.
+        :returns: the pod.
+        """
+        for i, container in enumerate(pod.spec.containers):
+            pinned = self._pins.get(container.image)
+            if pinned:
+                container = pod.spec.containers[i] = copy.copy(container)
+                container.image = pinned
+                container.image_pull_policy = "IfNotPresent"
+        return pod
+
+
+image_pins = ImagePins(prepuller=ImagePrePuller())
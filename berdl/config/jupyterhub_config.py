@@ -1,6 +1,14 @@
 import os
 from berdl.auth.kb_jupyterhub_auth import KBaseAuthenticator
+from berdl.config.api_handlers import MINIO_CREDENTIALS_SCOPE, SPARK_CLUSTER_SCOPE
+from berdl.config.api_handlers import default_handlers as berdl_api_handlers
 from berdl.config.hooks import pre_spawn_hook, post_stop_hook, modify_pod_hook
+from berdl.config.images import image_pins
+from berdl.config.placement import HOME_HOST_PATH, node_placement
+from berdl.config.pod_template import pod_templates
+from berdl.config.prefetch import prefetch_post_auth_hook
+from berdl.config.spawner import BERDLKubeSpawner
+from berdl.config.spark_warm_pool import spark_warm_pool, warm_pool_post_auth_hook
 
 c = get_config()
 # ==============================================================================
@@ -29,11 +37,61 @@ c.JupyterHub.cleanup_servers = False
 c.JupyterHub.authenticator_class = KBaseAuthenticator
 c.Authenticator.enable_auth_state = True
 c.Authenticator.allow_all = True
+# Check the KBase token before spawning so that an expired token fails fast and redirects to login
+# The token is revalidated in the background every KBASE_AUTH_REFRESH_AGE_SECONDS
+c.Authenticator.refresh_pre_spawn = True
+# BERDL REST endpoints under /hub/api/berdl/, see berdl/config/api_handlers.py
+c.KBaseAuthenticator.extra_handlers = berdl_api_handlers
+# Users, and their notebook servers, may manage their own Spark cluster and invalidate their
+# cached MinIO credentials through the BERDL API
+c.JupyterHub.custom_scopes = {
+    SPARK_CLUSTER_SCOPE: {"description": "Create and inspect a user's Spark cluster."},
+    MINIO_CREDENTIALS_SCOPE: {
+        "description": "Invalidate a user's cached MinIO credentials."
+    },
+}
+c.JupyterHub.load_roles = [
+    {
+        "name": "user",
+        "scopes": [
+            "self",
+            f"{SPARK_CLUSTER_SCOPE}!user",
+            f"{MINIO_CREDENTIALS_SCOPE}!user",
+        ],
+    },
+]
+c.Spawner.server_token_scopes = [
+    "users:activity!user",
+    "access:servers!server",
+    f"{SPARK_CLUSTER_SCOPE}!user",
+    f"{MINIO_CREDENTIALS_SCOPE}!user",
+]
+# Work started at login, ready for the spawn
+post_auth_hooks = []
+# Opt in to fetching MinIO credentials and Spark cluster status
+if os.environ.get("BERDL_PREFETCH_ON_LOGIN", "false").lower() == "true":
+    post_auth_hooks.append(prefetch_post_auth_hook)
+# Create Spark clusters for users who just logged in, see BERDL_SPARK_WARM_POOL_SIZE
+if spark_warm_pool.size > 0:
+    post_auth_hooks.append(warm_pool_post_auth_hook)
+
+
+async def post_auth_hook(authenticator, handler, authentication):
+    for hook in post_auth_hooks:
+        authentication = await hook(authenticator, handler, authentication)
+    return authentication
+
+
+if post_auth_hooks:
+    c.Authenticator.post_auth_hook = post_auth_hook
 # ==============================================================================
 # ## Spawner Configuration
 # How JupyterHub creates and manages individual user notebook servers.
 # ==============================================================================
-c.JupyterHub.spawner_class = "kubespawner.KubeSpawner"
+# A KubeSpawner that also reports BERDL spawn progress and Spark cluster readiness
+c.JupyterHub.spawner_class = BERDLKubeSpawner
+# Profile images are pinned to digests and pulled IfNotPresent, see image_pins below.
+# Images that cannot be resolved keep their tags, so must still be checked on every spawn.
 c.KubeSpawner.image_pull_policy = "Always"
 
 # --- Pod Definition ---
@@ -112,17 +170,75 @@ c.JupyterHub.services = [
             f"--timeout={timeout}",  # Shutdown servers after inactivity
             "--cull-every=600",  # Check for idle servers every 10 minutes
         ],
-    }
+    },
+    {
+        # Deletes Spark clusters left behind by failed deletes or hub restarts
+        "name": "spark-reaper",
+        "command": [
+            "python3",
+            "-m",
+            "berdl.services.spark_reaper",
+            f"--interval={os.environ.get('BERDL_SPARK_REAPER_INTERVAL_SECONDS', '3600')}",
+        ],
+        "environment": {
+            "SPARK_CLUSTER_MANAGER_API_URL": os.environ["SPARK_CLUSTER_MANAGER_API_URL"],
+        },
+    },
 ]
+c.JupyterHub.load_roles.append(
+    {
+        "name": "spark-reaper",
+        "scopes": ["list:users", "read:users", "read:servers", "admin:auth_state"],
+        "services": ["spark-reaper"],
+    }
+)
+# Removes the Spark workers of idle notebooks well before the idle culler stops the notebook.
+# Off by default, since removing the workers ends the notebook's Spark session
+spark_idle_timeout = os.environ.get("BERDL_SPARK_IDLE_TIMEOUT_SECONDS", "0")
+if float(spark_idle_timeout) > 0:
+    c.JupyterHub.services.append(
+        {
+            "name": "spark-idle-scaler",
+            "command": [
+                "python3",
+                "-m",
+                "berdl.services.spark_idle_scaler",
+                f"--idle-timeout={spark_idle_timeout}",
+            ],
+            "environment": {
+                "SPARK_CLUSTER_MANAGER_API_URL": os.environ[
+                    "SPARK_CLUSTER_MANAGER_API_URL"
+                ],
+            },
+        }
+    )
+    c.JupyterHub.load_roles.append(
+        {
+            "name": "spark-idle-scaler",
+            "scopes": [
+                "list:users",
+                "read:users",
+                "read:servers",
+                "admin:auth_state",
+                SPARK_CLUSTER_SCOPE,
+            ],
+            "services": ["spark-idle-scaler"],
+        }
+    )
 
 
 # --- User-Selectable Profiles ---
+# Profiles may declare BERDL settings under "spark", see berdl/config/profiles.py
+# "provisioning": "lazy" skips the Spark cluster at spawn; the notebook requests one when needed
+# "shape" sizes the Spark cluster with the notebook; users may request up to the BERDL_SPARK_MAX_* limits
+# "pod" adds env vars, labels, annotations, tolerations and sidecars to the pods, see berdl/config/pod_template.py
 berdl_notebook_image_tag = os.environ.get(
     "BERDL_NOTEBOOK_IMAGE_TAG", "ghcr.io/bio-boris/berdl_notebook:main"
 )
 c.KubeSpawner.profile_list = [
     {
         "display_name": "Small Server (2G RAM, 1 CPU)",
+        "slug": "small",
         "default": True,
         "kubespawner_override": {
             "mem_limit": "2G",
@@ -131,9 +247,14 @@ c.KubeSpawner.profile_list = [
             "cpu_guarantee": 0.5,
             "image": "jupyter/base-notebook:latest",
         },
+        "spark": {
+            "provisioning": "lazy",
+            "shape": {"worker_count": 1, "worker_memory": "4GiB", "master_memory": "4GiB"},
+        },
     },
     {
         "display_name": "Medium Server (8G RAM, 2 CPU) w quay.io/jupyter/pyspark-notebook:spark-4.0.0",
+        "slug": "medium",
         "kubespawner_override": {
             "mem_limit": "8G",
             "mem_guarantee": "4G",
@@ -144,6 +265,7 @@ c.KubeSpawner.profile_list = [
     },
     {
         "display_name": f"Large Server (32G RAM, 4 CPU) with {berdl_notebook_image_tag}",
+        "slug": "large",
         "kubespawner_override": {
             "mem_limit": "32G",
             "mem_guarantee": "16G",
@@ -151,8 +273,13 @@ c.KubeSpawner.profile_list = [
             "cpu_guarantee": 2,
             "image": f"{berdl_notebook_image_tag}",
         },
+        "spark": {"shape": {"worker_count": 4}},
     },
 ]
+# Validate the pod templates now, rather than on the first spawn
+pod_templates.compile(c.KubeSpawner.profile_list)
+# Warm Spark clusters are shaped for the profile each user last spawned
+spark_warm_pool.use_profiles(c.KubeSpawner.profile_list)
 
 # Storage
 # For now, we are binding workers to kworker02 at ANL and prodb-compute-01 at LBL.
@@ -163,14 +290,28 @@ c.KubeSpawner.profile_list = [
 # The specs of kworker02 are: 168 cores, 1TB RAM, 11.TB  storage
 
 
+# With BERDL_PLACEMENT_NODE_SELECTOR set, notebooks run on any of the matching nodes instead,
+# on the node with the user's home, see berdl/config/placement.py
 node_hostname = os.environ.get("NODE_SELECTOR_HOSTNAME", "kworker02")
-if node_hostname:
+if node_hostname and not node_placement.enabled:
     c.KubeSpawner.node_selector = {"kubernetes.io/hostname": node_hostname}
 
+# Pin the profile images to digests, and pull new digests onto the notebook node before use.
+# Nodes are named by their kubernetes.io/hostname label, as in the notebooks' node selectors
+if os.environ.get("BERDL_IMAGE_PINNING", "true").lower() == "true":
+    image_pins.start(
+        c.KubeSpawner.profile_list,
+        nodes=(
+            node_placement.node_hostnames
+            if node_placement.enabled
+            else [node_hostname] if node_hostname else []
+        ),
+    )
+
 c.KubeSpawner.volumes = [
     {
         "name": "user-home",
-        "hostPath": {"path": "/mnt/state/hub/{username}", "type": "DirectoryOrCreate"},
+        "hostPath": {"path": HOME_HOST_PATH, "type": "DirectoryOrCreate"},
     },
     {
         "name": "user-global",
@@ -188,7 +329,7 @@ c.KubeSpawner.volume_mounts = [
 
 # The default command runs 'start-notebook.sh', which passes these args along.
 # Hooks for pre-spawn and post-stop actions
-# These will also add environment variables to the pod, such as BERDL_POD_IP
+# modify_pod_hook applies the pod templates, which add environment variables such as BERDL_POD_IP
 c.KubeSpawner.pre_spawn_hook = pre_spawn_hook
 c.KubeSpawner.post_stop_hook = post_stop_hook
 c.KubeSpawner.modify_pod_hook = modify_pod_hook
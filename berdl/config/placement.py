@@ -0,0 +1,620 @@
+"""
+Chooses the node each notebook runs on.
+
+Home directories are hostPath directories, so a notebook must run on the node that has its
+user's home. Rather than pinning every notebook to one node, the hub keeps an index of the node
+each user's home is on, in a ConfigMap, and checks the allocatable capacity of the notebook
+nodes, the nodes matching BERDL_PLACEMENT_NODE_SELECTOR, against the resource requests of the
+pods already on them. For each spawn:
+    1. If the user's home node has room for the notebook, the notebook runs there.
+    2. If the user has no home yet, the notebook runs on the least loaded node with room, which
+        becomes their home.
+    3. If the home node is full, the home is copied to the least loaded node with room, which
+        becomes their home. The copy on the old node is left in place. If no node has room, or
+        the home cannot be copied, the notebook waits for room on its home node, as before.
+
+Users who have no entry in the index, and whose hub accounts are older than the index, have
+their homes on the node all notebooks ran on before, BERDL_PLACEMENT_LEGACY_NODE.
+
+Homes are copied by two short-lived pods running BERDL_HOME_MIGRATION_IMAGE, which must include
+rsync: an rsync daemon on the old node serves the home to a client on the new node. The daemon
+reads the home as root to keep its owners, so each copy generates a password, shared by the two
+pods through a Secret, and a NetworkPolicy admits only that copy's client to the daemon.
+
+The global share is a hostPath directory too, so each notebook node has its own.
+
+The hub's service account needs to list nodes and pods in every namespace, and to manage
+ConfigMaps, pods, Secrets and NetworkPolicies in the hub's namespace.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import secrets
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from jupyterhub.traitlets import ByteSpecification
+from kubernetes.utils.quantity import parse_quantity
+from kubernetes_asyncio import client as k8s
+
+from berdl.clients.kube import core_v1_api, hub_namespace, networking_v1_api
+from berdl.config.profiles import selected_profile
+from berdl.config.progress import publish
+from berdl.metrics import (
+    HOME_MIGRATION_DURATION_SECONDS,
+    NOTEBOOK_PLACEMENT_DECISIONS,
+    PlacementDecision,
+    observe_duration,
+)
+
+logger = logging.getLogger(__name__)
+
+PLACEMENT_NODE_SELECTOR = os.environ.get("BERDL_PLACEMENT_NODE_SELECTOR", "")
+PLACEMENT_LEGACY_NODE = os.environ.get(
+    "BERDL_PLACEMENT_LEGACY_NODE", os.environ.get("NODE_SELECTOR_HOSTNAME", "kworker02")
+)
+CAPACITY_TTL = float(os.environ.get("BERDL_PLACEMENT_CAPACITY_TTL_SECONDS", 15))
+HOME_HOST_PATH = os.environ.get("BERDL_HOME_HOST_PATH", "/mnt/state/hub/{username}")
+HOME_MIGRATION = os.environ.get("BERDL_HOME_MIGRATION", "true").lower() == "true"
+# The copy pods run as root with every user's home mounted, so there is no default: the image
+# must be one the deployment trusts, pinned to a digest
+HOME_MIGRATION_IMAGE = os.environ.get("BERDL_HOME_MIGRATION_IMAGE", "")
+HOME_MIGRATION_TIMEOUT = float(
+    os.environ.get("BERDL_HOME_MIGRATION_TIMEOUT_SECONDS", 3600)
+)
+
+HOSTNAME_LABEL = "kubernetes.io/hostname"
+INDEX_CONFIG_MAP = "berdl-home-nodes"
+
+_CONFIG_MAP_KEY = re.compile(r"^[-._a-zA-Z0-9]{1,253}$")
+_MIGRATION_APP = "berdl-home-migration"
+_RSYNC_PORT = 8730
+_RSYNC_USER = "berdl"
+# where the copy pods mount the copy's Secret
+_SECRET_PATH = "/secret"
+# printf format of the rsync daemon's config, serving the home read only as the module "home",
+# to the copy's client only
+_RSYNCD_CONF = (
+    "[home]\\npath = /data\\nread only = true\\nuse chroot = false\\nuid = 0\\ngid = 0\\n"
+    f"auth users = {_RSYNC_USER}\\nsecrets file = {_SECRET_PATH}/rsyncd.secrets\\n"
+)
+
+
+def _index_key(username: str) -> str:
+    # ConfigMap keys allow fewer characters than usernames
+    if _CONFIG_MAP_KEY.match(username):
+        return username
+    return "sha256-" + hashlib.sha256(username.encode()).hexdigest()
+
+
+def _migration_labels(attempt: str, role: str) -> Dict[str, str]:
+    return {
+        "app": _MIGRATION_APP,
+        f"{_MIGRATION_APP}/attempt": attempt,
+        f"{_MIGRATION_APP}/role": role,
+    }
+
+
+def _as_utc(value: datetime) -> datetime:
+    # The hub's database stores naive UTC timestamps
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+class NodeCapacity(NamedTuple):
+    """
+    The allocatable resources of a node, and the requests of the pods on it.
+    """
+
+    name: str
+    hostname: str
+    ready: bool  # ready and schedulable
+    cpu: float
+    memory: float
+    cpu_requested: float = 0
+    memory_requested: float = 0
+
+    def fits(self, cpu: float, memory: float) -> bool:
+        """
+        Check whether a pod with the requests has room on the node.
+        """
+        return (
+            self.ready
+            and self.cpu_requested + cpu <= self.cpu
+            and self.memory_requested + memory <= self.memory
+        )
+
+    def load(self, cpu: float = 0, memory: float = 0) -> float:
+        """
+        Get the larger of the fractions of the node's CPU and memory that would be requested
+        with a pod with the requests added.
+        """
+        if not self.cpu or not self.memory:
+            return float("inf")
+        return max(
+            (self.cpu_requested + cpu) / self.cpu,
+            (self.memory_requested + memory) / self.memory,
+        )
+
+
+def spawn_requests(spawner: Any) -> Tuple[float, float]:
+    """
+    Get the CPU and memory, in bytes, the spawn's notebook container will request, from the
+    profile the user selected or the spawner's defaults.
+    """
+    override = selected_profile(spawner).get("kubespawner_override", {})
+    cpu = override.get("cpu_guarantee", spawner.cpu_guarantee) or 0
+    memory = override.get("mem_guarantee", spawner.mem_guarantee) or 0
+    # KubeSpawner's memory sizes are binary, e.g. 1G is 1024**3 bytes
+    return float(cpu), float(ByteSpecification().validate(None, memory))
+
+
+class HomeIndex:
+    """
+    The node each user's home directory is on, stored in a ConfigMap.
+    """
+
+    def __init__(self, api: Any = None, namespace: str | None = None):
+        """
+        Create the index.
+        :param api: a kubernetes_asyncio CoreV1Api, or a fake. Defaults to a client for the
+            cluster the hub runs in.
+        :param namespace: the namespace of the ConfigMap. Defaults to the hub's.
+        """
+        self._api = api
+        self._namespace = namespace or hub_namespace()
+        self._homes: Dict[str, str] | None = None
+        self._lock = asyncio.Lock()
+        self.created: datetime | None = None
+
+    async def _load(self) -> Dict[str, str]:
+        async with self._lock:
+            if self._homes is None:
+                api = self._api or await core_v1_api()
+                try:
+                    config_map = await api.read_namespaced_config_map(
+                        INDEX_CONFIG_MAP, self._namespace
+                    )
+                except k8s.ApiException as e:
+                    if e.status != 404:
+                        raise
+                    config_map = await api.create_namespaced_config_map(
+                        self._namespace,
+                        {"metadata": {"name": INDEX_CONFIG_MAP}, "data": {}},
+                    )
+                self.created = _as_utc(config_map.metadata.creation_timestamp)
+                self._homes = dict(config_map.data or {})
+        return self._homes
+
+    async def get(self, username: str) -> str | None:
+        """
+        Get the node the user's home is on, or None if the index has no entry for the user.
+        """
+        return (await self._load()).get(_index_key(username))
+
+    async def set(self, username: str, node: str) -> None:
+        """
+        Record the node the user's home is on.
+        """
+        homes = await self._load()
+        api = self._api or await core_v1_api()
+        key = _index_key(username)
+        # a merge patch of a single key, so concurrent updates of other users cannot conflict
+        await api.patch_namespaced_config_map(
+            INDEX_CONFIG_MAP, self._namespace, {"data": {key: node}}
+        )
+        homes[key] = node
+
+
+class HomeMigrator:
+    """
+    Copies home directories between nodes.
+    """
+
+    def __init__(
+        self,
+        api: Any = None,
+        networking_api: Any = None,
+        namespace: str | None = None,
+        image: str = HOME_MIGRATION_IMAGE,
+        timeout: float = HOME_MIGRATION_TIMEOUT,
+        poll_interval: float = 2,
+    ):
+        """
+        Create the migrator.
+        :param api: a kubernetes_asyncio CoreV1Api, or a fake. Defaults to a client for the
+            cluster the hub runs in.
+        :param networking_api: a kubernetes_asyncio NetworkingV1Api, or a fake. Defaults to a
+            client for the cluster the hub runs in.
+        :param namespace: the namespace of the copy pods. Defaults to the hub's.
+        :param image: the image of the copy pods, which must include rsync.
+        :raises ValueError: if no image is given.
+        :param timeout: the maximum number of seconds a copy may take.
+        :param poll_interval: the number of seconds between checks of the copy pods.
+        """
+        if not image:
+            raise ValueError(
+                "BERDL_HOME_MIGRATION_IMAGE must be set to copy homes, "
+                "or BERDL_HOME_MIGRATION to false"
+            )
+        self._api = api
+        self._networking_api = networking_api
+        self._namespace = namespace or hub_namespace()
+        self._image = image
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+
+    def _pod(
+        self,
+        name: str,
+        labels: Dict[str, str],
+        node: str,
+        path: str,
+        read_only: bool,
+        secret: str,
+        command: str,
+    ) -> dict:
+        return {
+            "apiVersion": "v1",
+            "kind": "Pod",
+            "metadata": {"name": name, "labels": labels},
+            "spec": {
+                "nodeName": node,
+                "restartPolicy": "Never",
+                "tolerations": [{"operator": "Exists"}],
+                "containers": [
+                    {
+                        "name": "rsync",
+                        "image": self._image,
+                        "command": ["sh", "-c", command],
+                        "volumeMounts": [
+                            {"name": "home", "mountPath": "/data", "readOnly": read_only},
+                            {"name": "secret", "mountPath": _SECRET_PATH, "readOnly": True},
+                        ],
+                    }
+                ],
+                "volumes": [
+                    {
+                        "name": "home",
+                        "hostPath": {
+                            "path": path,
+                            "type": "Directory" if read_only else "DirectoryOrCreate",
+                        },
+                    },
+                    # rsync refuses password files other users can read
+                    {"name": "secret", "secret": {"secretName": secret, "defaultMode": 0o400}},
+                ],
+            },
+        }
+
+    async def copy(self, path: str, source: str, target: str) -> None:
+        """
+        Copy a directory from one node to the same path on another.
+        :param path: the path of the directory on the nodes.
+        :param source: the name of the node to copy from.
+        :param target: the name of the node to copy to.
+        :raises RuntimeError: if the copy fails.
+        :raises asyncio.TimeoutError: if the copy does not finish within the timeout.
+        """
+        api = self._api or await core_v1_api()
+        networking_api = self._networking_api or await networking_v1_api()
+        # every attempt has its own objects, so a retry does not wait for the last one's
+        attempt = secrets.token_hex(4)
+        name = f"berdl-home-{hashlib.sha256(path.encode()).hexdigest()[:12]}-{attempt}"
+        # the objects to delete when the copy ends, whether or not they were created
+        cleanup: List[Tuple[Any, str]] = []
+        try:
+            with observe_duration(HOME_MIGRATION_DURATION_SECONDS):
+                await asyncio.wait_for(
+                    self._copy(
+                        api, networking_api, path, source, target, name, attempt, cleanup
+                    ),
+                    self._timeout,
+                )
+        finally:
+            for delete, object_name in reversed(cleanup):
+                try:
+                    await delete(object_name, self._namespace)
+                except k8s.ApiException as e:
+                    if e.status != 404:
+                        logger.warning(
+                            "Failed to delete home copy object %s: %s", object_name, e
+                        )
+
+    async def _copy(
+        self,
+        api: Any,
+        networking_api: Any,
+        path: str,
+        source: str,
+        target: str,
+        name: str,
+        attempt: str,
+        cleanup: List[Tuple[Any, str]],
+    ) -> None:
+        server, client = f"{name}-src", f"{name}-dst"
+        password = secrets.token_urlsafe(32)
+        cleanup.append((api.delete_namespaced_secret, name))
+        await api.create_namespaced_secret(
+            self._namespace,
+            {
+                "apiVersion": "v1",
+                "kind": "Secret",
+                "metadata": {"name": name, "labels": {"app": _MIGRATION_APP}},
+                "stringData": {
+                    "password": password,
+                    "rsyncd.secrets": f"{_RSYNC_USER}:{password}\n",
+                },
+            },
+        )
+        # only the client of this attempt may connect to the daemon
+        cleanup.append((networking_api.delete_namespaced_network_policy, name))
+        await networking_api.create_namespaced_network_policy(
+            self._namespace,
+            {
+                "apiVersion": "networking.k8s.io/v1",
+                "kind": "NetworkPolicy",
+                "metadata": {"name": name, "labels": {"app": _MIGRATION_APP}},
+                "spec": {
+                    "podSelector": {"matchLabels": _migration_labels(attempt, "server")},
+                    "policyTypes": ["Ingress"],
+                    "ingress": [
+                        {
+                            "from": [
+                                {
+                                    "podSelector": {
+                                        "matchLabels": _migration_labels(attempt, "client")
+                                    }
+                                }
+                            ],
+                            "ports": [{"protocol": "TCP", "port": _RSYNC_PORT}],
+                        }
+                    ],
+                },
+            },
+        )
+        cleanup.append((api.delete_namespaced_pod, server))
+        await api.create_namespaced_pod(
+            self._namespace,
+            self._pod(
+                server,
+                _migration_labels(attempt, "server"),
+                source,
+                path,
+                True,
+                name,
+                f"printf '{_RSYNCD_CONF}' > /tmp/rsyncd.conf && exec rsync --daemon "
+                f"--no-detach --port={_RSYNC_PORT} --config=/tmp/rsyncd.conf",
+            ),
+        )
+        pod = await self._wait(api, server, lambda p: p.status.phase == "Running")
+        url = f"rsync://{_RSYNC_USER}@{pod.status.pod_ip}:{_RSYNC_PORT}/home/"
+        cleanup.append((api.delete_namespaced_pod, client))
+        # retry while the daemon starts listening
+        await api.create_namespaced_pod(
+            self._namespace,
+            self._pod(
+                client,
+                _migration_labels(attempt, "client"),
+                target,
+                path,
+                False,
+                name,
+                "for i in 1 2 3 4 5; do rsync -aH --delete "
+                f"--password-file={_SECRET_PATH}/password {url} /data/ && exit 0; "
+                "sleep 2; done; exit 1",
+            ),
+        )
+        await self._wait(api, client, lambda p: p.status.phase == "Succeeded")
+        logger.info("Copied %s from node %s to node %s", path, source, target)
+
+    async def _wait(self, api: Any, name: str, done: Any) -> Any:
+        while True:
+            pod = await api.read_namespaced_pod(name, self._namespace)
+            if done(pod):
+                return pod
+            if pod.status.phase in ("Failed", "Succeeded"):
+                raise RuntimeError(f"Home copy pod {name} ended with {pod.status.phase}")
+            await asyncio.sleep(self._poll_interval)
+
+
+class NodePlacement:
+    """
+    Chooses the node of each notebook, see the module documentation.
+    """
+
+    def __init__(
+        self,
+        node_selector: str = PLACEMENT_NODE_SELECTOR,
+        legacy_node: str | None = PLACEMENT_LEGACY_NODE,
+        api: Any = None,
+        index: HomeIndex | None = None,
+        migrator: HomeMigrator | None = None,
+        home_path: str = HOME_HOST_PATH,
+        capacity_ttl: float = CAPACITY_TTL,
+    ):
+        """
+        Create the placement.
+        :param node_selector: the label selector of the notebook nodes. Empty disables
+            placement.
+        :param legacy_node: the hostname of the node with the homes of users older than the
+            index. None if there is none.
+        :param api: a kubernetes_asyncio CoreV1Api, or a fake. Defaults to a client for the
+            cluster the hub runs in.
+        :param index: the home index. Defaults to an index using `api`.
+        :param migrator: copies full homes to other nodes. None never copies homes.
+        :param home_path: the host path of a home, with KubeSpawner's {username} placeholder.
+        :param capacity_ttl: the number of seconds node capacity is cached for.
+        """
+        self.node_selector = node_selector
+        self._legacy_node = legacy_node
+        self._api = api
+        self._index = index or HomeIndex(api)
+        self._migrator = migrator
+        self._home_path = home_path
+        self._capacity_ttl = capacity_ttl
+        self._nodes: Dict[str, NodeCapacity] = {}
+        self._nodes_time = 0.0
+        self._nodes_lock = asyncio.Lock()
+        # spawns placed since the capacity was read: (expiry, hostname, cpu, memory)
+        self._reservations: List[Tuple[float, str, float, float]] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.node_selector)
+
+    async def _read_nodes(self) -> Dict[str, NodeCapacity]:
+        api = self._api or await core_v1_api()
+        nodes = (await api.list_node(label_selector=self.node_selector)).items
+        pods = (
+            await api.list_pod_for_all_namespaces(
+                field_selector="status.phase!=Succeeded,status.phase!=Failed"
+            )
+        ).items
+        requested: Dict[str, List[float]] = {}
+        for pod in pods:
+            if not pod.spec.node_name:
+                continue
+            totals = requested.setdefault(pod.spec.node_name, [0.0, 0.0])
+            for container in pod.spec.containers:
+                requests = (container.resources and container.resources.requests) or {}
+                totals[0] += float(parse_quantity(requests.get("cpu", 0)))
+                totals[1] += float(parse_quantity(requests.get("memory", 0)))
+        capacity = {}
+        for node in nodes:
+            name = node.metadata.name
+            hostname = (node.metadata.labels or {}).get(HOSTNAME_LABEL, name)
+            allocatable = node.status.allocatable or {}
+            ready = not node.spec.unschedulable and any(
+                c.type == "Ready" and c.status == "True"
+                for c in node.status.conditions or []
+            )
+            cpu_requested, memory_requested = requested.get(name, (0.0, 0.0))
+            capacity[hostname] = NodeCapacity(
+                name=name,
+                hostname=hostname,
+                ready=ready,
+                cpu=float(parse_quantity(allocatable.get("cpu", 0))),
+                memory=float(parse_quantity(allocatable.get("memory", 0))),
+                cpu_requested=cpu_requested,
+                memory_requested=memory_requested,
+            )
+        return capacity
+
+    async def capacity(self) -> Dict[str, NodeCapacity]:
+        """
+        Get the capacity of the notebook nodes by hostname, including the requests of recent
+        spawns whose pods may not be on their nodes yet.
+        """
+        async with self._nodes_lock:
+            if time.monotonic() - self._nodes_time > self._capacity_ttl:
+                self._nodes = await self._read_nodes()
+                self._nodes_time = time.monotonic()
+        now = time.monotonic()
+        self._reservations = [r for r in self._reservations if r[0] > now]
+        nodes = dict(self._nodes)
+        for _, hostname, cpu, memory in self._reservations:
+            if hostname in nodes:
+                node = nodes[hostname]
+                nodes[hostname] = node._replace(
+                    cpu_requested=node.cpu_requested + cpu,
+                    memory_requested=node.memory_requested + memory,
+                )
+        return nodes
+
+    async def node_hostnames(self) -> List[str]:
+        """
+        Get the kubernetes.io/hostname labels of the ready notebook nodes, which need not be
+        their names.
+        """
+        return [n.hostname for n in (await self.capacity()).values() if n.ready]
+
+    async def _home(self, spawner: Any) -> str | None:
+        home = await self._index.get(spawner.user.name)
+        if home or not self._legacy_node:
+            return home
+        created = getattr(spawner.user, "created", None)
+        if created is None or (
+            self._index.created and _as_utc(created) < self._index.created
+        ):
+            return self._legacy_node
+        return None
+
+    @staticmethod
+    def _least_loaded(
+        nodes: Dict[str, NodeCapacity], cpu: float, memory: float, exclude: str = None
+    ) -> NodeCapacity | None:
+        candidates = [
+            n for n in nodes.values() if n.hostname != exclude and n.fits(cpu, memory)
+        ]
+        return min(candidates, key=lambda n: n.load(cpu, memory), default=None)
+
+    async def place(self, spawner: Any) -> str:
+        """
+        Choose the node of a spawn's notebook and set the spawner's node selector to it,
+        copying the user's home to the node if needed.
+        :returns: the hostname of the node.
+        :raises RuntimeError: if there are no notebook nodes.
+        """
+        username = spawner.user.name
+        cpu, memory = spawn_requests(spawner)
+        home = await self._home(spawner)
+        nodes = await self.capacity()
+        if home is not None and (home not in nodes or nodes[home].fits(cpu, memory)):
+            # a home outside the notebook nodes keeps its notebooks, e.g. while the old node
+            # is not labelled
+            hostname, decision = home, PlacementDecision.home
+        elif home is None:
+            node = self._least_loaded(nodes, cpu, memory) or min(
+                nodes.values(), key=lambda n: n.load(cpu, memory), default=None
+            )
+            if node is None:
+                raise RuntimeError(
+                    f"No notebook nodes match the selector {self.node_selector}"
+                )
+            await self._index.set(username, node.hostname)
+            hostname, decision = node.hostname, PlacementDecision.new
+        else:
+            hostname, decision = home, PlacementDecision.full
+            target = self._least_loaded(nodes, cpu, memory, exclude=home)
+            if target is not None and self._migrator is not None and nodes[home].ready:
+                publish(
+                    spawner,
+                    "Your home directory's node is full, moving your home directory to "
+                    f"node {target.hostname}. This may take a while.",
+                )
+                # KubeSpawner expands the hostPath of the home volume the same way
+                path = spawner._expand_user_properties(self._home_path)
+                try:
+                    await self._migrator.copy(path, nodes[home].name, target.name)
+                except Exception as e:
+                    logger.warning(
+                        "Failed to copy home of user %s to node %s, waiting for room on "
+                        "node %s: %s",
+                        username,
+                        target.hostname,
+                        home,
+                        e,
+                    )
+                else:
+                    await self._index.set(username, target.hostname)
+                    hostname, decision = target.hostname, PlacementDecision.migrated
+            if decision == PlacementDecision.full:
+                publish(spawner, f"Waiting for room on node {home}")
+        self._reservations.append(
+            (time.monotonic() + max(self._capacity_ttl, 60), hostname, cpu, memory)
+        )
+        NOTEBOOK_PLACEMENT_DECISIONS.labels(decision=decision).inc()
+        logger.info(
+            "Placing notebook of user %s on node %s (%s)", username, hostname, decision
+        )
+        spawner.node_selector = {HOSTNAME_LABEL: hostname}
+        return hostname
+
+
+node_placement = NodePlacement(
+    migrator=HomeMigrator() if HOME_MIGRATION and PLACEMENT_NODE_SELECTOR else None,
+)
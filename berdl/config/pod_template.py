@@ -0,0 +1,245 @@
+"""
+Changes the BERDL hooks make to every user pod, declared as a template.
+
+A template is a dict with any of the keys
+    env: environment variables of the notebook container, by name. A value is either a string,
+        or a downward API reference: {"field": "status.podIP"} or {"resource": "limits.cpu"}.
+    labels: pod labels.
+    annotations: pod annotations.
+    tolerations: pod tolerations, as Kubernetes dicts.
+    sidecars: additional containers, as Kubernetes dicts. Each needs a name and an image.
+
+DEFAULT_POD_TEMPLATE applies to every pod. A profile_list entry may add to it, and replace its
+entries, with a "pod" template, see profiles.py.
+
+The templates are validated and compiled into Kubernetes objects once, when the hub starts, so
+configuration errors stop the hub rather than a spawn. Applying a template merges it into the
+pod by name, so applying it again, e.g. because the hook ran twice, changes nothing.
+"""
+
+from typing import Any, Dict, List, Tuple
+
+from kubernetes import client
+from kubespawner.utils import get_k8s_model
+
+from berdl.config.profiles import selected_profile
+
+# KubeSpawner's name for the notebook container, always the first container of the pod
+NOTEBOOK_CONTAINER = "notebook"
+
+_TEMPLATE_KEYS = {"env", "labels", "annotations", "tolerations", "sidecars"}
+
+DEFAULT_POD_TEMPLATE = {
+    "env": {
+        "BERDL_POD_IP": {"field": "status.podIP"},
+        "BERDL_POD_NAME": {"field": "metadata.name"},
+        "BERDL_CPU_REQUEST": {"resource": "requests.cpu"},
+        "BERDL_CPU_LIMIT": {"resource": "limits.cpu"},
+        "BERDL_MEMORY_REQUEST": {"resource": "requests.memory"},
+        "BERDL_MEMORY_LIMIT": {"resource": "limits.memory"},
+    },
+}
+
+
+class InvalidPodTemplateError(ValueError):
+    """
+    An error thrown when a pod template is malformed.
+    """
+
+
+def _toleration_key(toleration: Any) -> Tuple:
+    # Tolerations have no name, they are the same if they match the same taints
+    return (
+        toleration.key,
+        toleration.operator,
+        toleration.value,
+        toleration.effect,
+        toleration.toleration_seconds,
+    )
+
+
+def _mapping(template: dict, key: str, source: str) -> dict:
+    value = template.get(key) or {}
+    if not isinstance(value, dict):
+        raise InvalidPodTemplateError(f"{source}: {key} must be a mapping")
+    return value
+
+
+def _list(template: dict, key: str, source: str) -> list:
+    value = template.get(key) or []
+    if not isinstance(value, list):
+        raise InvalidPodTemplateError(f"{source}: {key} must be a list")
+    return value
+
+
+def _env_var(name: str, value: Any, source: str) -> client.V1EnvVar:
+    if not isinstance(name, str) or not name:
+        raise InvalidPodTemplateError(f"{source}: invalid environment variable name {name!r}")
+    if isinstance(value, str):
+        return client.V1EnvVar(name, value)
+    if isinstance(value, dict) and list(value) == ["field"]:
+        return client.V1EnvVar(
+            name,
+            None,
+            client.V1EnvVarSource(
+                field_ref=client.V1ObjectFieldSelector(field_path=value["field"])
+            ),
+        )
+    if isinstance(value, dict) and list(value) == ["resource"]:
+        return client.V1EnvVar(
+            name,
+            None,
+            client.V1EnvVarSource(
+                resource_field_ref=client.V1ResourceFieldSelector(
+                    resource=value["resource"]
+                )
+            ),
+        )
+    raise InvalidPodTemplateError(
+        f"{source}: environment variable {name} must be a string, "
+        "{'field': ...} or {'resource': ...}"
+    )
+
+
+def _k8s_model(model_type: type, value: Any, source: str) -> Any:
+    if not isinstance(value, dict):
+        raise InvalidPodTemplateError(f"{source}: {model_type.__name__} must be a mapping")
+    try:
+        return get_k8s_model(model_type, value)
+    except (TypeError, ValueError) as e:
+        raise InvalidPodTemplateError(f"{source}: {e}")
+
+
+class PodTemplate:
+    """
+    A compiled pod template. Its Kubernetes objects are shared by every pod it is applied to,
+    and must not be modified.
+    """
+
+    def __init__(self, *templates: dict, source: str = "Pod template"):
+        """
+        Validate and compile templates. Later templates add to and replace the entries of
+        earlier ones.
+        :param templates: the templates, see the module documentation.
+        :param source: a description of the templates for error messages.
+        :raises InvalidPodTemplateError: if a template is malformed.
+        """
+        env: Dict[str, client.V1EnvVar] = {}
+        self.labels: Dict[str, str] = {}
+        self.annotations: Dict[str, str] = {}
+        tolerations: Dict[Tuple, Any] = {}
+        sidecars: Dict[str, Any] = {}
+        for template in templates:
+            if not isinstance(template, dict):
+                raise InvalidPodTemplateError(f"{source} must be a mapping")
+            unknown = set(template) - _TEMPLATE_KEYS
+            if unknown:
+                raise InvalidPodTemplateError(
+                    f"{source}: unknown keys {', '.join(sorted(unknown))}"
+                )
+            for name, value in _mapping(template, "env", source).items():
+                env[name] = _env_var(name, value, source)
+            for key in ("labels", "annotations"):
+                for name, value in _mapping(template, key, source).items():
+                    if not isinstance(name, str) or not isinstance(value, str):
+                        raise InvalidPodTemplateError(
+                            f"{source}: {key} must map strings to strings"
+                        )
+                    getattr(self, key)[name] = value
+            for value in _list(template, "tolerations", source):
+                toleration = _k8s_model(client.V1Toleration, value, source)
+                tolerations[_toleration_key(toleration)] = toleration
+            for value in _list(template, "sidecars", source):
+                sidecar = _k8s_model(client.V1Container, value, source)
+                if not sidecar.name or not sidecar.image:
+                    raise InvalidPodTemplateError(
+                        f"{source}: sidecars need a name and an image"
+                    )
+                if sidecar.name == NOTEBOOK_CONTAINER:
+                    raise InvalidPodTemplateError(
+                        f"{source}: sidecar name {NOTEBOOK_CONTAINER} is reserved"
+                    )
+                sidecars[sidecar.name] = sidecar
+        self.env: List[client.V1EnvVar] = list(env.values())
+        self.tolerations: List[Any] = list(tolerations.values())
+        self.sidecars: List[Any] = list(sidecars.values())
+
+    def apply(self, pod: Any) -> Any:
+        """
+        Merge the template into a pod, replacing entries with the same names.
+        :returns: the pod.
+        """
+        container = pod.spec.containers[0]
+        container.env = _merge_by_name(container.env, self.env)
+        if self.labels:
+            pod.metadata.labels = {**(pod.metadata.labels or {}), **self.labels}
+        if self.annotations:
+            pod.metadata.annotations = {
+                **(pod.metadata.annotations or {}),
+                **self.annotations,
+            }
+        if self.tolerations:
+            existing = {_toleration_key(t) for t in pod.spec.tolerations or []}
+            pod.spec.tolerations = list(pod.spec.tolerations or []) + [
+                t for t in self.tolerations if _toleration_key(t) not in existing
+            ]
+        if self.sidecars:
+            pod.spec.containers = _merge_by_name(pod.spec.containers, self.sidecars)
+        return pod
+
+
+def _merge_by_name(items: List[Any] | None, updates: List[Any]) -> List[Any]:
+    """Replace the items with the names of the updates in place, and append the rest."""
+    items = list(items or [])
+    index = {item.name: i for i, item in enumerate(items)}
+    for update in updates:
+        i = index.get(update.name)
+        if i is None:
+            index[update.name] = len(items)
+            items.append(update)
+        else:
+            items[i] = update
+    return items
+
+
+class PodTemplates:
+    """
+    The compiled pod templates of the hub's profiles.
+    """
+
+    def __init__(self, default: dict = DEFAULT_POD_TEMPLATE):
+        """
+        Create the templates.
+        :param default: the template applied to every pod.
+        """
+        self._default_template = default
+        self._default = PodTemplate(default, source="Default pod template")
+        self._profiles: Dict[str, PodTemplate] = {}
+
+    def compile(self, profile_list: Any) -> None:
+        """
+        Compile the templates of a profile_list. Call it once, when the hub starts.
+        :raises InvalidPodTemplateError: if a template is malformed.
+        """
+        profiles = {}
+        for profile in profile_list if isinstance(profile_list, list) else []:
+            if "pod" in profile:
+                slug = profile.get("slug")
+                profiles[slug] = PodTemplate(
+                    self._default_template,
+                    profile["pod"],
+                    source=f"Pod template of profile {slug}",
+                )
+        self._profiles = profiles
+
+    def get(self, spawner: Any) -> PodTemplate:
+        """
+        Get the template for the profile the user selected.
+        """
+        if not self._profiles:
+            return self._default
+        slug = selected_profile(spawner).get("slug")
+        return self._profiles.get(slug, self._default)
+
+
+pod_templates = PodTemplates()
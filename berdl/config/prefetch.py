@@ -0,0 +1,133 @@
+"""
+Work started at login and parked for the user's next spawn.
+
+Most users spawn a server right after logging in, so the spawn hooks' network round trips can
+start as soon as the KBase token has been validated. Results are held in memory, keyed by user
+and token, for a limited time, and a spawn that finds a result still in flight waits for it
+rather than starting the same request again.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Tuple
+
+from berdl.auth.token_cache import hash_token
+from berdl.clients.spark import cluster
+from berdl.metrics import PREFETCH_RESULTS, PrefetchResult
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_TTL = float(os.environ.get("BERDL_PREFETCH_TTL_SECONDS", 300))
+
+CREDENTIALS = "credentials"
+SPARK_STATUS = "spark-status"
+
+
+class _Parked(NamedTuple):
+    token_hash: str
+    started: float
+    task: asyncio.Task
+
+
+class LoginPrefetch:
+    """
+    Holds the results of work started at login until a spawn takes them.
+    """
+
+    def __init__(self, ttl: float = PREFETCH_TTL):
+        """
+        Create the store.
+        :param ttl: the number of seconds a result is kept for a spawn.
+        """
+        self._ttl = ttl
+        self._parked: Dict[Tuple[str, str], _Parked] = {}
+
+    def start(
+        self, kind: str, username: str, token: str, fn: Callable[[], Awaitable[Any]]
+    ) -> None:
+        """
+        Start work in the background and park its result.
+        :param kind: the kind of work, e.g. CREDENTIALS.
+        :param username: the user the work is for.
+        :param token: the user's KBase token. Results are only handed to spawns using the same
+            token.
+        :param fn: a coroutine function that performs the work.
+        """
+        self._expire()
+        previous = self._parked.get((kind, username))
+        if previous is not None:
+            previous.task.cancel()
+        task = asyncio.ensure_future(fn())
+        # results are retrieved later, or never; don't warn about unretrieved exceptions
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._parked[(kind, username)] = _Parked(
+            hash_token(token), time.monotonic(), task
+        )
+
+    async def take(self, kind: str, username: str, token: str) -> Any | None:
+        """
+        Take a parked result, waiting for it if it is still in flight.
+        :param kind: the kind of work.
+        :param username: the user.
+        :param token: the user's KBase token.
+        :returns: the result, or None if there is no usable result.
+        """
+        parked = self._parked.pop((kind, username), None)
+        if parked is None:
+            PREFETCH_RESULTS.labels(kind=kind, result=PrefetchResult.miss).inc()
+            return None
+        if (
+            parked.token_hash != hash_token(token)
+            or time.monotonic() - parked.started > self._ttl
+        ):
+            parked.task.cancel()
+            PREFETCH_RESULTS.labels(kind=kind, result=PrefetchResult.expired).inc()
+            return None
+        try:
+            result = await asyncio.shield(parked.task)
+        except Exception:
+            logger.warning(
+                "Prefetch of %s for user %s failed", kind, username, exc_info=True
+            )
+            PREFETCH_RESULTS.labels(kind=kind, result=PrefetchResult.failure).inc()
+            return None
+        PREFETCH_RESULTS.labels(kind=kind, result=PrefetchResult.hit).inc()
+        return result
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for key, parked in list(self._parked.items()):
+            if now - parked.started > self._ttl:
+                parked.task.cancel()
+                del self._parked[key]
+
+
+login_prefetch = LoginPrefetch()
+
+
+async def prefetch_post_auth_hook(authenticator: Any, handler: Any, authentication: dict):
+    """
+    A JupyterHub post_auth_hook that starts fetching MinIO credentials and the user's Spark
+    cluster status as soon as the user has logged in.
+    """
+    # imported here to avoid a circular import, GovernanceUtils takes parked results
+    from berdl.config.governance_utils import GovernanceUtils
+
+    username = authentication["name"]
+    token = (authentication.get("auth_state") or {}).get("kbase_token")
+    if token:
+        login_prefetch.start(
+            CREDENTIALS,
+            username,
+            token,
+            lambda: GovernanceUtils._fetch_credentials(token),
+        )
+        login_prefetch.start(
+            SPARK_STATUS,
+            username,
+            token,
+            lambda: cluster.get_cluster_status_async(kbase_auth_token=token),
+        )
+    return authentication
@@ -0,0 +1,154 @@
+"""
+BERDL settings declared on the entries of the KubeSpawner profile_list.
+
+KubeSpawner ignores keys it does not know, so a profile can carry BERDL settings next to its
+`kubespawner_override`, e.g.
+
+    {
+        "display_name": "Small Server",
+        "slug": "small",
+        "kubespawner_override": {...},
+        "spark": {"provisioning": "lazy", "shape": {"worker_count": 1}},
+    }
+
+A profile may also carry a "pod" template, see pod_template.py.
+
+The Spark settings are
+    provisioning: EAGER or LAZY, see `spark_provisioning`.
+    shape: the cluster resources, as ClusterShape fields. Missing fields use the defaults.
+    max_shape: the ceilings for user overrides, as ClusterShape fields. Missing fields use the
+        BERDL_SPARK_MAX_* environment variables.
+
+Users may override the shape of their profile with a "spark" dict in their user_options, e.g. by
+starting their server through the REST API with `{"profile": "large", "spark": {"worker_count":
+4}}`. Overrides above the ceilings are rejected.
+"""
+
+import os
+import re
+from typing import Any
+
+from berdl.clients.spark.cluster import DEFAULT_CLUSTER_SHAPE, ClusterShape
+
+# Spark provisioning modes
+EAGER = "eager"  # the cluster is created by the pre-spawn hook
+LAZY = "lazy"  # the notebook asks the hub for a cluster the first time it needs Spark
+
+SPARK_PROVISIONING = os.environ.get("BERDL_SPARK_PROVISIONING", EAGER)
+
+# Ceilings for the Spark cluster shapes users may request
+MAX_CLUSTER_SHAPE = ClusterShape(
+    worker_count=int(os.environ.get("BERDL_SPARK_MAX_WORKER_COUNT", 8)),
+    worker_cores=int(os.environ.get("BERDL_SPARK_MAX_WORKER_CORES", 4)),
+    worker_memory=os.environ.get("BERDL_SPARK_MAX_WORKER_MEMORY", "32GiB"),
+    master_cores=int(os.environ.get("BERDL_SPARK_MAX_MASTER_CORES", 4)),
+    master_memory=os.environ.get("BERDL_SPARK_MAX_MASTER_MEMORY", "32GiB"),
+)
+
+_MEMORY_UNITS = {
+    "": 1,
+    "K": 1000,
+    "M": 1000**2,
+    "G": 1000**3,
+    "T": 1000**4,
+    "Ki": 1024,
+    "Mi": 1024**2,
+    "Gi": 1024**3,
+    "Ti": 1024**4,
+}
+_MEMORY_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)(|K|M|G|T|Ki|Mi|Gi|Ti)B?$")
+
+
+class InvalidSparkShapeError(ValueError):
+    """
+    An error thrown when a Spark cluster shape is malformed or exceeds the ceilings.
+    """
+
+
+def selected_profile(spawner: Any) -> dict:
+    """
+    Get the profile_list entry the user selected, or the default entry if the user did not
+    select one. Returns an empty dict if the hub has no static profile_list.
+    """
+    profiles = getattr(spawner, "profile_list", None)
+    if not isinstance(profiles, list) or not profiles:
+        return {}
+    slug = (getattr(spawner, "user_options", None) or {}).get("profile")
+    for profile in profiles:
+        if slug and profile.get("slug") == slug:
+            return profile
+    return next((p for p in profiles if p.get("default")), profiles[0])
+
+
+def spark_provisioning(spawner: Any) -> str:
+    """
+    Get the Spark provisioning mode, EAGER or LAZY, for the profile the user selected.
+    Profiles without a mode use BERDL_SPARK_PROVISIONING.
+    """
+    mode = selected_profile(spawner).get("spark", {}).get("provisioning")
+    mode = mode or SPARK_PROVISIONING
+    if mode not in (EAGER, LAZY):
+        raise ValueError(f"Unknown Spark provisioning mode: {mode}")
+    return mode
+
+
+def parse_memory(memory: str) -> int:
+    """
+    Parse a memory size such as "10GiB", "512Mi" or "8G" into bytes.
+    :raises InvalidSparkShapeError: if the size is malformed.
+    """
+    match = _MEMORY_PATTERN.match(str(memory).strip())
+    if not match:
+        raise InvalidSparkShapeError(f"Invalid memory size: {memory}")
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2)])
+
+
+def _shape(base: ClusterShape, fields: Any, source: str) -> ClusterShape:
+    """Apply ClusterShape fields, as found in a profile or user_options, to a shape."""
+    if not fields:
+        return base
+    if not isinstance(fields, dict):
+        raise InvalidSparkShapeError(f"{source} must be a mapping of shape fields")
+    try:
+        shape = base._replace(**fields)
+    except ValueError as e:
+        raise InvalidSparkShapeError(f"{source}: {e}")
+    for field in ("worker_count", "worker_cores", "master_cores"):
+        value = getattr(shape, field)
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise InvalidSparkShapeError(f"{source}: {field} must be an integer")
+        # a cluster may have no workers, but always has a master
+        if value < (0 if field == "worker_count" else 1):
+            raise InvalidSparkShapeError(f"{source}: {field} is too small: {value}")
+    for field in ("worker_memory", "master_memory"):
+        if parse_memory(getattr(shape, field)) <= 0:
+            raise InvalidSparkShapeError(f"{source}: {field} must be positive")
+    return shape
+
+
+def spark_shape(spawner: Any) -> ClusterShape:
+    """
+    Get the Spark cluster shape for a spawn: the shape of the profile the user selected, with
+    the user's overrides from user_options.
+    :raises InvalidSparkShapeError: if a shape is malformed, or an override exceeds the
+        ceilings.
+    """
+    spark = selected_profile(spawner).get("spark", {})
+    shape = _shape(DEFAULT_CLUSTER_SHAPE, spark.get("shape"), "Profile Spark shape")
+    overrides = (getattr(spawner, "user_options", None) or {}).get("spark")
+    if not overrides:
+        return shape
+    ceiling = _shape(MAX_CLUSTER_SHAPE, spark.get("max_shape"), "Profile Spark max_shape")
+    shape = _shape(shape, overrides, "Requested Spark shape")
+    # only the user's choices are bounded, a profile may exceed the global ceilings
+    for field in overrides:
+        value, limit = getattr(shape, field), getattr(ceiling, field)
+        if field.endswith("memory"):
+            too_large = parse_memory(value) > parse_memory(limit)
+        else:
+            too_large = value > limit
+        if too_large:
+            raise InvalidSparkShapeError(
+                f"Requested Spark {field} {value} exceeds the maximum of {limit}"
+            )
+    return shape
@@ -0,0 +1,75 @@
+"""
+Progress events for the parts of a spawn that happen in the BERDL hooks.
+
+KubeSpawner only reports the events of the user's pod, so the hooks publish their own events
+here and `BERDLKubeSpawner.progress` merges them with the pod events.
+"""
+
+import asyncio
+import weakref
+from typing import Any, List
+
+# Keyed by spawner, replaced at the start of every spawn
+_streams: "weakref.WeakKeyDictionary[Any, SpawnProgress]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class SpawnProgress:
+    """
+    The BERDL progress events of a single spawn.
+    """
+
+    def __init__(self):
+        self.events: List[dict] = []
+        self._changed = asyncio.Event()
+
+    @classmethod
+    def reset(cls, spawner: Any) -> "SpawnProgress":
+        """
+        Attach a new, empty stream to the spawner, replacing the stream of any previous spawn.
+        """
+        stream = _streams[spawner] = cls()
+        return stream
+
+    @classmethod
+    def get(cls, spawner: Any) -> "SpawnProgress":
+        """
+        Get the stream attached to the spawner, attaching a new one if there is none.
+        """
+        stream = _streams.get(spawner)
+        if stream is None:
+            stream = cls.reset(spawner)
+        return stream
+
+    def publish(self, message: str, **fields) -> None:
+        """
+        Publish an event.
+        :param message: the message shown to the user.
+        :param fields: additional fields of the event, e.g. 'progress'.
+        """
+        self.events.append({"message": message, **fields})
+        self.notify()
+
+    def notify(self) -> None:
+        """
+        Wake up waiters, e.g. because another source of events has a new event.
+        """
+        self._changed.set()
+
+    async def wait(self, timeout: float) -> None:
+        """
+        Wait until `notify` is called, or the timeout expires.
+        """
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+
+def publish(spawner: Any, message: str, **fields) -> None:
+    """
+    Publish a progress event for the spawner's current spawn.
+    """
+    SpawnProgress.get(spawner).publish(message, **fields)
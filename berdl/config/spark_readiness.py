@@ -0,0 +1,160 @@
+"""
+Waits for a user's Spark cluster to accept work while their pod starts.
+
+The cluster manager returns a master URL as soon as the cluster is created, before the master
+and workers are running. The watcher polls the cluster status in the background from the moment
+the cluster is created, so the wait overlaps with the pod's scheduling, image pull and startup,
+and reports the cluster's state as spawn progress events.
+
+What happens if the cluster is still starting when the pod is ready is set by
+BERDL_SPARK_READINESS_POLICY:
+    block: the spawn waits for the cluster, and fails if it is not ready within the timeout.
+    warm: the notebook starts at once, with BERDL_SPARK_READINESS_POLICY=warm in its
+        environment, and can check the cluster with BERDL_SPARK_CLUSTER_API_URL.
+"""
+
+import asyncio
+import logging
+import os
+import weakref
+from typing import Any
+
+from berdl.clients.spark import cluster
+from berdl.config.progress import publish
+from berdl.metrics import (
+    SPARK_CLUSTER_READY_DURATION_SECONDS,
+    observe_duration,
+    profile_label,
+)
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+WARM = "warm"
+
+READINESS_POLICY = os.environ.get("BERDL_SPARK_READINESS_POLICY", WARM)
+READINESS_TIMEOUT = float(
+    os.environ.get("BERDL_SPARK_READINESS_TIMEOUT_SECONDS", 300)
+)
+READINESS_POLL_INTERVAL = float(
+    os.environ.get("BERDL_SPARK_READINESS_POLL_SECONDS", 2)
+)
+
+
+def is_cluster_ready(status: dict | None, worker_count: int) -> bool:
+    """
+    Check whether a cluster status from the cluster manager shows a cluster ready for work.
+    :param status: the status, or None if there is no cluster.
+    :param worker_count: the number of workers that must be ready.
+    """
+    if not status or status.get("error") or not status.get("master_url"):
+        return False
+    master = status.get("master") or {}
+    workers = status.get("workers") or {}
+    return (master.get("ready_replicas") or 0) >= 1 and (
+        workers.get("ready_replicas") or 0
+    ) >= worker_count
+
+
+class SparkReadinessWatcher:
+    """
+    Tracks the readiness of the Spark cluster of each spawn.
+    """
+
+    def __init__(
+        self,
+        policy: str = READINESS_POLICY,
+        timeout: float = READINESS_TIMEOUT,
+        poll_interval: float = READINESS_POLL_INTERVAL,
+    ):
+        """
+        Create the watcher.
+        :param policy: BLOCK or WARM.
+        :param timeout: the number of seconds to wait for a cluster to become ready.
+        :param poll_interval: the number of seconds between status requests.
+        """
+        if policy not in (BLOCK, WARM):
+            raise ValueError(f"Unknown Spark readiness policy: {policy}")
+        self.policy = policy
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._watches: "weakref.WeakKeyDictionary[Any, asyncio.Task]" = (
+            weakref.WeakKeyDictionary()
+        )
+
+    def watch(self, spawner: Any, token: str, worker_count: int) -> None:
+        """
+        Start watching the cluster of a spawn, replacing any previous watch for the spawner.
+        :param spawner: the spawner being started.
+        :param token: the user's KBase token.
+        :param worker_count: the number of workers the cluster must have ready.
+        """
+        self.cancel(spawner)
+        task = asyncio.ensure_future(self._watch(spawner, token, worker_count))
+        # the result is only retrieved when the policy blocks
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        self._watches[spawner] = task
+
+    def cancel(self, spawner: Any) -> None:
+        """
+        Stop watching the cluster of the spawner, e.g. because the server stopped.
+        """
+        task = self._watches.pop(spawner, None)
+        if task is not None:
+            task.cancel()
+
+    async def wait(self, spawner: Any) -> None:
+        """
+        Wait for the spawn's cluster to become ready, if the policy is BLOCK.
+        Returns immediately if the policy is WARM or the cluster is not being watched.
+        :raises asyncio.TimeoutError: if the cluster is not ready within the timeout.
+        """
+        task = self._watches.get(spawner)
+        if self.policy != BLOCK or task is None:
+            return
+        await asyncio.shield(task)
+
+    async def _watch(self, spawner: Any, token: str, worker_count: int) -> None:
+        username = spawner.user.name
+        publish(spawner, "Waiting for Spark cluster to start")
+        try:
+            with observe_duration(
+                SPARK_CLUSTER_READY_DURATION_SECONDS, profile=profile_label(spawner)
+            ):
+                await asyncio.wait_for(
+                    self._poll(spawner, token, worker_count), self._timeout
+                )
+        except asyncio.TimeoutError:
+            message = f"Spark cluster not ready after {self._timeout:.0f} seconds"
+            logger.warning("%s for user %s", message, username)
+            publish(spawner, message)
+            raise asyncio.TimeoutError(message)
+        publish(spawner, "Spark cluster ready")
+        logger.info("Spark cluster ready for user %s", username)
+
+    async def _poll(self, spawner: Any, token: str, worker_count: int) -> None:
+        last = None
+        while True:
+            try:
+                status = await cluster.get_cluster_status_async(kbase_auth_token=token)
+            except Exception:
+                logger.warning(
+                    "Failed to get Spark cluster status for user %s",
+                    spawner.user.name,
+                    exc_info=True,
+                )
+                status = None
+            if is_cluster_ready(status, worker_count):
+                return
+            workers = ((status or {}).get("workers") or {}).get("ready_replicas") or 0
+            state = (workers, worker_count)
+            if status and state != last:
+                publish(
+                    spawner,
+                    f"Spark cluster starting: {workers} of {worker_count} workers ready",
+                )
+                last = state
+            await asyncio.sleep(self._poll_interval)
+
+
+spark_readiness = SparkReadinessWatcher()
@@ -0,0 +1,173 @@
+"""
+Background deletion of Spark clusters.
+
+Stopping a server must not wait on the cluster manager, so the post-stop hook queues the delete
+and returns. A queued delete waits for a grace period before its first attempt, so that a
+server restarted soon after it stopped can adopt its cluster instead of creating a new one.
+Deletes run with bounded concurrency and are retried with backoff, and a spawn for the same user
+first cancels or waits out a queued delete so that it never deletes the new cluster. Deletes still pending when the hub stops are left to the orphan reaper service, see
+`berdl.services.spark_reaper`.
+"""
+
+import asyncio
+import logging
+import os
+import random
+from typing import Dict
+
+from berdl.clients.spark import cluster
+from berdl.metrics import (
+    SPARK_CLUSTER_DELETE_DURATION_SECONDS,
+    SPARK_TEARDOWN_PENDING,
+    SPARK_TEARDOWN_RESULTS,
+    TeardownResult,
+    observe_duration,
+)
+
+logger = logging.getLogger(__name__)
+
+TEARDOWN_CONCURRENCY = int(os.environ.get("BERDL_SPARK_TEARDOWN_CONCURRENCY", 5))
+TEARDOWN_MAX_RETRIES = int(os.environ.get("BERDL_SPARK_TEARDOWN_MAX_RETRIES", 5))
+TEARDOWN_RETRY_DELAY = float(
+    os.environ.get("BERDL_SPARK_TEARDOWN_RETRY_DELAY_SECONDS", 5)
+)
+TEARDOWN_GRACE = float(os.environ.get("BERDL_SPARK_TEARDOWN_GRACE_SECONDS", 60))
+
+
+class _Teardown:
+    def __init__(self, token: str, profile: str):
+        self.token = token
+        self.profile = profile
+        self.deleting = False
+        self.settled = False  # a spawn is waiting to create a new cluster
+        self.task: asyncio.Task | None = None
+
+
+class SparkTeardownQueue:
+    """
+    Deletes users' Spark clusters in the background.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = TEARDOWN_CONCURRENCY,
+        max_retries: int = TEARDOWN_MAX_RETRIES,
+        retry_delay: float = TEARDOWN_RETRY_DELAY,
+        grace: float = TEARDOWN_GRACE,
+    ):
+        """
+        Create the queue.
+        :param max_concurrency: the maximum number of deletes in flight at once.
+        :param max_retries: the number of retries of a failed delete.
+        :param retry_delay: the base of the jittered exponential backoff between retries, in
+            seconds.
+        :param grace: the time a delete waits before its first attempt, in seconds. A spawn in
+            that time cancels the delete, and may adopt the cluster.
+        """
+        self._max_retries = max_retries
+        self._grace = grace
+        self._retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._teardowns: Dict[str, _Teardown] = {}
+
+    def enqueue(self, username: str, token: str, profile: str = "default") -> None:
+        """
+        Queue the deletion of a user's cluster. A delete already queued for the user is kept,
+        with the new token.
+        :param username: the user.
+        :param token: the user's KBase token.
+        :param profile: the profile label for the delete duration metric.
+        """
+        teardown = self._teardowns.get(username)
+        if teardown is not None:
+            teardown.token = token
+            return
+        teardown = _Teardown(token, profile)
+        teardown.task = asyncio.ensure_future(self._run(username, teardown))
+        self._teardowns[username] = teardown
+        SPARK_TEARDOWN_PENDING.set(len(self._teardowns))
+
+    async def settle(self, username: str) -> None:
+        """
+        Make sure no delete will run for a user's cluster, e.g. before creating a new one.
+        A queued delete is cancelled, and a delete in flight is waited for.
+        """
+        teardown = self._teardowns.pop(username, None)
+        SPARK_TEARDOWN_PENDING.set(len(self._teardowns))
+        if teardown is None:
+            return
+        if not teardown.deleting:
+            teardown.task.cancel()
+            SPARK_TEARDOWN_RESULTS.labels(result=TeardownResult.cancelled).inc()
+            return
+        teardown.settled = True  # stop after the current attempt
+        try:
+            await asyncio.shield(teardown.task)
+        except Exception:
+            pass  # logged by the delete
+
+    def queued(self, username: str) -> bool:
+        """
+        Check whether a user's cluster is queued for deletion or being deleted, i.e. the user's
+        server has stopped.
+        """
+        return username in self._teardowns
+
+    @property
+    def pending(self) -> int:
+        """
+        The number of users whose cluster is queued for deletion or being deleted.
+        """
+        return len(self._teardowns)
+
+    async def _run(self, username: str, teardown: _Teardown) -> None:
+        result = TeardownResult.failure
+        try:
+            if self._grace > 0:
+                await asyncio.sleep(self._grace)
+            async with self._semaphore:
+                for attempt in range(self._max_retries + 1):
+                    if attempt:
+                        delay = self._retry_delay * 2 ** (attempt - 1)
+                        await asyncio.sleep(random.uniform(delay / 2, delay))
+                    teardown.deleting = True
+                    try:
+                        with observe_duration(
+                            SPARK_CLUSTER_DELETE_DURATION_SECONDS,
+                            profile=teardown.profile,
+                        ):
+                            await cluster.delete_cluster_async(
+                                kbase_auth_token=teardown.token
+                            )
+                        result = TeardownResult.success
+                        logger.info("Spark cluster deleted for user %s", username)
+                        return
+                    except Exception:
+                        logger.warning(
+                            "Failed to delete Spark cluster for user %s, attempt %s of %s",
+                            username,
+                            attempt + 1,
+                            self._max_retries + 1,
+                            exc_info=True,
+                        )
+                    finally:
+                        teardown.deleting = False
+                    if teardown.settled:
+                        result = TeardownResult.cancelled
+                        return
+                logger.error(
+                    "Giving up deleting Spark cluster for user %s, left to the reaper",
+                    username,
+                )
+        except asyncio.CancelledError:
+            result = None  # counted by settle, or the hub is stopping
+            raise
+        finally:
+            if self._teardowns.get(username) is teardown:
+                del self._teardowns[username]
+                SPARK_TEARDOWN_PENDING.set(len(self._teardowns))
+            if result:
+                SPARK_TEARDOWN_RESULTS.labels(result=result).inc()
+
+
+spark_teardown = SparkTeardownQueue()
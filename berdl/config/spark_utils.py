@@ -1,50 +1,190 @@
+from typing import Any
+
+from berdl.auth.single_flight import SingleFlight
+from berdl.auth.spawn_context import SpawnContext, update_auth_state
 from berdl.clients.spark import cluster
+from berdl.clients.spark.cluster import AUTH_STATE_SHAPE_KEY, ClusterShape
+from berdl.config.admission import spark_admission
+from berdl.config.prefetch import SPARK_STATUS, login_prefetch
+from berdl.config.profiles import LAZY, spark_provisioning, spark_shape
+from berdl.config.progress import publish
+from berdl.config.spark_readiness import is_cluster_ready, spark_readiness
+from berdl.config.spark_teardown import spark_teardown
+from berdl.config.spark_warm_pool import spark_warm_pool
+from berdl.metrics import (
+    SPARK_CLUSTER_CREATE_DURATION_SECONDS,
+    SPARK_CLUSTER_RECONCILE_RESULTS,
+    ClusterReconcileResult,
+    observe_duration,
+    profile_label,
+)
 
 
 class SparkClusterManager:
     """
     A utility class with static methods to manage Spark clusters for users.
-    It retrieves the necessary authentication token from the spawner's user auth_state and sets the environment variables required for Spark.
+    It retrieves the necessary authentication token from the spawn context and sets the environment variables required for Spark.
     """
 
     def __init__(self):
         pass
 
     @staticmethod
-    async def _get_auth_token(spawner) -> str:
-        # TODO WE CAN MOVE THIS TO A SHARED UTILS MODULE
-        """Helper method to retrieve and validate the auth token from the user's auth_state."""
-        auth_state = await spawner.user.get_auth_state()
-        if not auth_state:
-            spawner.log.error("KBase auth_state not found for user.")
-            raise RuntimeError("KBase authentication state is missing.")
-
-        kb_auth_token: str | None = auth_state.get("kbase_token")
-        if not kb_auth_token:
-            spawner.log.error("KBase token not found in auth_state.")
-            raise RuntimeError("KBase authentication token is missing from auth_state.")
-        return kb_auth_token
+    def _reconcile(
+        status: dict | None, shape: ClusterShape, recorded: list | None
+    ) -> ClusterReconcileResult:
+        """
+        Decide whether the user's existing cluster can be adopted for a spawn.
+        :param status: the cluster status from the cluster manager, or None if there is no
+            cluster.
+        :param shape: the shape the spawn needs.
+        :param recorded: the shape recorded in auth_state when the cluster was created.
+        """
+        if status is None:
+            return ClusterReconcileResult.missing
+        if not is_cluster_ready(status, shape.worker_count):
+            return ClusterReconcileResult.unhealthy
+        if recorded is None or ClusterShape(*recorded) != shape:
+            return ClusterReconcileResult.mismatched
+        return ClusterReconcileResult.adopted
+
+    # Concurrent requests for the same user's cluster share a single create
+    _provisioning = SingleFlight()
 
     @staticmethod
     async def start_spark_cluster(spawner):
         """
-        Create a Spark cluster for the user.
+        Create a Spark cluster for the user, or adopt the user's existing cluster if it is
+        healthy and has the shape the spawn needs. The shape is set by the user's profile and
+        options, see `berdl.config.profiles`.
+
+        Profiles with lazy provisioning skip the cluster; instead the notebook is told where to
+        request one, see `SparkClusterAPIHandler`.
         """
+        mode = spark_provisioning(spawner)
+        spawner.environment["BERDL_SPARK_PROVISIONING"] = mode
+        spawner.environment["BERDL_SPARK_READINESS_POLICY"] = spark_readiness.policy
+        spawner.environment["BERDL_SPARK_CLUSTER_API_URL"] = (
+            f"{spawner.hub.api_url.rstrip('/')}"
+            f"/berdl/users/{spawner.user.name}/spark-cluster"
+        )
+        # reject an invalid shape at spawn, even if the cluster is created later
+        shape = spark_shape(spawner)
+        if mode == LAZY:
+            spawner.log.info(
+                f"Skipping Spark cluster for user {spawner.user.name}, provisioned on demand"
+            )
+            spawner.environment.pop("SPARK_MASTER_URL", None)
+            return
+        spawner.environment["SPARK_MASTER_URL"] = (
+            await SparkClusterManager.ensure_spark_cluster(spawner)
+        )
+        # the cluster starts up while the pod does
+        spark_readiness.watch(
+            spawner, (await SpawnContext.get(spawner)).kbase_token, shape.worker_count
+        )
+
+    @staticmethod
+    async def ensure_spark_cluster(spawner: Any) -> str:
+        """
+        Get a Spark cluster for the user's server: a warm cluster, the user's existing cluster
+        if it can be adopted, or a new cluster.
+        Concurrent calls for the same user share a single create.
+        :param spawner: the spawner of the user's server.
+        :returns: the master URL of the cluster.
+        """
+        return await SparkClusterManager._provisioning.do(
+            spawner.user.name, lambda: SparkClusterManager._ensure_spark_cluster(spawner)
+        )
+
+    @staticmethod
+    async def scale_spark_cluster(spawner: Any, worker_count: int) -> str | None:
+        """
+        Recreate the user's Spark cluster with a different number of workers, e.g. none while
+        the notebook is idle. The cluster manager has no API to resize a cluster, so this is a
+        create with the spawn's shape and the new worker count; the master keeps its URL.
+
+        Shares the single flight of `ensure_spark_cluster`, so a scale never races a create of
+        the same user's cluster: a scale that arrives while one is in flight joins it instead.
+        A later `ensure_spark_cluster` finds the cluster short of workers and recreates it with
+        the spawn's shape.
+        :param spawner: the spawner of the user's server.
+        :param worker_count: the number of workers.
+        :returns: the master URL of the cluster, or None if the server has stopped and its
+            cluster is queued for deletion.
+        """
+        return await SparkClusterManager._provisioning.do(
+            spawner.user.name,
+            lambda: SparkClusterManager._scale_spark_cluster(spawner, worker_count),
+        )
+
+    @staticmethod
+    async def _scale_spark_cluster(spawner: Any, worker_count: int) -> str | None:
         username = spawner.user.name
-        kb_auth_token = await SparkClusterManager._get_auth_token(spawner)
-        try:
-            spawner.log.info(f"Creating Spark cluster for user {username}")
-            response = cluster.create_cluster(
-                kbase_auth_token=kb_auth_token, force=True
+        # never bring back a cluster the post-stop hook is deleting
+        if spark_teardown.queued(username):
+            spawner.log.info(
+                f"Not scaling Spark cluster for user {username}, it is being deleted"
+            )
+            return None
+        kb_auth_token = (await SpawnContext.get(spawner)).kbase_token
+        shape = spark_shape(spawner)._replace(worker_count=worker_count)
+        spawner.log.info(
+            f"Scaling Spark cluster for user {username} to {worker_count} workers"
+        )
+        async with spark_admission.slot(username):
+            response = await cluster.create_cluster_async(
+                kbase_auth_token=kb_auth_token, **shape._asdict()
             )
+        master_url = getattr(response, "master_url", None)
+        if not master_url:
+            raise ValueError(f"Master URL not found in response: {response}")
+        return master_url
 
-            master_url = getattr(response, "master_url", None)
-            if master_url:
+    @staticmethod
+    async def _ensure_spark_cluster(spawner: Any) -> str:
+        username = spawner.user.name
+        context = await SpawnContext.get(spawner)
+        kb_auth_token = context.kbase_token
+        # don't let the delete queued by the previous stop remove the cluster of this spawn
+        await spark_teardown.settle(username)
+        try:
+            shape = spark_shape(spawner)
+            response = await spark_warm_pool.take(username, kb_auth_token, shape)
+            if response:
+                master_url = await SparkClusterManager._check_warm_cluster(
+                    spawner, kb_auth_token, response.master_url
+                )
+            else:
+                master_url = await SparkClusterManager._adopt_cluster(
+                    spawner, context, shape
+                )
+            if not master_url:
+                spawner.log.info(f"Creating Spark cluster for user {username}")
+                async with spark_admission.slot(
+                    username,
+                    on_position=lambda p: publish(
+                        spawner, f"Waiting to create Spark cluster, position {p} in queue"
+                    ),
+                ):
+                    with observe_duration(
+                        SPARK_CLUSTER_CREATE_DURATION_SECONDS,
+                        profile=profile_label(spawner),
+                    ):
+                        response = await cluster.create_cluster_async(
+                            kbase_auth_token=kb_auth_token, **shape._asdict()
+                        )
+                master_url = getattr(response, "master_url", None)
+                if not master_url:
+                    raise ValueError(f"Master URL not found in response: {response}")
                 spawner.log.info(f"Spark cluster created with master URL: {master_url}")
-                spawner.environment["SPARK_MASTER_URL"] = master_url
 
-            else:
-                raise ValueError(f"Master URL not found in response: {response}")
+            if context.auth_state.get(AUTH_STATE_SHAPE_KEY) != list(shape):
+                context.auth_state[AUTH_STATE_SHAPE_KEY] = list(shape)
+                await update_auth_state(
+                    spawner.user, {AUTH_STATE_SHAPE_KEY: list(shape)}
+                )
+            return master_url
 
         except Exception as e:
             spawner.log.error(
@@ -52,17 +192,83 @@ class SparkClusterManager:
             )
             raise
 
+    @staticmethod
+    async def _check_warm_cluster(
+        spawner: Any, kb_auth_token: str, master_url: str
+    ) -> str | None:
+        """
+        Check that the user's warm cluster still exists, since it may have been deleted, e.g. by
+        the orphan reaper, after it was created.
+        :returns: the master URL of the cluster, or None if a cluster must be created.
+        """
+        username = spawner.user.name
+        try:
+            status = await cluster.get_cluster_status_async(
+                kbase_auth_token=kb_auth_token
+            )
+        except Exception:
+            spawner.log.warning(
+                f"Failed to get warm Spark cluster status for user {username}",
+                exc_info=True,
+            )
+            return None
+        if not status or status.get("error") or status.get("master_url") != master_url:
+            spawner.log.info(f"Warm Spark cluster for user {username} is gone")
+            return None
+        spawner.log.info(f"Attached warm Spark cluster for user {username}")
+        return master_url
+
+    @staticmethod
+    async def _adopt_cluster(
+        spawner: Any, context: SpawnContext, shape: ClusterShape
+    ) -> str | None:
+        """
+        Check the user's existing cluster.
+        :returns: the master URL of the cluster if it can be adopted, or None if a cluster must
+            be created.
+        """
+        username = spawner.user.name
+        try:
+            status = await login_prefetch.take(
+                SPARK_STATUS, username, context.kbase_token
+            ) or await cluster.get_cluster_status_async(
+                kbase_auth_token=context.kbase_token
+            )
+            result = SparkClusterManager._reconcile(
+                status,
+                shape,
+                context.auth_state.get(AUTH_STATE_SHAPE_KEY),
+            )
+        except Exception:
+            spawner.log.warning(
+                f"Failed to get Spark cluster status for user {username}", exc_info=True
+            )
+            status, result = None, ClusterReconcileResult.unknown
+        SPARK_CLUSTER_RECONCILE_RESULTS.labels(
+            result=result, profile=profile_label(spawner)
+        ).inc()
+        if result != ClusterReconcileResult.adopted:
+            spawner.log.info(f"Not adopting Spark cluster for user {username}: {result}")
+            return None
+        spawner.log.info(
+            f"Adopted existing Spark cluster for user {username}: {status['master_url']}"
+        )
+        return status["master_url"]
+
     @staticmethod
     async def stop_spark_cluster(spawner):
         """
-        Delete the Spark cluster for the user.
+        Queue the deletion of the user's Spark cluster. Returns without waiting for the delete,
+        see `berdl.config.spark_teardown`.
+        The KBase token is read again, since the one loaded for the spawn may have been replaced
+        by a later login while the server ran.
         """
         username = spawner.user.name
+        spark_readiness.cancel(spawner)
         try:
-            kb_auth_token = await SparkClusterManager._get_auth_token(spawner)
-            spawner.log.info(f"Deleting Spark cluster for user {username}")
-            cluster.delete_cluster(kbase_auth_token=kb_auth_token)
-            spawner.log.info(f"Spark cluster deleted for user {username}")
+            kb_auth_token = (await SpawnContext.load(spawner)).kbase_token
+            spawner.log.info(f"Queueing deletion of Spark cluster for user {username}")
+            spark_teardown.enqueue(username, kb_auth_token, profile_label(spawner))
         except Exception as e:
             spawner.log.error(
                 f"Error deleting Spark cluster for user {username}: {str(e)}"
@@ -0,0 +1,191 @@
+"""
+A pool of Spark clusters created ahead of the spawns that will use them.
+
+The Spark Cluster Manager creates each cluster for the user whose token made the request, and a
+cluster cannot be handed to a different user. The pool is therefore filled per user: when a user
+logs in and a slot is free, a cluster is created for them in the background, with the shape of
+the profile and options of their last spawn, or of the default profile. Users whose profile
+provisions Spark lazily get no warm cluster. When they spawn, the warm cluster is attached
+instead of provisioning a new one if it has the shape the spawn needs. A warm cluster that is not
+claimed within the TTL is deleted, which frees its slot for the next login. Until then, the
+user's auth_state records the cluster as warm, so that the orphan reaper leaves it alone.
+
+Warm clusters are created through the same admission controller as spawns, so a burst of logins
+does not overload the cluster manager.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, NamedTuple
+
+from berdl.auth.token_cache import hash_token
+from berdl.clients.spark import cluster
+from berdl.clients.spark.cluster import AUTH_STATE_WARM_UNTIL_KEY, ClusterShape
+from berdl.config.admission import spark_admission
+from berdl.config.profiles import LAZY, spark_provisioning, spark_shape
+from berdl.config.spark_teardown import spark_teardown
+from berdl.metrics import (
+    SPARK_WARM_POOL_CLUSTERS,
+    SPARK_WARM_POOL_RESULTS,
+    WarmPoolResult,
+)
+
+logger = logging.getLogger(__name__)
+
+WARM_POOL_SIZE = int(os.environ.get("BERDL_SPARK_WARM_POOL_SIZE", 0))
+WARM_POOL_TTL = float(os.environ.get("BERDL_SPARK_WARM_POOL_TTL_SECONDS", 900))
+
+
+class _WarmCluster(NamedTuple):
+    token: str
+    shape: ClusterShape
+    created: float
+    task: asyncio.Task  # resolves to the create response
+
+
+class SparkWarmPool:
+    """
+    Holds up to `size` Spark clusters created for users who are likely to spawn soon.
+    """
+
+    def __init__(self, size: int = WARM_POOL_SIZE, ttl: float = WARM_POOL_TTL):
+        """
+        Create the pool.
+        :param size: the maximum number of warm clusters. 0 disables the pool.
+        :param ttl: the number of seconds a warm cluster waits to be claimed before it is
+            deleted.
+        """
+        self.size = size
+        self.ttl = ttl
+        self._profile_list: Any = []
+        self._warm: Dict[str, _WarmCluster] = {}
+
+    def use_profiles(self, profile_list: Any) -> None:
+        """
+        Set the profiles the shapes of warm clusters are taken from.
+        :param profile_list: the KubeSpawner profile_list.
+        """
+        self._profile_list = profile_list
+
+    def shape_for(self, user_options: dict | None) -> ClusterShape | None:
+        """
+        Get the shape of the cluster a spawn with the given options would need.
+        :param user_options: the options of the user's last spawn, or None to use the default
+            profile.
+        :returns: the shape, or None if the spawn would not create a cluster up front or its
+            options are invalid.
+        """
+        spawner = SimpleNamespace(
+            profile_list=self._profile_list, user_options=user_options or {}
+        )
+        try:
+            if spark_provisioning(spawner) == LAZY:
+                return None
+            return spark_shape(spawner)
+        except ValueError as e:
+            logger.info("Not warming a Spark cluster for options %s: %s", user_options, e)
+            return None
+
+    def provision(self, username: str, token: str, shape: ClusterShape) -> bool:
+        """
+        Start creating a warm cluster for a user if there is a free slot.
+        :param username: the user.
+        :param token: the user's KBase token.
+        :param shape: the shape of the cluster, see `shape_for`.
+        :returns: True if a cluster is being created.
+        """
+        if username in self._warm or len(self._warm) >= self.size:
+            return False
+        task = asyncio.ensure_future(self._create(username, token, shape))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        warm = _WarmCluster(token, shape, time.monotonic(), task)
+        self._warm[username] = warm
+        SPARK_WARM_POOL_CLUSTERS.set(len(self._warm))
+        asyncio.get_running_loop().call_later(
+            self.ttl, lambda: asyncio.ensure_future(self._expire(username, warm))
+        )
+        logger.info("Creating warm Spark cluster for user %s", username)
+        return True
+
+    async def _create(self, username: str, token: str, shape: ClusterShape) -> Any:
+        async with spark_admission.slot(username):
+            return await cluster.create_cluster_async(
+                kbase_auth_token=token, **shape._asdict()
+            )
+
+    async def take(self, username: str, token: str, shape: ClusterShape) -> Any | None:
+        """
+        Claim the user's warm cluster, waiting for it if it is still being created.
+        :param username: the user.
+        :param token: the user's current KBase token.
+        :param shape: the shape of cluster the spawn needs.
+        :returns: the create response of the warm cluster, or None if the user has no usable
+            warm cluster and a cluster must be created.
+        """
+        warm = self._warm.pop(username, None)
+        SPARK_WARM_POOL_CLUSTERS.set(len(self._warm))
+        if (
+            warm is None
+            or warm.shape != shape
+            or hash_token(warm.token) != hash_token(token)
+        ):
+            SPARK_WARM_POOL_RESULTS.labels(result=WarmPoolResult.cold).inc()
+            return None
+        try:
+            response = await asyncio.shield(warm.task)
+        except Exception:
+            logger.warning(
+                "Warm Spark cluster for user %s failed", username, exc_info=True
+            )
+            SPARK_WARM_POOL_RESULTS.labels(result=WarmPoolResult.cold).inc()
+            return None
+        if not getattr(response, "master_url", None):
+            SPARK_WARM_POOL_RESULTS.labels(result=WarmPoolResult.cold).inc()
+            return None
+        SPARK_WARM_POOL_RESULTS.labels(result=WarmPoolResult.hit).inc()
+        return response
+
+    async def _expire(self, username: str, warm: _WarmCluster) -> None:
+        # wait for the create first, the user may still claim the cluster in the meantime
+        created = True
+        try:
+            await asyncio.shield(warm.task)
+        except Exception:
+            created = False
+        if self._warm.get(username) is not warm:
+            return  # already claimed, or replaced
+        del self._warm[username]
+        SPARK_WARM_POOL_CLUSTERS.set(len(self._warm))
+        SPARK_WARM_POOL_RESULTS.labels(result=WarmPoolResult.expired).inc()
+        if created:
+            logger.info("Deleting unclaimed warm Spark cluster for user %s", username)
+            spark_teardown.enqueue(username, warm.token)
+
+
+spark_warm_pool = SparkWarmPool()
+
+
+async def warm_pool_post_auth_hook(
+    authenticator: Any, handler: Any, authentication: dict
+):
+    """
+    A JupyterHub post_auth_hook that creates a warm Spark cluster for the user if the pool has
+    a free slot, shaped for the user's last spawn.
+    """
+    token = (authentication.get("auth_state") or {}).get("kbase_token")
+    user = handler.find_user(authentication["name"]) if handler else None
+    # Creating a cluster replaces the user's existing one, so never touch a running server's
+    if not token or (user and user.active):
+        return authentication
+    shape = spark_warm_pool.shape_for(user.spawner.user_options if user else None)
+    if shape is not None and spark_warm_pool.provision(
+        authentication["name"], token, shape
+    ):
+        # saved by the hub with the rest of the auth_state after the hook
+        authentication["auth_state"][AUTH_STATE_WARM_UNTIL_KEY] = (
+            time.time() + spark_warm_pool.ttl
+        )
+    return authentication
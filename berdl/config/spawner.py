@@ -0,0 +1,60 @@
+"""
+The KubeSpawner used by the BERDL hub.
+"""
+
+import asyncio
+
+from kubespawner import KubeSpawner
+
+from berdl.config.progress import SpawnProgress
+from berdl.config.spark_readiness import spark_readiness
+
+
+class BERDLKubeSpawner(KubeSpawner):
+    """
+    A KubeSpawner that reports the progress of the BERDL hooks along with the pod events, and
+    can hold the spawn until the user's Spark cluster is ready.
+
+    It is configured through the KubeSpawner config section like the plain KubeSpawner.
+    """
+
+    async def start(self):
+        url = await super().start()
+        # the pod is up; by now the Spark cluster has had the pod's startup time to get ready
+        await spark_readiness.wait(self)
+        return url
+
+    async def progress(self):
+        """
+        Merge the BERDL progress events of the spawn with KubeSpawner's pod events.
+        The merged progress never goes backwards.
+        """
+        stream = SpawnProgress.get(self)
+        pod_events = []
+
+        async def pump():
+            async for event in super(BERDLKubeSpawner, self).progress():
+                pod_events.append(event)
+                stream.notify()
+
+        pump_task = asyncio.ensure_future(pump())
+        progress = 0
+        next_event = next_pod_event = 0
+        try:
+            # pod events end when the pod is ready, the spawn may still be waiting on Spark
+            while not pump_task.done() or self.pending == "spawn":
+                for event in stream.events[next_event:]:
+                    # BERDL events don't know how far along the spawn is, so they move the bar
+                    # a little closer to where the pod events start
+                    progress = max(
+                        progress, event.get("progress", progress + (30 - progress) / 4)
+                    )
+                    yield {**event, "progress": int(progress)}
+                next_event = len(stream.events)
+                for event in pod_events[next_pod_event:]:
+                    progress = max(progress, event.get("progress", progress))
+                    yield {**event, "progress": int(progress)}
+                next_pod_event = len(pod_events)
+                await stream.wait(1)
+        finally:
+            pump_task.cancel()
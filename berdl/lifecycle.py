@@ -0,0 +1,42 @@
+"""
+Hooks for releasing long lived resources when the hub shuts down.
+
+JupyterHub has no shutdown hook for authenticators or spawner hooks, but on shutdown it cancels
+every pending task on the event loop and waits for them to finish. A sentinel task is parked on
+the loop and runs the registered callbacks when it is cancelled.
+"""
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, List
+
+logger = logging.getLogger(__name__)
+
+_callbacks: List[Callable[[], Awaitable[None]]] = []
+_sentinel: asyncio.Task | None = None
+
+
+def on_shutdown(callback: Callable[[], Awaitable[None]]) -> None:
+    """
+    Register a coroutine function to be awaited when the hub shuts down.
+    Callbacks are run in reverse order of registration.
+    Must be called while the hub's event loop is running.
+    :param callback: the coroutine function to call.
+    """
+    global _sentinel
+    _callbacks.append(callback)
+    if _sentinel is None or _sentinel.done():
+        _sentinel = asyncio.get_running_loop().create_task(_wait_for_shutdown())
+
+
+async def _wait_for_shutdown() -> None:
+    try:
+        await asyncio.Event().wait()
+    except asyncio.CancelledError:
+        while _callbacks:
+            callback = _callbacks.pop()
+            try:
+                await callback()
+            except Exception:
+                logger.exception("Error running shutdown callback %s", callback)
+        raise
@@ -0,0 +1,460 @@
+"""
+Prometheus metrics exported by the BERDL hub extensions.
+
+The metrics are registered with the default prometheus_client registry, so they are served by
+the hub's existing `/hub/metrics` endpoint alongside JupyterHub's own metrics.
+Names follow the JupyterHub convention of `<noun>_<verb>_<type_suffix>`, with a `berdl_` prefix.
+"""
+
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from enum import Enum
+from typing import Any
+
+import httpx
+from prometheus_client import Counter, Gauge, Histogram
+
+metrics_prefix = os.getenv("BERDL_METRICS_PREFIX", "berdl")
+
+# Auth2 requests and in-hub work are expected to be fast, so these buckets are finer than
+# JupyterHub's spawn buckets
+request_duration_buckets = [
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    float("inf"),
+]
+
+# Spawn steps wait on Kubernetes, so use the same buckets as JupyterHub's spawn duration
+spawn_duration_buckets = [
+    0.1,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    15,
+    30,
+    60,
+    120,
+    180,
+    300,
+    600,
+    float("inf"),
+]
+
+# Errors reported with the 'timeout' status rather than 'failure'
+_TIMEOUT_ERRORS = (asyncio.TimeoutError, httpx.TimeoutException)
+
+
+class AuthRequestStatus(Enum):
+    """
+    Possible values for 'status' label of AUTH_REQUEST_DURATION_SECONDS
+    """
+
+    success = "success"
+    invalid_token = "invalid-token"
+    failure = "failure"
+    timeout = "timeout"
+    rejected = "rejected"  # by the open circuit breaker
+
+    def __str__(self):
+        return self.value
+
+
+class TokenCacheResult(Enum):
+    """
+    Possible values for 'result' label of TOKEN_CACHE_LOOKUPS
+    """
+
+    hit = "hit"
+    negative_hit = "negative-hit"
+    miss = "miss"
+    stale = "stale"  # served from an expired entry while the auth server is unavailable
+
+    def __str__(self):
+        return self.value
+
+
+AUTH_REQUEST_DURATION_SECONDS = Histogram(
+    "auth_request_duration_seconds",
+    "Time spent waiting on the KBase auth server",
+    ["status"],
+    buckets=request_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+for s in AuthRequestStatus:
+    AUTH_REQUEST_DURATION_SECONDS.labels(status=s)
+
+AUTH_CIRCUIT_BREAKER_STATE = Gauge(
+    "auth_circuit_breaker_state",
+    "State of the KBase auth server circuit breaker: 0 closed, 1 half open, 2 open",
+    namespace=metrics_prefix,
+)
+
+TOKEN_CACHE_LOOKUPS = Counter(
+    "token_cache_lookups",
+    "Number of KBase token cache lookups",
+    ["result"],
+    namespace=metrics_prefix,
+)
+
+for r in TokenCacheResult:
+    TOKEN_CACHE_LOOKUPS.labels(result=r)
+
+TOKEN_CACHE_EVICTIONS = Counter(
+    "token_cache_evictions",
+    "Number of KBase token cache entries evicted to stay within the size limit",
+    namespace=metrics_prefix,
+)
+
+AUTH_LOOKUPS_DEDUPLICATED = Counter(
+    "auth_lookups_deduplicated",
+    "Number of token lookups that joined an identical in flight request to the auth server",
+    namespace=metrics_prefix,
+)
+
+
+class CredentialsCacheResult(Enum):
+    """
+    Possible values for 'result' label of GOVERNANCE_CREDENTIALS_CACHE_LOOKUPS
+    """
+
+    hit = "hit"
+    miss = "miss"
+
+    def __str__(self):
+        return self.value
+
+
+class PrefetchResult(Enum):
+    """
+    Possible values for 'result' label of PREFETCH_RESULTS
+    """
+
+    hit = "hit"
+    miss = "miss"
+    expired = "expired"  # too old, or fetched with a different token
+    failure = "failure"
+
+    def __str__(self):
+        return self.value
+
+
+class WarmPoolResult(Enum):
+    """
+    Possible values for 'result' label of SPARK_WARM_POOL_RESULTS
+    """
+
+    hit = "hit"
+    cold = "cold"  # the spawn had to create a cluster
+    expired = "expired"  # a warm cluster was deleted without being claimed
+
+    def __str__(self):
+        return self.value
+
+
+class ClusterReconcileResult(Enum):
+    """
+    Possible values for 'result' label of SPARK_CLUSTER_RECONCILE_RESULTS
+    """
+
+    adopted = "adopted"  # the existing cluster was reused, no create
+    missing = "missing"
+    unhealthy = "unhealthy"
+    mismatched = "mismatched"  # a different shape than the spawn needs
+    unknown = "unknown"  # the status could not be retrieved
+
+    def __str__(self):
+        return self.value
+
+
+class TeardownResult(Enum):
+    """
+    Possible values for 'result' label of SPARK_TEARDOWN_RESULTS
+    """
+
+    success = "success"
+    failure = "failure"  # all retries failed, left to the reaper
+    cancelled = "cancelled"  # the user spawned again before the delete ran
+
+    def __str__(self):
+        return self.value
+
+
+class PlacementDecision(Enum):
+    """
+    Possible values for 'decision' label of NOTEBOOK_PLACEMENT_DECISIONS
+    """
+
+    home = "home"  # the node with the user's home directory had room
+    new = "new"  # the user had no home directory, the least loaded node was chosen
+    migrated = "migrated"  # the home node was full, the home was moved to another node
+    full = "full"  # the home node was full and could not be left, the pod waits for room
+
+    def __str__(self):
+        return self.value
+
+
+class OperationStatus(Enum):
+    """
+    Possible values for 'status' label of the spawn phase metrics
+    """
+
+    success = "success"
+    failure = "failure"
+    timeout = "timeout"
+
+    def __str__(self):
+        return self.value
+
+
+class PreSpawnStatus(Enum):
+    """
+    Possible values for 'status' label of PRE_SPAWN_HOOK_DURATION_SECONDS
+    """
+
+    success = "success"
+    degraded = "degraded"  # a non critical step failed
+    failure = "failure"
+
+    def __str__(self):
+        return self.value
+
+
+def profile_label(spawner: Any) -> str:
+    """
+    Get the value for the 'profile' label of a spawner: the slug of the profile the user
+    selected if the spawner's profile_list has it, 'default' if the user selected none, and
+    'other' otherwise. KubeSpawner only validates the selected profile once the pod starts, after
+    the hooks, so the slug is checked here to keep the label's values bounded.
+    """
+    user_options = getattr(spawner, "user_options", None) or {}
+    slug = user_options.get("profile")
+    if not slug:
+        return "default"
+    profiles = getattr(spawner, "profile_list", None)
+    if isinstance(profiles, list) and any(
+        isinstance(profile, dict) and profile.get("slug") == slug for profile in profiles
+    ):
+        return str(slug)
+    return "other"
+
+
+@contextmanager
+def observe_duration(histogram: Histogram, **labels):
+    """
+    Observe the duration of the enclosed block in a histogram with a 'status' label, in
+    addition to the given labels. The status is derived from the exception, if any.
+    """
+    status = OperationStatus.failure
+    start = time.perf_counter()
+    try:
+        yield
+        status = OperationStatus.success
+    except _TIMEOUT_ERRORS:
+        status = OperationStatus.timeout
+        raise
+    finally:
+        histogram.labels(status=status, **labels).observe(time.perf_counter() - start)
+
+
+AUTH_STATE_LOAD_DURATION_SECONDS = Histogram(
+    "auth_state_load_duration_seconds",
+    "Time spent loading and decrypting a user's auth_state for a spawn",
+    ["status"],
+    buckets=request_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+GOVERNANCE_CREDENTIALS_DURATION_SECONDS = Histogram(
+    "governance_credentials_duration_seconds",
+    "Time spent fetching MinIO credentials from the governance API",
+    ["status", "profile"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+GOVERNANCE_CREDENTIALS_CACHE_LOOKUPS = Counter(
+    "governance_credentials_cache_lookups",
+    "Number of lookups of MinIO credentials cached in auth_state",
+    ["result"],
+    namespace=metrics_prefix,
+)
+
+for r in CredentialsCacheResult:
+    GOVERNANCE_CREDENTIALS_CACHE_LOOKUPS.labels(result=r)
+
+SPARK_CLUSTER_CREATE_DURATION_SECONDS = Histogram(
+    "spark_cluster_create_duration_seconds",
+    "Time spent creating a Spark cluster through the cluster manager API",
+    ["status", "profile"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+SPARK_CLUSTER_DELETE_DURATION_SECONDS = Histogram(
+    "spark_cluster_delete_duration_seconds",
+    "Time spent deleting a Spark cluster through the cluster manager API",
+    ["status", "profile"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+SPARK_CLUSTER_READY_DURATION_SECONDS = Histogram(
+    "spark_cluster_ready_duration_seconds",
+    "Time from creating or adopting a Spark cluster until its master and workers are ready",
+    ["status", "profile"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+MODIFY_POD_HOOK_DURATION_SECONDS = Histogram(
+    "modify_pod_hook_duration_seconds",
+    "Time spent in the KubeSpawner modify_pod_hook",
+    ["status", "profile"],
+    buckets=request_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+PRE_SPAWN_HOOK_DURATION_SECONDS = Histogram(
+    "pre_spawn_hook_duration_seconds",
+    "Time spent in the KubeSpawner pre_spawn_hook",
+    ["status", "profile", "failed_step"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+HOOK_STEP_DURATION_SECONDS = Histogram(
+    "hook_step_duration_seconds",
+    "Time spent in each step of the spawner hook pipelines",
+    ["pipeline", "step", "status", "profile"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+HOOK_STEP_FAILURES = Counter(
+    "hook_step_failures",
+    "Number of failed steps in the spawner hook pipelines",
+    ["pipeline", "step", "profile"],
+    namespace=metrics_prefix,
+)
+
+PREFETCH_RESULTS = Counter(
+    "prefetch_results",
+    "Number of spawns that looked for work prefetched at login, by outcome",
+    ["kind", "result"],
+    namespace=metrics_prefix,
+)
+
+SPARK_WARM_POOL_RESULTS = Counter(
+    "spark_warm_pool_results",
+    "Number of Spark clusters attached from the warm pool, created cold, or expired unclaimed",
+    ["result"],
+    namespace=metrics_prefix,
+)
+
+for r in WarmPoolResult:
+    SPARK_WARM_POOL_RESULTS.labels(result=r)
+
+SPARK_WARM_POOL_CLUSTERS = Gauge(
+    "spark_warm_pool_clusters",
+    "Number of warm Spark clusters waiting to be claimed",
+    namespace=metrics_prefix,
+)
+
+SPARK_CLUSTER_RECONCILE_RESULTS = Counter(
+    "spark_cluster_reconcile_results",
+    "Number of spawns that checked the user's existing Spark cluster, by whether it was adopted or why it was recreated",
+    ["result", "profile"],
+    namespace=metrics_prefix,
+)
+
+SPARK_TEARDOWN_RESULTS = Counter(
+    "spark_teardown_results",
+    "Number of queued Spark cluster deletions, by outcome",
+    ["result"],
+    namespace=metrics_prefix,
+)
+
+for r in TeardownResult:
+    SPARK_TEARDOWN_RESULTS.labels(result=r)
+
+SPARK_TEARDOWN_PENDING = Gauge(
+    "spark_teardown_pending",
+    "Number of Spark clusters queued for deletion or being deleted",
+    namespace=metrics_prefix,
+)
+
+ADMISSION_WAIT_DURATION_SECONDS = Histogram(
+    "admission_wait_duration_seconds",
+    "Time spent waiting for admission to a spawn phase or downstream service",
+    ["controller"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+ADMISSION_LIMIT = Gauge(
+    "admission_limit",
+    "Current number of concurrent callers admitted by each admission controller",
+    ["controller"],
+    namespace=metrics_prefix,
+)
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "admission_in_flight",
+    "Number of callers currently admitted by each admission controller",
+    ["controller"],
+    namespace=metrics_prefix,
+)
+
+ADMISSION_QUEUE_LENGTH = Gauge(
+    "admission_queue_length",
+    "Number of callers waiting for each admission controller",
+    ["controller"],
+    namespace=metrics_prefix,
+)
+
+IMAGE_RESOLVE_DURATION_SECONDS = Histogram(
+    "image_resolve_duration_seconds",
+    "Time spent resolving a profile image's tag to a digest with its registry",
+    ["status"],
+    buckets=request_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+IMAGE_PREPULL_DURATION_SECONDS = Histogram(
+    "image_prepull_duration_seconds",
+    "Time spent pulling a newly pinned image onto a notebook node",
+    ["status"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
+
+NOTEBOOK_PLACEMENT_DECISIONS = Counter(
+    "notebook_placement_decisions",
+    "Number of notebook pods placed on a node, by how the node was chosen",
+    ["decision"],
+    namespace=metrics_prefix,
+)
+
+for r in PlacementDecision:
+    NOTEBOOK_PLACEMENT_DECISIONS.labels(decision=r)
+
+HOME_MIGRATION_DURATION_SECONDS = Histogram(
+    "home_migration_duration_seconds",
+    "Time spent copying a home directory to a node with room for the user's notebook",
+    ["status"],
+    buckets=spawn_duration_buckets,
+    namespace=metrics_prefix,
+)
@@ -0,0 +1,82 @@
+"""
+A minimal client for the JupyterHub REST API, for the BERDL hub services.
+"""
+
+from datetime import datetime
+from typing import AsyncIterator
+
+import httpx
+
+
+def parse_timestamp(value: str | None) -> datetime | None:
+    """
+    Parse a timestamp from the hub's API, e.g. a last_activity, into an aware datetime.
+    """
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class HubClient:
+    """
+    Makes requests to the hub's REST API with the service's token.
+    """
+
+    def __init__(self, api_url: str, api_token: str):
+        """
+        Create the client.
+        :param api_url: the hub's API URL, e.g. JUPYTERHUB_API_URL.
+        :param api_token: the service's API token, e.g. JUPYTERHUB_API_TOKEN.
+        """
+        self._client = httpx.AsyncClient(
+            base_url=api_url.rstrip("/") + "/",
+            headers={"Authorization": f"token {api_token}"},
+            timeout=30,
+        )
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+    async def users(self, state: str) -> AsyncIterator[dict]:
+        """
+        Page through the hub's users.
+        :param state: 'active', 'inactive' or 'ready', see the hub's GET /users.
+        """
+        params = {"state": state, "offset": 0, "limit": 200}
+        while True:
+            response = await self._client.get(
+                "users",
+                params=params,
+                headers={"Accept": "application/jupyterhub-pagination+json"},
+            )
+            response.raise_for_status()
+            page = response.json()
+            for user in page["items"]:
+                yield user
+            next_page = page["_pagination"]["next"]
+            if not next_page:
+                return
+            params["offset"] = next_page["offset"]
+
+    async def user(self, name: str) -> dict:
+        """
+        Get a user's model, including their auth_state if the service may read it.
+        """
+        response = await self._client.get(f"users/{name}")
+        response.raise_for_status()
+        return response.json()
+
+    async def spark_cluster(self, name: str, worker_count: int | None = None) -> dict:
+        """
+        Ask the hub for the Spark cluster of a user's server, see `SparkClusterAPIHandler`.
+        :param name: the user.
+        :param worker_count: the number of workers to scale the cluster to, or None to get a
+            cluster with the shape the server was spawned with, creating it if necessary.
+        :returns: the response, with the cluster's master URL.
+        """
+        body = {} if worker_count is None else {"worker_count": worker_count}
+        response = await self._client.post(
+            f"berdl/users/{name}/spark-cluster", json=body
+        )
+        response.raise_for_status()
+        return response.json()
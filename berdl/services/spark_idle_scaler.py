@@ -0,0 +1,191 @@
+"""
+A JupyterHub service that frees the Spark workers of idle notebooks long before the idle culler
+stops the notebooks themselves.
+
+A user's cluster is considered idle when both
+    the notebook server has had no activity, as reported to the hub, which includes time spent
+        running cells and so the Spark jobs they submit, and
+    the Spark master has seen no application start or finish,
+for longer than `--idle-timeout`. The cluster is then recreated with no workers. The cluster
+manager has no API to resize a cluster, so scaling is a create with the same shape and a
+different worker count; the master keeps its URL but SparkSessions must reconnect.
+
+Scaling goes through the hub's spark-cluster endpoint rather than the cluster manager, so that it
+never races the hub creating or deleting the same cluster, see
+`SparkClusterManager.scale_spark_cluster`.
+
+Workers come back when the notebook is active again, on the next check, or as soon as the
+notebook requests its cluster from the hub's spark-cluster endpoint, which recreates a cluster
+with too few workers.
+
+Run it as a managed service, see jupyterhub_config.py. It needs the list:users, read:users,
+read:servers, admin:auth_state and custom:berdl:spark scopes.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Tuple
+
+import httpx
+
+from berdl.clients.spark import cluster
+from berdl.clients.spark.cluster import AUTH_STATE_SHAPE_KEY, ClusterShape
+from berdl.services.hub import HubClient, parse_timestamp
+
+logger = logging.getLogger("berdl.spark_idle_scaler")
+
+
+class SparkIdleScaler:
+    """
+    Scales the Spark workers of idle notebooks to zero, and back up when they are active again.
+    """
+
+    def __init__(self, hub: HubClient, idle_timeout: timedelta, concurrency: int = 5):
+        """
+        Create the scaler.
+        :param hub: a client for the hub's API.
+        :param idle_timeout: how long a cluster must be idle before its workers are removed.
+        :param concurrency: the maximum number of users checked at once.
+        """
+        self._hub = hub
+        self._idle_timeout = idle_timeout
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._spark_ui = httpx.AsyncClient(timeout=10)
+        # user -> when their workers were removed
+        self._scaled_down: Dict[str, datetime] = {}
+        # user -> the applications the Spark master reported, and when they last changed
+        self._applications: Dict[str, Tuple[tuple, datetime]] = {}
+
+    async def close(self) -> None:
+        await self._spark_ui.aclose()
+
+    async def _spark_activity(self, name: str, status: dict) -> datetime | None:
+        """
+        Get the last time the user's Spark master saw an application start or finish.
+        Returns None if the master's UI is unavailable.
+        """
+        ui_url = status.get("master_ui_url")
+        if not ui_url:
+            return None
+        try:
+            response = await self._spark_ui.get(f"{ui_url.rstrip('/')}/json/")
+            response.raise_for_status()
+            master = response.json()
+        except (httpx.HTTPError, ValueError):
+            logger.debug("Spark master UI unavailable for user %s", name, exc_info=True)
+            return None
+        applications = (
+            tuple(sorted(app["id"] for app in master.get("activeapps", []))),
+            len(master.get("completedapps", [])),
+        )
+        previous = self._applications.get(name)
+        if previous is None or previous[0] != applications:
+            self._applications[name] = (applications, datetime.now(timezone.utc))
+        return self._applications[name][1]
+
+    async def _check_user(self, user: dict) -> None:
+        name = user["name"]
+        server = (user.get("servers") or {}).get("")
+        if not server or not server.get("ready"):
+            return
+        async with self._semaphore:
+            model = await self._hub.user(name)
+            auth_state = model.get("auth_state") or {}
+            token = auth_state.get("kbase_token")
+            recorded = auth_state.get(AUTH_STATE_SHAPE_KEY)
+            if not token or not recorded:
+                return  # the hub has not created a cluster for this server
+            shape = ClusterShape(*recorded)
+            if shape.worker_count == 0:
+                return
+            now = datetime.now(timezone.utc)
+            last_activity = parse_timestamp(
+                server.get("last_activity") or user.get("last_activity")
+            ) or datetime.fromtimestamp(0, timezone.utc)
+
+            status = await cluster.get_cluster_status_async(kbase_auth_token=token)
+            if status is None:
+                return
+            if not ((status.get("workers") or {}).get("replicas") or 0):
+                # scaled down by this service, possibly before it restarted
+                scaled_down = self._scaled_down.get(name)
+                if (
+                    last_activity > scaled_down
+                    if scaled_down
+                    else now - last_activity < self._idle_timeout
+                ):
+                    logger.info("Notebook of user %s is active, adding Spark workers", name)
+                    await self._hub.spark_cluster(name)
+                    self._scaled_down.pop(name, None)
+                return
+            spark_activity = await self._spark_activity(name, status)
+            idle_since = max(last_activity, spark_activity or last_activity)
+            if now - idle_since < self._idle_timeout:
+                return
+            logger.info(
+                "Spark cluster of user %s idle since %s, removing its workers",
+                name,
+                idle_since.isoformat(),
+            )
+            await self._hub.spark_cluster(name, worker_count=0)
+            self._scaled_down[name] = now
+
+    async def check(self) -> None:
+        """
+        Check the Spark cluster of every user with a running server.
+        """
+        users = [user async for user in self._hub.users("ready")]
+        results = await asyncio.gather(
+            *(self._check_user(user) for user in users), return_exceptions=True
+        )
+        for user, result in zip(users, results):
+            if isinstance(result, Exception):
+                logger.warning(
+                    "Failed to check Spark cluster of user %s: %s", user["name"], result
+                )
+        # forget users whose servers stopped, their clusters are deleted with the server
+        running = {user["name"] for user in users}
+        for state in (self._scaled_down, self._applications):
+            for name in list(state):
+                if name not in running:
+                    del state[name]
+
+
+async def main(args: argparse.Namespace) -> None:
+    hub = HubClient(os.environ["JUPYTERHUB_API_URL"], os.environ["JUPYTERHUB_API_TOKEN"])
+    scaler = SparkIdleScaler(
+        hub, timedelta(seconds=args.idle_timeout), concurrency=args.concurrency
+    )
+    try:
+        while True:
+            try:
+                await scaler.check()
+            except Exception:
+                logger.exception("Spark idle scaling failed")
+            await asyncio.sleep(args.interval)
+    finally:
+        await scaler.close()
+        await hub.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=900,
+        help="Seconds a Spark cluster must be idle before its workers are removed.",
+    )
+    parser.add_argument(
+        "--interval", type=float, default=60, help="Seconds between checks."
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=5, help="Users checked at once."
+    )
+    logging.basicConfig(
+        level=logging.INFO, format="[%(levelname)s %(asctime)s %(name)s] %(message)s"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,154 @@
+"""
+A JupyterHub service that deletes orphaned Spark clusters: clusters of users who have no active
+server, e.g. because a delete failed or the hub stopped with deletes still queued. Clusters the
+hub's warm pool holds for a user who logged in but has not spawned yet are not orphaned, and are
+recognised by the time recorded in the user's auth_state, see `berdl.config.spark_warm_pool`.
+
+The cluster manager has no API to list every cluster, and a cluster can only be deleted with its
+owner's KBase token. So the reaper pages through the hub's inactive users, reads each recently
+active user's token from their auth_state, and checks that user's cluster.
+
+Run it as a managed service, see jupyterhub_config.py. It needs the list:users, read:users,
+read:servers and admin:auth_state scopes. It runs once at startup and then every `--interval`
+seconds.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+from berdl.clients.spark import cluster
+from berdl.clients.spark.cluster import AUTH_STATE_WARM_UNTIL_KEY
+from berdl.services.hub import HubClient, parse_timestamp
+
+logger = logging.getLogger("berdl.spark_reaper")
+
+
+def _in_use(model: dict) -> bool:
+    """Check whether a user's cluster is used by a server, or held by the warm pool."""
+    warm_until = (model.get("auth_state") or {}).get(AUTH_STATE_WARM_UNTIL_KEY)
+    return bool(model.get("servers")) or bool(warm_until and warm_until > time.time())
+
+
+class SparkReaper:
+    """
+    Finds and deletes Spark clusters whose users have no active server.
+    """
+
+    def __init__(
+        self,
+        hub: HubClient,
+        concurrency: int = 5,
+        max_age: timedelta | None = None,
+    ):
+        """
+        Create the reaper.
+        :param hub: a client for the hub's API.
+        :param concurrency: the maximum number of users checked at once.
+        :param max_age: skip users who have not been active for longer than this, since their
+            clusters would have been reaped already. None checks every user.
+        """
+        self._hub = hub
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._max_age = max_age
+
+    def _recently_active(self, user: dict) -> bool:
+        if self._max_age is None:
+            return True
+        last_activity = parse_timestamp(user.get("last_activity"))
+        if not last_activity:
+            return False
+        return datetime.now(timezone.utc) - last_activity < self._max_age
+
+    async def _reap_user(self, name: str) -> bool:
+        """
+        Delete the user's cluster if they have one, no active server and no warm cluster.
+        :returns: True if a cluster was deleted.
+        """
+        async with self._semaphore:
+            model = await self._hub.user(name)
+            token = (model.get("auth_state") or {}).get("kbase_token")
+            if not token or _in_use(model):
+                return False
+            status = await cluster.get_cluster_status_async(kbase_auth_token=token)
+            if status is None:
+                return False
+            # the user may have logged in or started a server while the status was fetched
+            if _in_use(await self._hub.user(name)):
+                return False
+            logger.info("Deleting orphaned Spark cluster of user %s", name)
+            await cluster.delete_cluster_async(kbase_auth_token=token)
+            return True
+
+    async def reap(self) -> int:
+        """
+        Check every recently active user with no active server and delete their cluster.
+        :returns: the number of clusters deleted.
+        """
+        names = [
+            user["name"]
+            async for user in self._hub.users("inactive")
+            if self._recently_active(user)
+        ]
+        results = await asyncio.gather(
+            *(self._reap_user(name) for name in names), return_exceptions=True
+        )
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                # e.g. an expired token; the user's next login and stop cleans up instead
+                logger.warning(
+                    "Failed to reap Spark cluster of user %s: %s", name, result
+                )
+        deleted = sum(result is True for result in results)
+        logger.info(
+            "Checked %s inactive users, deleted %s orphaned Spark clusters",
+            len(names),
+            deleted,
+        )
+        return deleted
+
+
+async def main(args: argparse.Namespace) -> None:
+    hub = HubClient(os.environ["JUPYTERHUB_API_URL"], os.environ["JUPYTERHUB_API_TOKEN"])
+    reaper = SparkReaper(
+        hub,
+        concurrency=args.concurrency,
+        max_age=timedelta(days=args.max_age_days) if args.max_age_days else None,
+    )
+    try:
+        while True:
+            try:
+                await reaper.reap()
+            except Exception:
+                logger.exception("Spark cluster reaping failed")
+            if not args.interval:
+                return
+            await asyncio.sleep(args.interval)
+    finally:
+        await hub.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=3600,
+        help="Seconds between runs. 0 runs once and exits.",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=5, help="Users checked at once."
+    )
+    parser.add_argument(
+        "--max-age-days",
+        type=float,
+        default=30,
+        help="Skip users inactive for longer than this. 0 checks every user.",
+    )
+    logging.basicConfig(
+        level=logging.INFO, format="[%(levelname)s %(asctime)s %(name)s] %(message)s"
+    )
+    asyncio.run(main(parser.parse_args()))
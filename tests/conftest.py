@@ -0,0 +1,21 @@
+import pytest
+
+from tests.fakes import FakeClusterManager
+
+
+@pytest.fixture
+def cluster_manager(monkeypatch):
+    """
+    Replace the Spark Cluster Manager API with a FakeClusterManager.
+    """
+    pytest.importorskip("spark_manager_client")
+    from berdl.clients.spark import cluster
+
+    fake = FakeClusterManager()
+    for name in (
+        "create_cluster_async",
+        "delete_cluster_async",
+        "get_cluster_status_async",
+    ):
+        monkeypatch.setattr(cluster, name, getattr(fake, name))
+    return fake
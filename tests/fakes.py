@@ -0,0 +1,195 @@
+"""
+Fakes of the hub, the KBase auth server and the Spark Cluster Manager for the tests.
+"""
+
+import logging
+from types import SimpleNamespace
+from typing import Dict, List
+
+from berdl.auth.kb_auth import AdminPermission, KBaseUser
+
+
+class FakeUser:
+    """
+    A hub user with a stored auth_state.
+    """
+
+    def __init__(self, name: str, auth_state: dict | None = None):
+        self.name = name
+        self.auth_state = auth_state
+
+    async def get_auth_state(self) -> dict | None:
+        # the hub decrypts a new copy on every read
+        return dict(self.auth_state) if self.auth_state else None
+
+    async def save_auth_state(self, auth_state: dict) -> None:
+        self.auth_state = dict(auth_state)
+
+
+class FakeKBaseAuth:
+    """
+    A KBase auth client that accepts any token as belonging to the user named in the test.
+    """
+
+    def __init__(self, username: str = "alice"):
+        self.username = username
+
+    async def get_user(self, token, refresh=False):
+        return KBaseUser(self.username, AdminPermission.NONE, token)
+
+
+class FakeLoginHandler:
+    """
+    The parts of a hub login handler the authenticator uses.
+    """
+
+    def __init__(self, users: dict, token: str):
+        self.users = users
+        self.token = token
+
+    def get_cookie(self, name):
+        return self.token if name == "kbase_session" else None
+
+    def find_user(self, name):
+        return self.users.get(name)
+
+
+class FakeSpawner:
+    """
+    The parts of a KubeSpawner the BERDL hooks use.
+    """
+
+    def __init__(
+        self,
+        user: FakeUser,
+        profile_list: list | None = None,
+        user_options: dict | None = None,
+    ):
+        self.user = user
+        self.profile_list = profile_list or []
+        self.user_options = user_options or {}
+        self.environment: Dict[str, str] = {}
+        self.hub = SimpleNamespace(api_url="http://hub:8081/hub/api")
+        self.log = logging.getLogger("tests.spawner")
+
+
+class FakeClusterManager:
+    """
+    Stands in for the async functions of `berdl.clients.spark.cluster`, with at most one
+    cluster per KBase token. Clusters are ready as soon as they are created.
+    """
+
+    def __init__(self):
+        self.clusters: Dict[str, dict] = {}
+        self.created: List[tuple] = []
+        self.deleted: List[str] = []
+
+    async def create_cluster_async(self, kbase_auth_token=None, **shape):
+        master_url = f"spark://spark-master-{len(self.created)}:7077"
+        self.created.append((kbase_auth_token, shape))
+        self.clusters[kbase_auth_token] = {
+            "master_url": master_url,
+            "master": {"ready_replicas": 1},
+            "workers": {
+                "replicas": shape.get("worker_count", 0),
+                "ready_replicas": shape.get("worker_count", 0),
+            },
+        }
+        return SimpleNamespace(master_url=master_url)
+
+    async def delete_cluster_async(self, kbase_auth_token=None):
+        self.deleted.append(kbase_auth_token)
+        if self.clusters.pop(kbase_auth_token, None) is None:
+            return None
+        return SimpleNamespace(message="deleted")
+
+    async def get_cluster_status_async(self, kbase_auth_token=None):
+        return self.clusters.get(kbase_auth_token)
+
+
+class FakeKubernetes:
+    """
+    Stands in for the kubernetes_asyncio CoreV1Api and NetworkingV1Api methods the hub uses.
+    Objects are kept as the dicts they were created from. Pods report the phase returned by
+    `pod_phase`, called with the pod.
+    """
+
+    def __init__(self, nodes: list | None = None, pods: list | None = None):
+        self.nodes = nodes or []
+        self.pods = pods or []  # pods already on the nodes, as kubernetes models
+        self.objects: Dict[tuple, dict] = {}  # by (kind, name)
+        self.created: Dict[tuple, dict] = {}  # every object ever created, in order
+        self.deleted: List[tuple] = []
+        self.pod_phase = lambda pod: "Succeeded"
+
+    @staticmethod
+    def _error(status: int):
+        from kubernetes_asyncio import client as k8s
+
+        return k8s.ApiException(status=status)
+
+    def _create(self, kind: str, body: dict) -> SimpleNamespace:
+        key = (kind, body["metadata"]["name"])
+        if key in self.objects:
+            raise self._error(409)
+        self.objects[key] = self.created[key] = body
+        return SimpleNamespace(
+            metadata=SimpleNamespace(name=key[1], creation_timestamp=None)
+        )
+
+    def _delete(self, kind: str, name: str) -> None:
+        self.deleted.append((kind, name))
+        if self.objects.pop((kind, name), None) is None:
+            raise self._error(404)
+
+    async def list_node(self, label_selector: str = ""):
+        return SimpleNamespace(items=self.nodes)
+
+    async def list_pod_for_all_namespaces(self, field_selector: str = ""):
+        return SimpleNamespace(items=self.pods)
+
+    async def read_namespaced_config_map(self, name, namespace):
+        body = self.objects.get(("ConfigMap", name))
+        if body is None:
+            raise self._error(404)
+        return SimpleNamespace(
+            metadata=SimpleNamespace(name=name, creation_timestamp=body["created"]),
+            data=body["data"],
+        )
+
+    async def create_namespaced_config_map(self, namespace, body):
+        from datetime import datetime, timezone
+
+        self._create("ConfigMap", {**body, "created": datetime.now(timezone.utc)})
+        return await self.read_namespaced_config_map(body["metadata"]["name"], namespace)
+
+    async def patch_namespaced_config_map(self, name, namespace, body):
+        self.objects[("ConfigMap", name)]["data"].update(body["data"])
+
+    async def create_namespaced_secret(self, namespace, body):
+        return self._create("Secret", body)
+
+    async def delete_namespaced_secret(self, name, namespace):
+        self._delete("Secret", name)
+
+    async def create_namespaced_network_policy(self, namespace, body):
+        return self._create("NetworkPolicy", body)
+
+    async def delete_namespaced_network_policy(self, name, namespace):
+        self._delete("NetworkPolicy", name)
+
+    async def create_namespaced_pod(self, namespace, body):
+        return self._create("Pod", body)
+
+    async def read_namespaced_pod(self, name, namespace):
+        body = self.objects.get(("Pod", name))
+        if body is None:
+            raise self._error(404)
+        return SimpleNamespace(
+            status=SimpleNamespace(
+                phase=self.pod_phase(body), pod_ip="10.0.0.1", container_statuses=[]
+            )
+        )
+
+    async def delete_namespaced_pod(self, name, namespace):
+        self._delete("Pod", name)
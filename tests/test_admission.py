@@ -0,0 +1,125 @@
+import asyncio
+
+import pytest
+
+from berdl.config.admission import AdmissionController, AdmissionTimeoutError
+
+
+async def _hold(controller, key, order, release):
+    async with controller.slot(key):
+        order.append(key)
+        await release.wait()
+
+
+async def _acquire_with_positions(controller, key, order, positions):
+    async with controller.slot(key, on_position=positions.append):
+        order.append(key)
+
+
+def test_queue_is_fair_across_users():
+    async def run():
+        controller = AdmissionController("test-fair", 1)
+        order, release = [], asyncio.Event()
+        holder = asyncio.ensure_future(_hold(controller, "holder", order, release))
+        await asyncio.sleep(0)
+        positions = []
+        waiters = [
+            asyncio.ensure_future(_hold(controller, "busy", order, release)),
+            asyncio.ensure_future(_hold(controller, "busy", order, release)),
+            asyncio.ensure_future(_hold(controller, "busy", order, release)),
+        ]
+        await asyncio.sleep(0)
+        waiters.append(
+            asyncio.ensure_future(
+                _acquire_with_positions(controller, "other", order, positions)
+            )
+        )
+        await asyncio.sleep(0)
+        assert controller.queued == 4
+        # served after the busy user's first request, not after all three
+        assert positions == [2]
+
+        release.set()
+        await asyncio.gather(holder, *waiters)
+        return order
+
+    assert asyncio.run(run()) == ["holder", "busy", "other", "busy", "busy"]
+
+
+def test_queue_timeout():
+    async def run():
+        controller = AdmissionController("test-timeout", 1, queue_timeout=0.05)
+        release = asyncio.Event()
+        holder = asyncio.ensure_future(_hold(controller, "holder", [], release))
+        await asyncio.sleep(0)
+        with pytest.raises(AdmissionTimeoutError):
+            async with controller.slot("late"):
+                pass
+        assert controller.queued == 0
+        release.set()
+        await holder
+        # the timed out caller did not keep a slot
+        async with controller.slot("next"):
+            pass
+
+    asyncio.run(run())
+
+
+def test_limit_shrinks_on_failed_and_slow_calls():
+    async def run():
+        controller = AdmissionController(
+            "test-shrink", 8, latency_target=0.01, cooldown=0
+        )
+        with pytest.raises(RuntimeError):
+            async with controller.slot("alice"):
+                raise RuntimeError("downstream failed")
+        assert controller.limit == 5
+        async with controller.slot("alice"):
+            await asyncio.sleep(0.02)
+        assert controller.limit == 3
+
+    asyncio.run(run())
+
+
+def test_limit_grows_on_fast_calls_up_to_max():
+    async def run():
+        controller = AdmissionController(
+            "test-grow", 2, max_limit=3, latency_target=1, cooldown=0
+        )
+        for _ in range(3):
+            async with controller.slot("alice"):
+                pass
+        assert controller.limit == 3
+        for _ in range(10):
+            async with controller.slot("alice"):
+                pass
+        assert controller.limit == 3
+
+    asyncio.run(run())
+
+
+def test_cancellation_releases_slot():
+    async def run():
+        controller = AdmissionController("test-cancel", 1)
+        order, release = [], asyncio.Event()
+        holder = asyncio.ensure_future(_hold(controller, "holder", order, release))
+        await asyncio.sleep(0)
+        queued = asyncio.ensure_future(_hold(controller, "queued", order, release))
+        await asyncio.sleep(0)
+
+        # a waiter cancelled in the queue leaves it
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert controller.queued == 0
+
+        # a holder cancelled inside its slot frees the slot for the next caller
+        waiter = asyncio.ensure_future(_hold(controller, "waiter", order, release))
+        await asyncio.sleep(0)
+        holder.cancel()
+        await asyncio.gather(holder, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert order == ["holder", "waiter"]
+        release.set()
+        await waiter
+
+    asyncio.run(run())
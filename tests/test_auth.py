@@ -0,0 +1,28 @@
+import asyncio
+
+from berdl.auth.kb_jupyterhub_auth import KBaseAuthenticator
+from tests.fakes import FakeKBaseAuth, FakeLoginHandler, FakeUser
+
+
+def _login(users: dict, token: str) -> dict:
+    authenticator = KBaseAuthenticator()
+    authenticator._kb_auth = FakeKBaseAuth()
+    return asyncio.run(authenticator.authenticate(FakeLoginHandler(users, token)))
+
+
+def test_first_login_stores_token():
+    authenticated = _login({}, "token-1")
+    assert authenticated["name"] == "alice"
+    assert authenticated["auth_state"] == {"kbase_token": "token-1"}
+
+
+def test_login_keeps_cached_auth_state():
+    user = FakeUser(
+        "alice",
+        {"kbase_token": "token-1", "minio_credentials": {"access_key": "a"}},
+    )
+    authenticated = _login({"alice": user}, "token-2")
+    assert authenticated["auth_state"] == {
+        "kbase_token": "token-2",
+        "minio_credentials": {"access_key": "a"},
+    }
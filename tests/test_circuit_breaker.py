@@ -0,0 +1,69 @@
+import pytest
+
+from berdl.auth.circuit_breaker import BreakerState, CircuitBreaker, CircuitOpenError
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def _breaker(timer, states):
+    return CircuitBreaker(
+        failure_threshold=3,
+        reset_timeout=30,
+        on_state_change=states.append,
+        timer=timer,
+    )
+
+
+def test_breaker_opens_half_opens_and_closes():
+    timer, states = FakeTimer(), []
+    breaker = _breaker(timer, states)
+    for _ in range(3):
+        breaker.check()
+        breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    timer.now += 30
+    assert breaker.state == BreakerState.HALF_OPEN
+    breaker.check()
+    # only one trial call at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+
+    assert breaker.state == BreakerState.CLOSED
+    breaker.check()
+    assert states == [BreakerState.OPEN, BreakerState.HALF_OPEN, BreakerState.CLOSED]
+
+
+def test_failed_trial_opens_breaker_again():
+    timer, states = FakeTimer(), []
+    breaker = _breaker(timer, states)
+    for _ in range(3):
+        breaker.record_failure()
+    timer.now += 30
+    breaker.check()
+    breaker.record_failure()
+    assert breaker.state == BreakerState.OPEN
+    timer.now += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_success_resets_failure_count():
+    timer, states = FakeTimer(), []
+    breaker = _breaker(timer, states)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.state == BreakerState.CLOSED
+    assert states == []
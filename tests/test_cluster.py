@@ -0,0 +1,94 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.clients.spark import cluster  # noqa: E402
+
+DELAY = 0.5
+
+
+class SlowClusterManager(httpx.AsyncBaseTransport):
+    """
+    A Spark Cluster Manager that takes DELAY seconds to answer, as it does while Kubernetes
+    starts or stops the cluster.
+    """
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(DELAY)
+        body = {
+            "cluster_id": "spark-cluster-alice",
+            "master_url": "spark://spark-master-alice:7077",
+            "master_ui_url": "http://spark-master-alice:8080",
+            "message": "done",
+        }
+        status = 201 if request.method == "POST" else 200
+        return httpx.Response(status, json=body)
+
+
+@pytest.fixture
+def slow_cluster_manager(monkeypatch):
+    monkeypatch.setenv("SPARK_CLUSTER_MANAGER_API_URL", "http://cluster-manager")
+    monkeypatch.setattr(cluster, "_async_transport", SlowClusterManager())
+
+
+async def _max_loop_lag(work) -> float:
+    """
+    Run work while measuring how late a 10ms timer fires, and return the worst delay.
+    """
+    lags = []
+    done = asyncio.Event()
+
+    async def tick():
+        while not done.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    ticker = asyncio.ensure_future(tick())
+    try:
+        await work
+    finally:
+        done.set()
+        await ticker
+    return max(lags)
+
+
+def test_create_and_delete_do_not_block_event_loop(slow_cluster_manager):
+    async def run():
+        start = time.perf_counter()
+        responses = []
+
+        async def work():
+            responses.append(
+                await cluster.create_cluster_async(kbase_auth_token="token")
+            )
+            responses.append(
+                await cluster.delete_cluster_async(kbase_auth_token="token")
+            )
+
+        lag = await _max_loop_lag(work())
+        assert time.perf_counter() - start >= 2 * DELAY
+        assert lag < 0.1
+        assert responses[0].master_url == "spark://spark-master-alice:7077"
+        assert responses[1] is not None
+
+    asyncio.run(run())
+
+
+def test_concurrent_creates_overlap(slow_cluster_manager):
+    async def run():
+        start = time.perf_counter()
+        lag = await _max_loop_lag(
+            asyncio.gather(
+                *(cluster.create_cluster_async(kbase_auth_token=f"t{i}") for i in range(10))
+            )
+        )
+        # ten users' creates share the loop and the connection pool rather than queueing
+        assert time.perf_counter() - start < 5 * DELAY
+        assert lag < 0.1
+
+    asyncio.run(run())
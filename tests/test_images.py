@@ -0,0 +1,138 @@
+import asyncio
+
+import httpx
+import pytest
+from kubernetes import client
+
+from berdl.config.images import ImagePins, ImagePrePuller, RegistryClient
+from tests.fakes import FakeKubernetes
+
+IMAGE = "ghcr.io/bio-boris/berdl_notebook:main"
+DIGEST = "sha256:" + "ab" * 32
+
+
+def _registry(digests: dict) -> httpx.MockTransport:
+    """
+    A stub registry that requires an anonymous Bearer token, and serves the digests of tags
+    by repository:tag.
+    """
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path == "/token":
+            return httpx.Response(200, json={"token": "anonymous"})
+        if request.headers.get("Authorization") != "Bearer anonymous":
+            return httpx.Response(
+                401,
+                headers={
+                    "www-authenticate": 'Bearer realm="https://ghcr.io/token",'
+                    'service="ghcr.io"'
+                },
+            )
+        repository, _, tag = request.url.path[len("/v2/") :].partition("/manifests/")
+        digest = digests.get(f"{repository}:{tag}")
+        if digest is None:
+            return httpx.Response(404)
+        return httpx.Response(200, headers={"docker-content-digest": digest})
+
+    return httpx.MockTransport(handler)
+
+
+def _pins(kube: FakeKubernetes, digests: dict) -> ImagePins:
+    return ImagePins(
+        registry=RegistryClient(_registry(digests)),
+        prepuller=ImagePrePuller(kube, namespace="hub", poll_interval=0),
+        refresh_interval=0,
+    )
+
+
+def test_registry_resolves_tag_with_anonymous_token():
+    async def run():
+        registry = RegistryClient(_registry({"bio-boris/berdl_notebook:main": DIGEST}))
+        try:
+            assert await registry.resolve(IMAGE) == DIGEST
+            with pytest.raises(httpx.HTTPStatusError):
+                await registry.resolve("ghcr.io/bio-boris/berdl_notebook:missing")
+        finally:
+            await registry.close()
+
+    asyncio.run(run())
+
+
+def test_new_digest_is_pulled_onto_nodes_before_it_is_pinned():
+    async def run():
+        kube = FakeKubernetes()
+        pins = _pins(kube, {"bio-boris/berdl_notebook:main": DIGEST})
+        pins.start(
+            [{"kubespawner_override": {"image": IMAGE}}], nodes=["node-a", "node-b"]
+        )
+        await pins._task
+
+        pinned = f"ghcr.io/bio-boris/berdl_notebook@{DIGEST}"
+        pulled = sorted(
+            (
+                body["spec"]["nodeSelector"]["kubernetes.io/hostname"],
+                body["spec"]["containers"][0]["image"],
+            )
+            for body in kube.created.values()
+        )
+        assert pulled == [("node-a", pinned), ("node-b", pinned)]
+        assert kube.objects == {}
+
+        pod = client.V1Pod(
+            spec=client.V1PodSpec(
+                containers=[client.V1Container(name="notebook", image=IMAGE)]
+            )
+        )
+        container = pins.pin(pod).spec.containers[0]
+        assert container.image == pinned
+        assert container.image_pull_policy == "IfNotPresent"
+
+    asyncio.run(run())
+
+
+def test_unresolved_image_keeps_its_tag():
+    async def run():
+        kube = FakeKubernetes()
+        pins = _pins(kube, {})
+        pins.start([{"kubespawner_override": {"image": IMAGE}}], nodes=["node-a"])
+        await pins._task
+
+        assert kube.created == {}
+        pod = client.V1Pod(
+            spec=client.V1PodSpec(
+                containers=[
+                    client.V1Container(
+                        name="notebook", image=IMAGE, image_pull_policy="Always"
+                    )
+                ]
+            )
+        )
+        container = pins.pin(pod).spec.containers[0]
+        assert (container.image, container.image_pull_policy) == (IMAGE, "Always")
+
+    asyncio.run(run())
+
+
+def test_pinning_does_not_change_shared_sidecars():
+    pytest.importorskip("spark_manager_client")
+    from berdl.config.pod_template import PodTemplate
+
+    async def run():
+        pins = _pins(FakeKubernetes(), {"bio-boris/berdl_notebook:main": DIGEST})
+        pins.start([{"kubespawner_override": {"image": IMAGE}}])
+        await pins._task
+
+        template = PodTemplate({"sidecars": [{"name": "proxy", "image": IMAGE}]})
+        for _ in range(2):
+            pod = client.V1Pod(
+                metadata=client.V1ObjectMeta(),
+                spec=client.V1PodSpec(
+                    containers=[client.V1Container(name="notebook", image="notebook")]
+                ),
+            )
+            sidecar = pins.pin(template.apply(pod)).spec.containers[1]
+            assert sidecar.image.endswith(DIGEST)
+        assert template.sidecars[0].image == IMAGE
+        assert template.sidecars[0].image_pull_policy is None
+
+    asyncio.run(run())
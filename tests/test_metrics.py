@@ -0,0 +1,25 @@
+from types import SimpleNamespace
+
+from berdl.metrics import profile_label
+
+PROFILES = [{"slug": "small", "default": True}, {"slug": "large"}]
+
+
+def _spawner(user_options, profile_list=PROFILES):
+    return SimpleNamespace(user_options=user_options, profile_list=profile_list)
+
+
+def test_profile_label_is_a_known_slug():
+    assert profile_label(_spawner({"profile": "large"})) == "large"
+    assert profile_label(_spawner({})) == "default"
+    assert profile_label(_spawner(None)) == "default"
+
+
+def test_profile_label_bounds_unknown_values():
+    assert profile_label(_spawner({"profile": "x" * 100})) == "other"
+    assert profile_label(_spawner({"profile": ["large"]})) == "other"
+    assert profile_label(_spawner({"profile": "large"}, profile_list=[])) == "other"
+    # a callable profile_list cannot be checked without the spawner
+    assert profile_label(_spawner({"profile": "large"}, profile_list=lambda s: [])) == (
+        "other"
+    )
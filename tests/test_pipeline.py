@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.config.hooks import kubespawner_hooks  # noqa: E402
+from berdl.config.hooks.pipeline import (  # noqa: E402
+    HookPipeline,
+    SpawnStep,
+    StepResult,
+    StepStatus,
+)
+
+
+def _spawner():
+    return SimpleNamespace(
+        user=SimpleNamespace(name="alice"), log=logging.getLogger("tests.pipeline")
+    )
+
+
+def _step(name, events, delay=0.0, error=None, **kwargs):
+    async def run(spawner):
+        events.append(f"{name} started")
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        events.append(f"{name} done")
+
+    return SpawnStep(name, run, **kwargs)
+
+
+def test_steps_wait_for_dependencies():
+    events = []
+
+    async def run():
+        pipeline = HookPipeline("test")
+        pipeline.add_step(_step("first", events, delay=0.02))
+        pipeline.add_step(_step("independent", events))
+        pipeline.add_step(_step("second", events, depends_on=["first"]))
+        results = await pipeline.run(_spawner())
+        assert all(r.status == StepStatus.success for r in results.values())
+
+    asyncio.run(run())
+    # independent steps run concurrently, dependents only after their dependencies
+    assert events.index("independent done") < events.index("first done")
+    assert events.index("first done") < events.index("second started")
+
+
+def test_unknown_dependency_is_rejected():
+    pipeline = HookPipeline("test")
+    with pytest.raises(ValueError):
+        pipeline.add_step(_step("second", [], depends_on=["first"]))
+
+
+def test_non_critical_failure_skips_dependents():
+    events, failures = [], []
+
+    async def run():
+        pipeline = HookPipeline("test")
+        pipeline.add_step(
+            _step(
+                "optional",
+                events,
+                error=RuntimeError("down"),
+                critical=False,
+                on_failure=lambda spawner, e: failures.append(e),
+            )
+        )
+        pipeline.add_step(_step("dependent", events, depends_on=["optional"]))
+        pipeline.add_step(_step("other", events))
+        return await pipeline.run(_spawner())
+
+    results = asyncio.run(run())
+    assert results["optional"].status == StepStatus.failure
+    assert results["dependent"].status == StepStatus.skipped
+    assert results["other"].status == StepStatus.success
+    assert [str(e) for e in failures] == ["down"]
+    assert "dependent started" not in events
+
+
+def test_critical_failure_cancels_other_steps():
+    events = []
+
+    async def run():
+        pipeline = HookPipeline("test")
+        pipeline.add_step(_step("critical", events, error=RuntimeError("broken")))
+        pipeline.add_step(_step("slow", events, delay=10))
+        results = {}
+        start = time.perf_counter()
+        with pytest.raises(RuntimeError, match="broken"):
+            await pipeline.run(_spawner(), results)
+        assert time.perf_counter() - start < 1
+        assert results["critical"].status == StepStatus.failure
+        assert "slow" not in results
+
+    asyncio.run(run())
+    assert "slow started" in events and "slow done" not in events
+
+
+def test_retries_then_succeeds():
+    attempts = []
+
+    async def flaky(spawner):
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RuntimeError("flaky")
+
+    async def run():
+        pipeline = HookPipeline("test")
+        pipeline.add_step(SpawnStep("flaky", flaky, retries=2, retry_delay=0.001))
+        return await pipeline.run(_spawner())
+
+    result = asyncio.run(run())["flaky"]
+    assert result.status == StepStatus.success
+    assert result.attempts == 3
+
+
+def test_step_timeout():
+    async def run():
+        pipeline = HookPipeline("test")
+        pipeline.add_step(_step("slow", [], delay=10, timeout=0.05, critical=False))
+        return await pipeline.run(_spawner())
+
+    result = asyncio.run(run())["slow"]
+    assert result.status == StepStatus.timeout
+    assert isinstance(result.error, asyncio.TimeoutError)
+
+
+def test_deadline_bounds_all_attempts():
+    attempts = []
+
+    async def hang(spawner):
+        attempts.append(time.perf_counter())
+        await asyncio.sleep(10)
+
+    async def run():
+        pipeline = HookPipeline("test")
+        pipeline.add_step(
+            SpawnStep("slow", hang, deadline=0.2, retries=5, retry_delay=0.01)
+        )
+        results = {}
+        start = time.perf_counter()
+        with pytest.raises(asyncio.TimeoutError):
+            await pipeline.run(_spawner(), results)
+        assert time.perf_counter() - start < 0.5
+        assert results["slow"].status == StepStatus.timeout
+        # the first attempt used the whole deadline, so no retry started
+        assert len(attempts) == 1
+
+    asyncio.run(run())
+
+
+def test_failed_step_names_non_critical_failures():
+    def result(name, status):
+        return StepResult(name, status, 0, 1)
+
+    degraded = {
+        "governance": result("governance", StepStatus.failure),
+        "spark": result("spark", StepStatus.success),
+    }
+    assert kubespawner_hooks._failed_step(degraded) == "governance"
+    failed = {
+        "governance": result("governance", StepStatus.timeout),
+        "spark": result("spark", StepStatus.failure),
+    }
+    assert kubespawner_hooks._failed_step(failed) == "spark"
+    assert kubespawner_hooks._failed_step({}) == ""
@@ -0,0 +1,232 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+from kubernetes import client
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.config.placement import (  # noqa: E402
+    HomeIndex,
+    HomeMigrator,
+    NodePlacement,
+)
+from tests.fakes import FakeKubernetes, FakeSpawner, FakeUser  # noqa: E402
+
+IMAGE = "registry.example.org/rsync@sha256:" + "cd" * 32
+
+
+def _node(hostname: str, cpu: str = "8", memory: str = "32Gi", ready: bool = True):
+    # cloud providers name nodes differently from their hostname label
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(
+            name=f"ip-10-0-0-{ord(hostname[-1])}.ec2.internal",
+            labels={"kubernetes.io/hostname": hostname},
+        ),
+        spec=client.V1NodeSpec(unschedulable=False),
+        status=client.V1NodeStatus(
+            allocatable={"cpu": cpu, "memory": memory},
+            conditions=[
+                client.V1NodeCondition(type="Ready", status=str(ready))
+            ],
+        ),
+    )
+
+
+def _pod(hostname: str, cpu: str, memory: str):
+    return client.V1Pod(
+        spec=client.V1PodSpec(
+            node_name=f"ip-10-0-0-{ord(hostname[-1])}.ec2.internal",
+            containers=[
+                client.V1Container(
+                    name="c",
+                    resources=client.V1ResourceRequirements(
+                        requests={"cpu": cpu, "memory": memory}
+                    ),
+                )
+            ],
+        )
+    )
+
+
+def _spawner(name: str) -> FakeSpawner:
+    user = FakeUser(name)
+    user.created = datetime.now(timezone.utc)
+    spawner = FakeSpawner(user)
+    spawner.cpu_guarantee = 2
+    spawner.mem_guarantee = "8G"
+    spawner._expand_user_properties = lambda path: path.format(username=name)
+    return spawner
+
+
+class FakeMigrator:
+    def __init__(self, fail: bool = False):
+        self.copies = []
+        self.fail = fail
+
+    async def copy(self, path, source, target):
+        self.copies.append((path, source, target))
+        if self.fail:
+            raise RuntimeError("copy failed")
+
+
+def _placement(kube: FakeKubernetes, migrator=None) -> NodePlacement:
+    return NodePlacement(
+        node_selector="berdl/notebooks=true",
+        legacy_node=None,
+        api=kube,
+        index=HomeIndex(kube, namespace="hub"),
+        migrator=migrator,
+        home_path="/mnt/state/hub/{username}",
+        capacity_ttl=0,
+    )
+
+
+def test_new_user_goes_to_least_loaded_node():
+    async def run():
+        kube = FakeKubernetes(
+            nodes=[_node("node-a"), _node("node-b")],
+            pods=[_pod("node-a", "4", "8Gi")],
+        )
+        placement = _placement(kube)
+        spawner = _spawner("new-user")
+        assert await placement.place(spawner) == "node-b"
+        assert spawner.node_selector == {"kubernetes.io/hostname": "node-b"}
+        assert await placement._index.get("new-user") == "node-b"
+
+    asyncio.run(run())
+
+
+def test_user_stays_on_home_node_with_room():
+    async def run():
+        kube = FakeKubernetes(
+            nodes=[_node("node-a"), _node("node-b")],
+            pods=[_pod("node-a", "4", "8Gi")],
+        )
+        placement = _placement(kube)
+        await placement._index.set("home-user", "node-a")
+        assert await placement.place(_spawner("home-user")) == "node-a"
+
+    asyncio.run(run())
+
+
+def test_full_home_node_migrates_home():
+    async def run():
+        kube = FakeKubernetes(
+            nodes=[_node("node-a"), _node("node-b")],
+            pods=[_pod("node-a", "7", "8Gi")],
+        )
+        migrator = FakeMigrator()
+        placement = _placement(kube, migrator)
+        await placement._index.set("full-user", "node-a")
+        assert await placement.place(_spawner("full-user")) == "node-b"
+        # homes are copied between nodes by name, and notebooks placed by hostname
+        assert migrator.copies == [
+            ("/mnt/state/hub/full-user", "ip-10-0-0-97.ec2.internal", "ip-10-0-0-98.ec2.internal")
+        ]
+        assert await placement._index.get("full-user") == "node-b"
+
+    asyncio.run(run())
+
+
+def test_failed_migration_waits_on_home_node():
+    async def run():
+        kube = FakeKubernetes(
+            nodes=[_node("node-a"), _node("node-b")],
+            pods=[_pod("node-a", "7", "8Gi")],
+        )
+        placement = _placement(kube, FakeMigrator(fail=True))
+        await placement._index.set("stuck-user", "node-a")
+        assert await placement.place(_spawner("stuck-user")) == "node-a"
+        assert await placement._index.get("stuck-user") == "node-a"
+
+    asyncio.run(run())
+
+
+def test_node_hostnames_are_labels():
+    async def run():
+        kube = FakeKubernetes(nodes=[_node("node-a"), _node("node-b", ready=False)])
+        assert await _placement(kube).node_hostnames() == ["node-a"]
+
+    asyncio.run(run())
+
+
+def test_migration_needs_an_image():
+    with pytest.raises(ValueError):
+        HomeMigrator(FakeKubernetes(), FakeKubernetes(), namespace="hub", image="")
+
+
+def _migration_kube() -> FakeKubernetes:
+    kube = FakeKubernetes()
+    kube.pod_phase = lambda pod: (
+        "Running" if pod["metadata"]["name"].endswith("-src") else "Succeeded"
+    )
+    return kube
+
+
+def test_migration_authenticates_and_isolates_the_copy():
+    async def run():
+        kube = _migration_kube()
+        migrator = HomeMigrator(kube, kube, namespace="hub", image=IMAGE, poll_interval=0)
+        await migrator.copy("/mnt/state/hub/alice", "node-a", "node-b")
+
+        assert [kind for kind, _ in kube.created] == [
+            "Secret",
+            "NetworkPolicy",
+            "Pod",
+            "Pod",
+        ]
+        (secret, policy, server, client_pod) = kube.created.values()
+        password = secret["stringData"]["password"]
+        assert secret["stringData"]["rsyncd.secrets"] == f"berdl:{password}\n"
+
+        server_command = server["spec"]["containers"][0]["command"][-1]
+        assert "auth users = berdl" in server_command
+        assert "secrets file = /secret/rsyncd.secrets" in server_command
+        client_command = client_pod["spec"]["containers"][0]["command"][-1]
+        assert "--password-file=/secret/password" in client_command
+        assert "rsync://berdl@10.0.0.1:8730/home/" in client_command
+        for pod in (server, client_pod):
+            volumes = {v["name"]: v for v in pod["spec"]["volumes"]}
+            assert volumes["secret"]["secret"]["secretName"] == secret["metadata"]["name"]
+
+        # the daemon admits the copy's client only
+        assert (
+            policy["spec"]["podSelector"]["matchLabels"].items()
+            <= server["metadata"]["labels"].items()
+        )
+        allowed = policy["spec"]["ingress"][0]["from"][0]["podSelector"]["matchLabels"]
+        assert allowed.items() <= client_pod["metadata"]["labels"].items()
+        assert not allowed.items() <= server["metadata"]["labels"].items()
+
+        assert kube.objects == {}
+        assert sorted(kube.deleted) == sorted(kube.created)
+
+    asyncio.run(run())
+
+
+def test_migration_retry_uses_new_objects():
+    async def run():
+        kube = _migration_kube()
+        kube.pod_phase = lambda pod: "Failed"
+        migrator = HomeMigrator(kube, kube, namespace="hub", image=IMAGE, poll_interval=0)
+        with pytest.raises(RuntimeError):
+            await migrator.copy("/mnt/state/hub/bob", "node-a", "node-b")
+        # a pod that is still terminating keeps its name for a while
+        kube.objects.update(
+            {key: body for key, body in kube.created.items() if key[0] == "Pod"}
+        )
+        kube.pod_phase = _migration_kube().pod_phase
+        await migrator.copy("/mnt/state/hub/bob", "node-a", "node-b")
+        # the first attempt failed at its server pod
+        assert [kind for kind, _ in kube.created] == [
+            "Secret",
+            "NetworkPolicy",
+            "Pod",
+            "Secret",
+            "NetworkPolicy",
+            "Pod",
+            "Pod",
+        ]
+
+    asyncio.run(run())
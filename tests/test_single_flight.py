@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from berdl.auth.single_flight import SingleFlight
+
+
+def test_concurrent_callers_share_one_call():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(*(flight.do("key", fetch) for _ in range(10)))
+        assert flight.deduplicated == 9
+        assert flight.inflight == 0
+        return results
+
+    assert asyncio.run(run()) == ["result"] * 10
+    assert len(calls) == 1
+
+
+def test_different_keys_do_not_share():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0)
+
+    async def run():
+        flight = SingleFlight()
+        await asyncio.gather(flight.do("a", fetch), flight.do("b", fetch))
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_error_is_shared_and_next_call_runs_again():
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError("down")
+
+    async def run():
+        flight = SingleFlight()
+        results = await asyncio.gather(
+            *(flight.do("key", fail) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(r, RuntimeError) for r in results)
+        with pytest.raises(RuntimeError):
+            await flight.do("key", fail)
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_cancelled_caller_does_not_cancel_others():
+    async def fetch():
+        await asyncio.sleep(0.02)
+        return "result"
+
+    async def run():
+        flight = SingleFlight()
+        first = asyncio.ensure_future(flight.do("key", fetch))
+        second = asyncio.ensure_future(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await second == "result"
+
+    asyncio.run(run())
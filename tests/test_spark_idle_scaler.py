@@ -0,0 +1,64 @@
+import asyncio
+from datetime import timedelta
+
+import pytest
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.clients.spark.cluster import (  # noqa: E402
+    AUTH_STATE_SHAPE_KEY,
+    DEFAULT_CLUSTER_SHAPE,
+)
+from berdl.services.spark_idle_scaler import SparkIdleScaler  # noqa: E402
+
+
+class FakeHub:
+    """
+    The parts of the hub's API the idle scaler uses.
+    """
+
+    def __init__(self, models: dict):
+        self.models = models
+        self.requests = []
+
+    async def users(self, state: str):
+        for name, model in self.models.items():
+            yield {"name": name, **model}
+
+    async def user(self, name: str) -> dict:
+        return self.models[name]
+
+    async def spark_cluster(self, name: str, worker_count: int | None = None) -> dict:
+        self.requests.append((name, worker_count))
+        return {"user": name, "master_url": "spark://spark-master-0:7077"}
+
+
+def test_idle_cluster_is_scaled_through_hub(cluster_manager):
+    async def run():
+        hub = FakeHub(
+            {
+                "idle": {
+                    "auth_state": {
+                        "kbase_token": "idle-token",
+                        AUTH_STATE_SHAPE_KEY: list(DEFAULT_CLUSTER_SHAPE),
+                    },
+                    "servers": {
+                        "": {"ready": True, "last_activity": "2020-01-01T00:00:00Z"}
+                    },
+                }
+            }
+        )
+        await cluster_manager.create_cluster_async(
+            kbase_auth_token="idle-token", **DEFAULT_CLUSTER_SHAPE._asdict()
+        )
+        scaler = SparkIdleScaler(hub, timedelta(minutes=15))
+        try:
+            await scaler.check()
+        finally:
+            await scaler.close()
+
+        # the scaler never creates clusters itself, so it cannot race the hub
+        assert hub.requests == [("idle", 0)]
+        assert len(cluster_manager.created) == 1
+
+    asyncio.run(run())
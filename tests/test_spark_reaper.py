@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.clients.spark.cluster import AUTH_STATE_WARM_UNTIL_KEY  # noqa: E402
+from berdl.services.spark_reaper import SparkReaper  # noqa: E402
+
+
+class FakeHub:
+    """
+    The parts of the hub's API the reaper uses.
+    """
+
+    def __init__(self, models: dict):
+        self.models = models
+
+    async def users(self, state: str):
+        for name, model in self.models.items():
+            if not model.get("servers"):
+                yield {"name": name, "last_activity": None}
+
+    async def user(self, name: str) -> dict:
+        return self.models[name]
+
+
+def test_reaper_deletes_only_orphaned_clusters(cluster_manager):
+    async def run():
+        hub = FakeHub(
+            {
+                "orphan": {"auth_state": {"kbase_token": "orphan-token"}},
+                "warm": {
+                    "auth_state": {
+                        "kbase_token": "warm-token",
+                        AUTH_STATE_WARM_UNTIL_KEY: time.time() + 600,
+                    }
+                },
+                "expired": {
+                    "auth_state": {
+                        "kbase_token": "expired-token",
+                        AUTH_STATE_WARM_UNTIL_KEY: time.time() - 1,
+                    }
+                },
+                "running": {
+                    "auth_state": {"kbase_token": "running-token"},
+                    "servers": {"": {}},
+                },
+            }
+        )
+        for token in ("orphan-token", "warm-token", "expired-token", "running-token"):
+            await cluster_manager.create_cluster_async(kbase_auth_token=token)
+
+        assert await SparkReaper(hub).reap() == 2
+        assert sorted(cluster_manager.deleted) == ["expired-token", "orphan-token"]
+
+    asyncio.run(run())
@@ -0,0 +1,165 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.auth.kb_jupyterhub_auth import KBaseAuthenticator  # noqa: E402
+from berdl.clients.spark.cluster import (  # noqa: E402
+    AUTH_STATE_SHAPE_KEY,
+    DEFAULT_CLUSTER_SHAPE,
+)
+from berdl.config import spark_utils  # noqa: E402
+from berdl.config.spark_teardown import SparkTeardownQueue  # noqa: E402
+from berdl.config.spark_utils import SparkClusterManager  # noqa: E402
+from berdl.config.spark_warm_pool import SparkWarmPool  # noqa: E402
+from tests.fakes import (  # noqa: E402
+    FakeKBaseAuth,
+    FakeLoginHandler,
+    FakeSpawner,
+    FakeUser,
+)
+
+
+def _reconcile_results(result: str) -> float:
+    return (
+        REGISTRY.get_sample_value(
+            "berdl_spark_cluster_reconcile_results_total",
+            {"result": result, "profile": "default"},
+        )
+        or 0
+    )
+
+
+def test_restart_within_grace_period_adopts_cluster(cluster_manager, monkeypatch):
+    async def run():
+        monkeypatch.setattr(spark_utils, "spark_teardown", SparkTeardownQueue(grace=30))
+        user = FakeUser("adopt-user", {"kbase_token": "adopt-token"})
+
+        master_url = await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user))
+        await SparkClusterManager.stop_spark_cluster(FakeSpawner(user))
+        await asyncio.sleep(0.05)
+        adopted = _reconcile_results("adopted")
+
+        assert await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user)) == master_url
+        assert _reconcile_results("adopted") == adopted + 1
+        await asyncio.sleep(0)
+        assert len(cluster_manager.created) == 1
+        assert cluster_manager.deleted == []
+        assert spark_utils.spark_teardown.pending == 0
+
+    asyncio.run(run())
+
+
+def test_restart_after_login_adopts_cluster(cluster_manager, monkeypatch):
+    async def run():
+        monkeypatch.setattr(spark_utils, "spark_teardown", SparkTeardownQueue(grace=30))
+        user = FakeUser("relogin-user", {"kbase_token": "relogin-token"})
+        authenticator = KBaseAuthenticator()
+        authenticator._kb_auth = FakeKBaseAuth("relogin-user")
+
+        master_url = await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user))
+        await SparkClusterManager.stop_spark_cluster(FakeSpawner(user))
+        # the hub saves the auth_state returned on login in place of the stored one
+        authenticated = await authenticator.authenticate(
+            FakeLoginHandler({user.name: user}, "relogin-token")
+        )
+        await user.save_auth_state(authenticated["auth_state"])
+        assert AUTH_STATE_SHAPE_KEY in user.auth_state
+
+        assert await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user)) == master_url
+        await asyncio.sleep(0)
+        assert len(cluster_manager.created) == 1
+        assert cluster_manager.deleted == []
+
+    asyncio.run(run())
+
+
+def test_cluster_deleted_after_grace_period(cluster_manager, monkeypatch):
+    async def run():
+        monkeypatch.setattr(
+            spark_utils, "spark_teardown", SparkTeardownQueue(grace=0.01)
+        )
+        user = FakeUser("grace-user", {"kbase_token": "grace-token"})
+
+        await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user))
+        await SparkClusterManager.stop_spark_cluster(FakeSpawner(user))
+        assert cluster_manager.deleted == []
+        await asyncio.sleep(0.1)
+        assert cluster_manager.deleted == ["grace-token"]
+
+        missing = _reconcile_results("missing")
+        await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user))
+        assert _reconcile_results("missing") == missing + 1
+        assert len(cluster_manager.created) == 2
+
+    asyncio.run(run())
+
+
+def test_stop_uses_token_from_latest_login(cluster_manager, monkeypatch):
+    async def run():
+        monkeypatch.setattr(
+            spark_utils, "spark_teardown", SparkTeardownQueue(grace=0.01)
+        )
+        user = FakeUser("stop-user", {"kbase_token": "spawn-token"})
+        spawner = FakeSpawner(user)
+
+        await SparkClusterManager.ensure_spark_cluster(spawner)
+        user.auth_state["kbase_token"] = "login-token"
+        await SparkClusterManager.stop_spark_cluster(spawner)
+        await asyncio.sleep(0.1)
+        assert cluster_manager.deleted == ["login-token"]
+
+    asyncio.run(run())
+
+
+def test_scale_joins_create_in_flight(cluster_manager):
+    async def run():
+        user = FakeUser("scale-race-user", {"kbase_token": "scale-race-token"})
+        spawner = FakeSpawner(user)
+
+        ensure = asyncio.ensure_future(SparkClusterManager.ensure_spark_cluster(spawner))
+        await asyncio.sleep(0)
+        master_url = await SparkClusterManager.scale_spark_cluster(spawner, 0)
+
+        assert await ensure == master_url
+        assert len(cluster_manager.created) == 1
+        shape = cluster_manager.created[0][1]
+        assert shape["worker_count"] == DEFAULT_CLUSTER_SHAPE.worker_count
+
+    asyncio.run(run())
+
+
+def test_scale_after_stop_leaves_cluster_deleted(cluster_manager, monkeypatch):
+    async def run():
+        monkeypatch.setattr(
+            spark_utils, "spark_teardown", SparkTeardownQueue(grace=0.01)
+        )
+        user = FakeUser("scale-stop-user", {"kbase_token": "scale-stop-token"})
+        spawner = FakeSpawner(user)
+
+        await SparkClusterManager.ensure_spark_cluster(spawner)
+        await SparkClusterManager.stop_spark_cluster(spawner)
+        assert await SparkClusterManager.scale_spark_cluster(spawner, 0) is None
+        await asyncio.sleep(0.1)
+        assert len(cluster_manager.created) == 1
+        assert cluster_manager.clusters == {}
+
+    asyncio.run(run())
+
+
+def test_deleted_warm_cluster_is_replaced(cluster_manager, monkeypatch):
+    async def run():
+        user = FakeUser("warm-gone-user", {"kbase_token": "warm-gone-token"})
+        pool = SparkWarmPool(size=1, ttl=30)
+        monkeypatch.setattr(spark_utils, "spark_warm_pool", pool)
+        pool.provision("warm-gone-user", "warm-gone-token", DEFAULT_CLUSTER_SHAPE)
+        await asyncio.sleep(0.01)
+        await cluster_manager.delete_cluster_async(kbase_auth_token="warm-gone-token")
+
+        master_url = await SparkClusterManager.ensure_spark_cluster(FakeSpawner(user))
+        assert len(cluster_manager.created) == 2
+        assert cluster_manager.clusters["warm-gone-token"]["master_url"] == master_url
+
+    asyncio.run(run())
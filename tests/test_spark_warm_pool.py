@@ -0,0 +1,110 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("spark_manager_client")
+
+from berdl.clients.spark.cluster import (  # noqa: E402
+    AUTH_STATE_WARM_UNTIL_KEY,
+    DEFAULT_CLUSTER_SHAPE,
+)
+from berdl.config import spark_warm_pool as warm_pool_module  # noqa: E402
+from berdl.config.spark_warm_pool import (  # noqa: E402
+    SparkWarmPool,
+    warm_pool_post_auth_hook,
+)
+
+PROFILES = [
+    {"slug": "small", "default": True},
+    {"slug": "large", "spark": {"shape": {"worker_count": 6, "worker_cores": 4}}},
+    {"slug": "notebook", "spark": {"provisioning": "lazy"}},
+]
+
+
+@pytest.fixture
+def pool(cluster_manager, monkeypatch):
+    pool = SparkWarmPool(size=2, ttl=30)
+    pool.use_profiles(PROFILES)
+    monkeypatch.setattr(warm_pool_module, "spark_warm_pool", pool)
+    return pool
+
+
+@pytest.fixture
+def admitted(monkeypatch):
+    keys = []
+
+    @asynccontextmanager
+    async def slot(key, on_position=None):
+        keys.append(key)
+        yield
+
+    monkeypatch.setattr(warm_pool_module, "spark_admission", SimpleNamespace(slot=slot))
+    return keys
+
+
+def _handler(user_options: dict | None, active: bool = False):
+    user = SimpleNamespace(
+        active=active, spawner=SimpleNamespace(user_options=user_options)
+    )
+    return SimpleNamespace(find_user=lambda name: user)
+
+
+def _login(name: str, token: str) -> dict:
+    return {"name": name, "auth_state": {"kbase_token": token}}
+
+
+def test_shape_follows_last_profile(pool):
+    assert pool.shape_for(None) == DEFAULT_CLUSTER_SHAPE
+    assert pool.shape_for({"profile": "large"}) == DEFAULT_CLUSTER_SHAPE._replace(
+        worker_count=6, worker_cores=4
+    )
+    assert pool.shape_for({"profile": "large", "spark": {"worker_count": 2}}) == (
+        DEFAULT_CLUSTER_SHAPE._replace(worker_count=2, worker_cores=4)
+    )
+    assert pool.shape_for({"profile": "notebook"}) is None
+    assert pool.shape_for({"spark": {"worker_count": 10_000}}) is None
+
+
+def test_login_warms_cluster_of_last_profile(pool, admitted, cluster_manager):
+    async def run():
+        authentication = await warm_pool_post_auth_hook(
+            None, _handler({"profile": "large"}), _login("warm-user", "warm-token")
+        )
+        assert authentication["auth_state"][AUTH_STATE_WARM_UNTIL_KEY] > time.time()
+        shape = pool.shape_for({"profile": "large"})
+        response = await pool.take("warm-user", "warm-token", shape)
+        assert response.master_url
+        assert cluster_manager.created == [("warm-token", shape._asdict())]
+        assert admitted == ["warm-user"]
+
+    asyncio.run(run())
+
+
+def test_login_skips_lazy_profile_and_active_server(pool, admitted, cluster_manager):
+    async def run():
+        authentication = await warm_pool_post_auth_hook(
+            None, _handler({"profile": "notebook"}), _login("lazy-user", "lazy-token")
+        )
+        assert AUTH_STATE_WARM_UNTIL_KEY not in authentication["auth_state"]
+        await warm_pool_post_auth_hook(
+            None, _handler(None, active=True), _login("active-user", "active-token")
+        )
+        await asyncio.sleep(0)
+        assert cluster_manager.created == []
+        assert admitted == []
+
+    asyncio.run(run())
+
+
+def test_take_with_other_shape_is_cold(pool, admitted, cluster_manager):
+    async def run():
+        await warm_pool_post_auth_hook(
+            None, _handler(None), _login("cold-user", "cold-token")
+        )
+        large = pool.shape_for({"profile": "large"})
+        assert await pool.take("cold-user", "cold-token", large) is None
+
+    asyncio.run(run())
@@ -0,0 +1,83 @@
+import pytest
+
+from berdl.auth.kb_auth import InvalidTokenError
+from berdl.auth.token_cache import TokenCache, hash_token
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = TokenCache(max_size=2, ttl=60)
+    cache.put("token-a", "alice")
+    cache.put("token-b", "bob")
+    assert cache.get("token-a") == "alice"  # token-b is now least recently used
+    cache.put("token-c", "carol")
+
+    assert cache.get("token-b") is None
+    assert cache.get("token-a") == "alice"
+    assert cache.get("token-c") == "carol"
+    assert cache.stats.evictions == 1
+    assert cache.stats.size == 2
+
+
+def test_entries_expire():
+    timer = FakeTimer()
+    cache = TokenCache(ttl=60, timer=timer)
+    cache.put("token-a", "alice")
+    timer.now += 59
+    assert cache.get("token-a") == "alice"
+    timer.now += 1
+    assert cache.get("token-a") is None
+    assert cache.stats.size == 0
+
+
+def test_invalid_tokens_are_cached_for_negative_ttl():
+    timer = FakeTimer()
+    cache = TokenCache(ttl=60, negative_ttl=10, timer=timer)
+    error = InvalidTokenError("bad token")
+    cache.put_invalid("token-bad", error)
+    assert cache.get("token-bad") is error
+    assert cache.stats.negative_hits == 1
+    timer.now += 10
+    assert cache.get("token-bad") is None
+    # an invalid token is never served stale
+    assert cache.get_stale("token-bad") is None
+
+
+def test_negative_caching_can_be_disabled():
+    cache = TokenCache(negative_ttl=0)
+    cache.put_invalid("token-bad", InvalidTokenError("bad token"))
+    assert cache.get("token-bad") is None
+
+
+def test_stale_entries_are_kept_for_stale_ttl():
+    timer = FakeTimer()
+    cache = TokenCache(ttl=60, stale_ttl=30, timer=timer)
+    cache.put("token-a", "alice")
+    timer.now += 70
+    assert cache.get("token-a") is None
+    assert cache.get_stale("token-a") == "alice"
+    timer.now += 20
+    assert cache.get_stale("token-a") is None
+    assert cache.get("token-a") is None
+    assert cache.stats.size == 0
+
+
+def test_tokens_are_not_stored():
+    cache = TokenCache()
+    cache.put("secret-token", "alice")
+    assert "secret-token" not in cache._cache
+    assert hash_token("secret-token") in cache._cache
+
+
+def test_invalid_settings_are_rejected():
+    with pytest.raises(ValueError):
+        TokenCache(max_size=0)
+    with pytest.raises(ValueError):
+        TokenCache(ttl=-1)